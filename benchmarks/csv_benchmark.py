@@ -0,0 +1,56 @@
+"""Benchmark of storage.read_csv
+
+Compares the Arrow csv reader used by the loaders with the previous pandas path (type inference, single thread)
+on a synthetic forecast file of 10 years (40 forecasts per day), as well as the memory used by the DataFrames loaded
+(the Arrow path uses the compact dtypes of 'config.column_dtypes')
+
+    python benchmarks/csv_benchmark.py
+"""
+
+import os
+import tempfile
+import timeit
+import numpy as np
+import pandas as pd
+from roboclimate.storage import read_csv
+
+YEARS = 10
+STEP_3HOURS = 3 * 60 * 60
+
+
+def forecast_file(folder):
+    rng = np.random.default_rng(0)
+    days = YEARS * 365
+    # every day, 5 forecasts of each of the 8 dts of the following days
+    dts = 1575072000 + STEP_3HOURS * (np.repeat(np.arange(days) * 8, 40) + np.tile(np.arange(40), days))
+    today = pd.to_datetime(1575072000 + np.repeat(np.arange(days), 40) * 86400, unit='s').strftime('%Y-%m-%d')
+    n = len(dts)
+    forecast_df = pd.DataFrame({'temp': rng.normal(10, 3, n).round(2), 'pressure': rng.integers(980, 1040, n),
+                                'humidity': rng.integers(20, 100, n), 'wind_speed': rng.gamma(2, 2, n).round(2),
+                                'wind_deg': rng.integers(0, 360, n).astype(float), 'dt': dts, 'today': today})
+    forecast_df.loc[forecast_df.sample(frac=0.01, random_state=0).index, 'wind_deg'] = np.nan
+    file = os.path.join(folder, "forecast_london.csv")
+    forecast_df.to_csv(file, index=False)
+    return file, n
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        file, n = forecast_file(folder)
+        pandas_result = pd.read_csv(file, dtype={'dt': 'int64'})
+        arrow_result = read_csv(file)
+        assert (arrow_result['today'] == pd.to_datetime(pandas_result['today'])).all()
+        pd.testing.assert_frame_equal(arrow_result.drop(columns='today'), pandas_result.drop(columns='today'), check_dtype=False, rtol=1e-6)
+
+        pandas_time = min(timeit.repeat(lambda: pd.read_csv(file, dtype={'dt': 'int64'}), number=1, repeat=5))
+        arrow_time = min(timeit.repeat(lambda: read_csv(file), number=1, repeat=5))
+        print(f"{n} rows ({os.path.getsize(file) / 2 ** 20:.1f} MiB)")
+        print(f"pandas: {pandas_time:.3f} s")
+        print(f"arrow:  {arrow_time:.3f} s ({pandas_time / arrow_time:.1f}x faster)")
+        pandas_memory = pandas_result.memory_usage(deep=True).sum()
+        arrow_memory = arrow_result.memory_usage(deep=True).sum()
+        print(f"memory: {pandas_memory / 2 ** 20:.1f} MiB (pandas) vs {arrow_memory / 2 ** 20:.1f} MiB (arrow), {pandas_memory / arrow_memory:.1f}x smaller")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Benchmark of metrics.mean_absolute_scaled_error
+
+Compares the vectorized implementation with the previous one, that iterates over the series element by element,
+on a synthetic contiguous series of one million points (both must return the same result on contiguous data).
+It also times the seasonal (1-year) mase of the 5 models over the same series (more than 340 years of data points)
+
+    python benchmarks/mase_benchmark.py
+"""
+
+import timeit
+import numpy as np
+import pandas as pd
+from roboclimate.metrics import mean_absolute_scaled_error, mean_absolute_scaled_error_1year
+
+N = 1_000_000
+STEP_3HOURS = 3 * 60 * 60
+
+
+def loop_mean_absolute_scaled_error(real_data, predicted_data, dts, period=1) -> float:
+    """Previous implementation, that compares each value with the one 'period' positions before"""
+    if len(real_data) <= period:
+        return np.nan
+
+    period_in_seconds = STEP_3HOURS * period
+    forecast_zip = zip(real_data[period:], predicted_data[period:])
+    naive_forecast_zip = zip(real_data[period:], real_data[:-period])
+    dt_zip = zip(dts[period:], dts[:-period])
+    mae1 = 0
+    mae2 = 0
+
+    for dt_current, dt_previous in dt_zip:
+        real_value, forecast_value = next(forecast_zip)
+        _, naive_forecast_value = next(naive_forecast_zip)
+        if dt_current - dt_previous == period_in_seconds:
+            mae1 += abs(real_value - forecast_value)
+            mae2 += abs(real_value - naive_forecast_value)
+
+    try:
+        return mae1 / mae2
+    except ZeroDivisionError:
+        return np.nan
+
+
+def main():
+    rng = np.random.default_rng(0)
+    real_data = pd.Series(rng.normal(10, 3, N))
+    predicted_data = pd.Series(real_data + rng.normal(0, 1, N))
+    dts = pd.Series(1575072000 + STEP_3HOURS * np.arange(N))
+    period = 8
+
+    loop_result = loop_mean_absolute_scaled_error(real_data, predicted_data, dts, period)
+    vectorized_result = mean_absolute_scaled_error(real_data, predicted_data, dts, period)
+    np.testing.assert_allclose(vectorized_result, loop_result)
+
+    loop_time = min(timeit.repeat(lambda: loop_mean_absolute_scaled_error(real_data, predicted_data, dts, period), number=1, repeat=3))
+    vectorized_time = min(timeit.repeat(lambda: mean_absolute_scaled_error(real_data, predicted_data, dts, period), number=1, repeat=3))
+    print(f"{N} points, period={period}")
+    print(f"loop:       {loop_time:.3f} s")
+    print(f"vectorized: {vectorized_time:.3f} s ({loop_time / vectorized_time:.0f}x faster)")
+
+    joined_data = pd.DataFrame({'temp': real_data, 'dt': dts, **{f't{i}': predicted_data for i in range(5, 0, -1)}})
+    seasonal_time = min(timeit.repeat(lambda: mean_absolute_scaled_error_1year(joined_data, 'temp'), number=1, repeat=3))
+    print(f"1-year mase of t5...t1: {seasonal_time:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Climatology
+
+Module to build the climatology of a city: the values of a weather variable recorded on each month, day and hour of every
+year of the historical data (see function 'util.read_historical_data').
+
+The climatology is a dense array with one row per year and one column per month-day-hour slot of a leap year
+(366 * 24 slots), NaN where the historical data has no value. It is built once from the historical data and it can be
+cached on disk next to the historical data file, so that the naive forecasts based on previous years
+(see function 'metrics.mean_absolute_scaled_error_year_avg') become vectorized gathers from the array instead of lookups
+of every data point and year in the historical data.
+
+"""
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+import roboclimate.util as util
+
+logger = logging.getLogger(__name__)
+
+HOURS_PER_DAY = 24
+# first day of each month in a leap year, so that 29 February has its own slot
+MONTH_OFFSETS = np.array([0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335])
+SLOTS = 366 * HOURS_PER_DAY
+
+
+def slots(months, days, hours):
+    """
+    Month-day-hour slot of each datetime, e.g. 1 January 00:00 is slot 0 and 31 December 23:00 is slot 8783
+    """
+    return (MONTH_OFFSETS[np.asarray(months) - 1] + np.asarray(days) - 1) * HOURS_PER_DAY + np.asarray(hours)
+
+
+def build_climatology(historical_data: pd.DataFrame, weather_variable: str) -> dict:
+    """
+    Args:
+        historical_data (pd.DataFrame): historical data indexed by datetime (UTC), as returned by 'util.read_historical_data'
+        weather_variable (str): name of the weather variable
+
+    Returns:
+        dict: 'first_year' of the historical data and 'values', the (years, 366 * 24) array of the values of the weather
+        variable, NaN for the slots without data (e.g. 29 February of non-leap years)
+    """
+    datetimes = pd.DatetimeIndex(historical_data.index)
+    if len(datetimes) == 0:
+        return {'first_year': 0, 'values': np.empty((0, SLOTS))}
+    years = datetimes.year.to_numpy()
+    first_year = years.min()
+    values = np.full((years.max() - first_year + 1, SLOTS), np.nan)
+    values[years - first_year, slots(datetimes.month, datetimes.day, datetimes.hour)] = historical_data[weather_variable].to_numpy(dtype=np.float64)
+    return {'first_year': int(first_year), 'values': values}
+
+
+def climatology_file_path(historical_file: str, weather_variable: str) -> str:
+    return f"{os.path.splitext(historical_file)[0]}_climatology_{weather_variable}.npz"
+
+
+def load_climatology(historical_file: str, weather_variable: str) -> dict:
+    """
+    Climatology of the weather variable in the given historical data file (see function 'build_climatology')
+
+    The climatology is cached in a .npz file next to the historical data file, which is rebuilt whenever the size or the
+    modification time of the historical data file change
+    """
+    cache_file = climatology_file_path(historical_file, weather_variable)
+    stat = os.stat(historical_file)
+    source = np.array([stat.st_size, stat.st_mtime_ns])
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cache:
+            if np.array_equal(cache['source'], source):
+                return {'first_year': int(cache['first_year']), 'values': cache['values']}
+
+    logger.info("Building climatology of %s from %s", weather_variable, historical_file)
+    climatology = build_climatology(util.read_historical_data(historical_file), weather_variable)
+    np.savez(cache_file, source=source, first_year=climatology['first_year'], values=climatology['values'])
+    return climatology
+
+
+def years_average(climatology: dict, dts, years_back: int) -> np.ndarray:
+    """
+    Average of the values recorded on the same month, day and hour (UTC) over the 'years_back' years before each dt
+
+    Years without data are left out of the average, NaN is returned for the dts without data in any of those years.
+    29 February has no counterpart in most years, so NaN is returned for its dts
+    """
+    datetimes = pd.to_datetime(np.asarray(dts, dtype=np.int64), unit='s', utc=True)
+    values = climatology['values']
+    if values.shape[0] == 0:
+        return np.full(len(datetimes), np.nan)
+    rows = datetimes.year.to_numpy()[:, np.newaxis] - climatology['first_year'] - np.arange(1, years_back + 1)
+    valid = (rows >= 0) & (rows < values.shape[0])
+    day_slots = slots(datetimes.month, datetimes.day, datetimes.hour)[:, np.newaxis]
+    previous_values = np.where(valid, values[np.where(valid, rows, 0), day_slots], np.nan)
+    previous_values[(datetimes.month == 2) & (datetimes.day == 29)] = np.nan
+
+    counts = np.count_nonzero(~np.isnan(previous_values), axis=1)
+    totals = np.nansum(previous_values, axis=1)
+    return np.divide(totals, counts, out=np.full(len(totals), np.nan), where=counts > 0)
@@ -1,13 +1,17 @@
 from datetime import datetime, date
 from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 import os
+import json
+import time
+import fcntl
+import random
 import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
-from tenacity import retry
-from tenacity.retry import retry_if_exception_type
-from tenacity.wait import wait_fixed
-from tenacity.stop import stop_after_attempt
 
 # type alias
 csv_row = "list[str]"
@@ -25,6 +29,32 @@ CITIES = {"london": 2643743,
           "asuncion": 3439389,
           "lagos": 2332459}
 
+# pre-join of the weather and forecast data (see 'add_pending_forecasts' and 'complete_joins')
+PENDING_FORECASTS = "pending_forecasts"
+# separate from the join files written by the 'data_analysis' module, so that each file has a single writer
+PREJOIN_RESOURCE = "prejoin"
+WEATHER_VARIABLES = ['temp', 'pressure', 'humidity', 'wind_speed', 'wind_deg']  # first columns of the weather and forecast rows
+TX_SLOTS = ['t5', 't4', 't3', 't2', 't1']
+JOIN_HEADER = ','.join(['dt', 'today'] + [column for weather_variable in WEATHER_VARIABLES
+                                          for column in [weather_variable] + [f"{weather_variable}_{tx}" for tx in TX_SLOTS]])
+ONE_DAY_IN_SECONDS = 24 * 60 * 60
+
+# maximum number of cities processed at the same time, unless overridden by ROBOCLIMATE_SPIDER_CONCURRENCY (see 'run_cities')
+DEFAULT_CONCURRENCY = 10
+# retry policy of the requests (see 'read_remote_resource')
+REQUEST_TIMEOUT = 10  # seconds
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 1  # seconds, doubled after each attempt
+BACKOFF_CAP = 8  # seconds
+# time kept before the end of the invocation to finish the cities in progress (see 'invocation_deadline')
+DEADLINE_MARGIN = 2  # seconds
+# default limit of the requests of the spiders, as per OpenWeather's free plan, unless overridden by
+# ROBOCLIMATE_RATE_LIMIT (requests per minute, 0 for no limit) and ROBOCLIMATE_RATE_BURST (see 'get_rate_limiter')
+RATE_LIMIT = 60  # requests per minute
+RATE_BURST = 10  # requests
+# connections kept alive per host by the HTTP session, one per city processed at the same time
+POOL_MAXSIZE = DEFAULT_CONCURRENCY
+
 # openweathermap provides an endpoint to get a city's geo coordinates
 # https://api.openweathermap.org/geo/1.0/direct?q=London,GB&limit=5&appid=YOUR_API_KEY
 CityParams = namedtuple('CityParams', 'city_name lat lon tz_offset')
@@ -39,6 +69,70 @@ CITY_PARAMS = {'london': CityParams('london', 51.5073219, -0.1276474, 0),
                'asuncion': CityParams('asuncion', -25.2800459, -57.6343814, -4),
                'lagos': CityParams('lagos', 6.4550575, 3.3941795, 1)}
 
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request cannot be made before the deadline of the invocation
+    """
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate of the requests: the bucket holds up to 'burst' tokens, which are refilled at 'rate'
+    tokens per second, and every request takes one, waiting for it if the bucket is empty. Thus requests are made as
+    fast as possible while the average rate stays below 'rate'.
+
+    Tokens are reserved when requested, so that the threads waiting for tokens get them in turn.
+
+    If a 'state_file' is given, the state of the bucket is kept there instead of in memory, so that it is shared by all
+    the spiders using the same file and kept between invocations (see 'locked_json_file'). In that case, 'clock' must
+    be a wall clock (e.g. 'time.time') comparable among processes.
+    """
+
+    def __init__(self, rate: float, burst: int, clock=time.monotonic, sleep=time.sleep, state_file: str = None):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.state_file = state_file
+        self.state = {'tokens': burst, 'updated': clock()}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _locked_state(self):
+        with self.lock:
+            if self.state_file is None:
+                yield self.state
+            else:
+                with locked_json_file(self.state_file) as state:
+                    if not state:
+                        state.update(self.state)
+                    yield state
+
+    def acquire(self, timeout: float = None) -> float:
+        """
+        Take a token, waiting until it is available
+
+        Returns:
+            float: seconds waited
+
+        Raises:
+            DeadlineExceeded: if the token will not be available within 'timeout' seconds (it is not taken)
+        """
+        with self._locked_state() as state:
+            now = self.clock()
+            tokens = min(self.burst, state['tokens'] + max(now - state['updated'], 0) * self.rate)
+            wait_time = max(1 - tokens, 0) / self.rate
+            if timeout is not None and wait_time > timeout:
+                raise DeadlineExceeded(f"no request allowed in the next {timeout:.1f} s")
+            state['tokens'] = tokens - 1
+            state['updated'] = max(now, state['updated'])
+        if wait_time > 0:
+            self.sleep(wait_time)
+        return wait_time
+
+
 # global variables
 logger = logging.getLogger()
 if len(logger.handlers) > 0:
@@ -49,6 +143,19 @@ else:
     logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', level='INFO', filename='weather.log')
 
 
+# serializes the writes of the cities processed concurrently
+write_lock = threading.Lock()
+# HTTP session shared by all the requests, which outlives the invocation when the Lambda environment is reused
+# (see 'get_session')
+session = None
+session_lock = threading.Lock()
+# rate limiter of all the requests (see 'get_rate_limiter'), which is kept between invocations as well. It is None
+# until configured, and stays None once configured if the requests are not rate limited
+rate_limiter = None
+rate_limiter_configured = False
+rate_limiter_lock = threading.Lock()
+
+
 # common functions
 
 def utcnow_date() -> date:
@@ -59,14 +166,110 @@ def utcnow_date() -> date:
     return date(current_utc_dt.year, current_utc_dt.month, current_utc_dt.day)
 
 
-@retry(retry=retry_if_exception_type((RequestsConnectionError, Timeout)), stop=stop_after_attempt(2), wait=wait_fixed(5), reraise=True)
-def read_remote_resource(url):
-    return requests.get(url, timeout=10)
+def get_session() -> requests.Session:
+    """
+    Return the HTTP session of the spiders, which is created on first use
+
+    The connections of the session are kept alive and reused by the requests of all the cities and, as the session is a
+    global variable, by the next invocations handled by the same Lambda environment, saving the TCP (and TLS) handshake
+    of each request. Responses are compressed (gzip) unless ROBOCLIMATE_HTTP_GZIP is 'false'
+    """
+    global session  # pylint: disable=global-statement
+    with session_lock:
+        if session is None:
+            new_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(POOL_MAXSIZE, spider_concurrency()))
+            new_session.mount('http://', adapter)
+            new_session.mount('https://', adapter)
+            new_session.headers['Accept-Encoding'] = 'identity' if os.environ.get('ROBOCLIMATE_HTTP_GZIP') == 'false' else 'gzip, deflate'
+            session = new_session
+        return session
 
 
-def fetch_data(weather_resource_url: str) -> requests.Response:
+def invocation_deadline(context) -> 'float | None':
+    """
+    Deadline of the invocation (in terms of 'time.monotonic'), DEADLINE_MARGIN seconds before the Lambda invocation
+    times out according to 'context.get_remaining_time_in_millis()'
+
+    When running locally (no context), the budget in seconds can be set with ROBOCLIMATE_SPIDER_BUDGET. Otherwise there
+    is no deadline and None is returned
+    """
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+    if os.environ.get('ROBOCLIMATE_SPIDER_BUDGET'):
+        return time.monotonic() + float(os.environ['ROBOCLIMATE_SPIDER_BUDGET']) - DEADLINE_MARGIN
+    return None
+
+
+def get_rate_limiter() -> 'TokenBucket | None':
+    """
+    Return the rate limiter of the requests of the spiders, which is created on first use (see 'TokenBucket')
+
+    The rate (requests per minute) and burst are set with ROBOCLIMATE_RATE_LIMIT and ROBOCLIMATE_RATE_BURST (by default,
+    RATE_LIMIT and RATE_BURST). None is returned if the rate is 0. The state of the bucket is shared by the spiders through
+    the file ROBOCLIMATE_RATE_STATE_FILE if set (e.g. in the EFS volume of the csv files), otherwise it is only shared by
+    the invocations handled by the same Lambda environment
+    """
+    global rate_limiter, rate_limiter_configured  # pylint: disable=global-statement
+    with rate_limiter_lock:
+        if not rate_limiter_configured:
+            rate = float(os.environ.get('ROBOCLIMATE_RATE_LIMIT', RATE_LIMIT)) / 60
+            burst = int(os.environ.get('ROBOCLIMATE_RATE_BURST', RATE_BURST))
+            state_file = os.environ.get('ROBOCLIMATE_RATE_STATE_FILE') or None
+            rate_limiter = TokenBucket(rate, burst, time.time if state_file else time.monotonic, state_file=state_file) if rate > 0 else None
+            rate_limiter_configured = True
+        return rate_limiter
+
+
+def backoff(attempt: int) -> float:
+    """
+    Seconds to wait before retrying after the given attempt (starting at 0): exponential backoff with "full jitter", so
+    that the retries of the cities processed at the same time are spread out
+    """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def read_remote_resource(url, deadline: 'float | None' = None):
+    """
+    GET the url, retrying connection errors and timeouts up to MAX_ATTEMPTS times (see 'backoff')
+
+    Every attempt waits for the rate limiter first (see 'get_rate_limiter').
+
+    With a deadline, requests never last beyond it, and a retry is only started if there is time to wait for it and
+    complete it (REQUEST_TIMEOUT). DeadlineExceeded is raised if the deadline has already passed or will have passed
+    when the rate limiter allows the request, if a request times out because its timeout was cut short by the deadline
+    and if an error is not retried because there is no time left for the retry
+    """
+    limiter = get_rate_limiter()
+    for attempt in range(MAX_ATTEMPTS):
+        if limiter is not None:
+            limiter.acquire(None if deadline is None else deadline - time.monotonic())
+        timeout = REQUEST_TIMEOUT
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"deadline reached before requesting '{url}'")
+            timeout = min(REQUEST_TIMEOUT, remaining)
+        try:
+            return get_session().get(url, timeout=timeout)
+        except (RequestsConnectionError, Timeout) as ex:
+            if isinstance(ex, Timeout) and timeout < REQUEST_TIMEOUT:
+                raise DeadlineExceeded(f"deadline reached while requesting '{url}'") from ex
+            if attempt == MAX_ATTEMPTS - 1:
+                raise ex
+            wait_time = backoff(attempt)
+            if deadline is not None and time.monotonic() + wait_time + REQUEST_TIMEOUT > deadline:
+                raise DeadlineExceeded(f"no time left to retry '{url}' before the deadline") from ex
+            logger.warning("Error '%s' while reading '%s', retrying in %.1f s", ex, url, wait_time)
+            time.sleep(wait_time)
+
+
+def fetch_data(weather_resource_url: str, deadline: 'float | None' = None) -> requests.Response:
     try:
-        return read_remote_resource(weather_resource_url)
+        return read_remote_resource(weather_resource_url, deadline)
+    except DeadlineExceeded:
+        # not an error: the city is skipped and retried in the next invocation (see 'run_city')
+        raise
     except Exception as ex:
         logger.error("Error '%s' while reading '%s'", ex, weather_resource_url, exc_info=False)
         raise ex
@@ -90,6 +293,74 @@ def write_data(city_name: str, weather_resource: str, weather_data_csv: csv_rows
     write_to_filesystem(csv_file_name, csv_data_serialized, csv_header)
 
 
+@contextmanager
+def locked_json_file(file_name: str):
+    """
+    Dict stored in a json file shared by several processes (e.g. spiders running at the same time)
+
+    The file is locked while in use and it is written back atomically on exit, so that it is never left half-written
+    """
+    with open(f"{file_name}.lock", 'a', encoding='UTF-8') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            content = {}
+            if os.path.exists(file_name):
+                with open(file_name, encoding='UTF-8') as f:
+                    content = json.load(f)
+            yield content
+            with open(f"{file_name}.tmp", 'w', encoding='UTF-8') as f:
+                json.dump(content, f, separators=(',', ':'))
+            os.replace(f"{file_name}.tmp", file_name)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def pending_forecasts(csv_files_path: str, city_name: str):
+    """
+    Store of the forecasts of a city whose weather measurement has not been recorded yet, keyed by dt:
+
+        {"1575072000": [["2019-11-25", [temp, pressure, humidity, wind_speed, wind_deg]], ....], ....}
+
+    The weather and forecast spiders may use the store at the same time (see 'locked_json_file')
+    """
+    return locked_json_file(f"{csv_files_path}/{PENDING_FORECASTS}_{city_name}.json")
+
+
+def add_pending_forecasts(city_name: str, forecast_data_csv: csv_rows, run_params: dict):
+    """
+    Add the forecast rows written by the forecast spider to the pending forecasts of the city (see 'pending_forecasts')
+    """
+    with pending_forecasts(run_params['csv_files_path'], city_name) as store:
+        for row in forecast_data_csv:
+            store.setdefault(str(int(row[5])), []).append([row[6], row[:5]])
+
+
+def complete_joins(city_name: str, weather_data_csv: csv_rows, run_params: dict):
+    """
+    Join the weather rows written by the weather spider with their pending forecasts and append the result to the file
+    prejoin_{city}.csv, in the same format as the join files of the 'data_analysis' module (JOIN_HEADER). The spiders
+    are the only writers of that file
+
+    As in 'data_analysis', only the measurements with exactly 5 forecasts are joined: the oldest forecast is t5 and the
+    most recent one t1. No more forecasts are made for a dt once it has been measured, so its pending forecasts are
+    removed, as are the forecasts of the dts more than one day old, whose measurement was never recorded
+    """
+    joined_rows = []
+    with pending_forecasts(run_params['csv_files_path'], city_name) as store:
+        for row in weather_data_csv:
+            dt = int(row[5])
+            forecasts = sorted(store.pop(str(dt), []), key=lambda forecast: forecast[0])
+            if len(forecasts) == len(TX_SLOTS):
+                joined_rows.append([dt, row[6]] + [value for i in range(len(WEATHER_VARIABLES))
+                                                   for value in [row[i]] + [forecast[1][i] for forecast in forecasts]])
+            else:
+                logger.info("%d forecasts found for %s at %s, no join", len(forecasts), city_name, dt)
+            for expired_dt in [key for key in store if int(key) < dt - ONE_DAY_IN_SECONDS]:
+                del store[expired_dt]
+    if joined_rows:
+        write_data(city_name, PREJOIN_RESOURCE, joined_rows, run_params['csv_files_path'], JOIN_HEADER)
+
+
 def transform_data(weather_data: requests.Response, run_params: dict) -> csv_rows:
     try:
         weather_data_json = weather_data.json()
@@ -99,10 +370,64 @@ def transform_data(weather_data: requests.Response, run_params: dict) -> csv_row
         raise ex
 
 
-def run_city(city_name: str, run_params: dict):
+def store_city_data(city_name: str, weather_data_csv: csv_rows, run_params: dict):
+    """
+    Write the rows of the city and, if enabled, pre-join them (see 'run_params['prejoin_f']')
+    """
+    with write_lock:
+        write_data(city_name, run_params['weather_resource'], weather_data_csv, run_params['csv_files_path'], run_params['csv_header'])
+        if run_params.get('prejoin_f'):
+            run_params['prejoin_f'](city_name, weather_data_csv, run_params)
+
+
+def run_city(city_name: str, run_params: dict) -> bool:
+    """
+    Fetch, transform and store the data of the city. Errors are logged
+
+    Returns:
+        bool: False if the city was skipped because the deadline of the invocation ('run_params['deadline']') was reached
+    """
     try:
-        weather_data = fetch_data(run_params['weather_resource_url'])
+        weather_data = fetch_data(run_params['weather_resource_url'], run_params.get('deadline'))
         weather_data_csv = transform_data(weather_data, run_params)
-        write_data(city_name, run_params['weather_resource'], weather_data_csv, run_params['csv_files_path'], run_params['csv_header'])
+        store_city_data(city_name, weather_data_csv, run_params)
+    except DeadlineExceeded:
+        return False
     except Exception as ex:
         logger.error("Error '%s' while processing '%s'", ex, city_name, exc_info=True)
+    return True
+
+
+def spider_concurrency() -> int:
+    return int(os.environ.get('ROBOCLIMATE_SPIDER_CONCURRENCY', DEFAULT_CONCURRENCY))
+
+
+def run_cities(cities_run_params: 'dict[str, dict]', concurrency: int = None) -> 'list[str]':
+    """
+    Run 'run_city' for every city with its own run params
+
+    Most of the time of a city is spent waiting for the weather API, so up to 'concurrency' cities (by default, see
+    'spider_concurrency') are fetched and transformed at the same time by a pool of threads, and the total time is close
+    to the time of the slowest city. As in 'run_city', the errors of a city do not affect the rest of cities.
+    Files are written one city at a time.
+
+    Cities not started by the deadline of the run params are cancelled, while the requests in progress are bounded by
+    the deadline (see 'read_remote_resource').
+
+    Returns:
+        list[str]: cities skipped because of the deadline
+    """
+    concurrency = concurrency or spider_concurrency()
+    if concurrency <= 1 or len(cities_run_params) <= 1:
+        skipped = [city_name for city_name, run_params in cities_run_params.items() if not run_city(city_name, run_params)]
+    else:
+        deadlines = [run_params['deadline'] for run_params in cities_run_params.values() if run_params.get('deadline') is not None]
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(cities_run_params))) as executor:
+            futures = {city_name: executor.submit(run_city, city_name, run_params) for city_name, run_params in cities_run_params.items()}
+            _, not_done = wait(futures.values(), timeout=max(min(deadlines) - time.monotonic(), 0) if deadlines else None)
+            for future in not_done:
+                future.cancel()
+        skipped = [city_name for city_name, future in futures.items() if future.cancelled() or not future.result()]
+    if skipped:
+        logger.warning("Deadline reached, cities skipped: %s", ', '.join(skipped))
+    return skipped
@@ -15,12 +15,24 @@ cities = {"london": City(2643743, 'london', dt.datetime(2019, 11, 28, 3, 0, 0, t
           "lagos": City(2332459, 'lagos', dt.datetime(2021, 1, 27, 3, 0, 0, tzinfo=dt.timezone.utc))}
 
 weather_resources = ['weather', 'forecast']
+# join files written by the spiders (see 'common.complete_joins'), separate from the join files of 'data_analysis'
+prejoin_resource = 'prejoin'
 weather_variables = {'temperature': 'temp', 'pressure': 'pressure', 'humidity': 'humidity', 'wind_speed': 'wind_speed', 'wind_direction': 'wind_deg'}
 weather_variables_with_units = {'temperature': 'temp (°C)', 'pressure': 'pressure (hPa)', 'humidity': 'humidity (%)', 'wind_speed': 'wind_speed (m/s)', 'wind_direction': 'wind_deg (degrees)'}
 csv_folder = os.environ.get('ROBOCLIMATE_CSV_FILES_PATH')
 csv_header = list(weather_variables.values()) + ['dt', 'today']
+# dtypes of the columns of the weather, forecast and join files once loaded (see module 'storage'): the measurements, and
+# their forecasts in the join files ({weather variable}_{tx} or tx in the joins of a single weather variable), are
+# float32 and 'today' is a date
+measurement_dtype = 'float32'
+column_dtypes = {'dt': 'int64', 'today': 'datetime64[s]', **{f"t{i}": measurement_dtype for i in range(5, 0, -1)},
+                 **{column: measurement_dtype for weather_variable in weather_variables.values()
+                    for column in [weather_variable] + [f"{weather_variable}_t{i}" for i in range(5, 0, -1)]}}
 tolerance = {'positive_tolerance': 1200, 'negative_tolerance': 60}  # tolerance in seconds
 day_factor = 8  # number of data points per day
+rolling_windows = [7, 30, 365]  # length in days of the windows of the rolling metrics
+streaming_memory_cap = 256 * 2 ** 20  # approximate memory (bytes) used to analyse a city in streaming mode
+metric_breakdowns = ['hour', 'month', 'season', 'year']  # groupings of the metrics (see data_analysis.GROUPINGS)
 
 if __name__ == "__main__":
     for city in cities:
@@ -5,50 +5,97 @@ Module with functions to analyse the data collected by the weather and forecast
 For each weather variable and each city, data is analysed to calculate metrics about the accuracy of the forecasts.
 
 This module reads data from the folder containing the csv files generated by the weather and forecast spiders 
-(said folder is defined by the environment variable ROBOCLIMATE_CSV_FILES_PATH). Under that folder, it will create separate
+(said folder is defined by the environment variable ROBOCLIMATE_CSV_FILES_PATH), or from their Parquet mirror when they
+are mirrored, which is brought up to date first (see module 'storage'). Under that folder, it will create separate
 folders for each of the weather variables, each of them containing files for each of the cities.
 
-Two file types are generated for each weather variable: join_{city}.csv and metrics_{city}.csv.
+The join of each weather measurement with its 5 forecasts is stored in the file join_{city}.csv, that contains
+the values of all weather variables. See function 'join_weather_and_forecast' for more details.
 
-- join* files contain the result of joining each weather measurement with its 5 forecasts. 
-See function 'join_actual_values_and_forecast' for more details.
-
-- metrics* files contain the values of the different metrics for each tx forecast.
+For each weather variable, the file metrics_{city}.csv contains the values of the different metrics for each tx forecast.
 First row is t5, second row t4 and so on up to the fifth row that is t1.
-
-Metric calculations can be circumbscribed to a subset of data points by specifying the initial and final rows to take from 
-the original join* files (the ones generated by taking into account all data points).
-In doing so, the join* files will be re-written with only those rows
-CAUTION: while those limits apply to all cities and weather variables, not all of them may have the same number of data points.
+The file rolling_metrics_{city}.csv contains the time series of those metrics over rolling windows of several lengths and
+the files metrics_{grouping}_{city}.csv break them down by hour, month, season or year.
+Optionally, the join of each weather variable can also be exported to the file join_{city}.csv of the weather variable folder.
+See function 'weather_variable_join' for more details.
+
+Instead of rebuilding the join files from scratch, the analysis can be run in incremental mode: the last dt joined for each
+city (watermark) is stored in the file watermark_{city}.csv, so that subsequent runs only load and join the weather
+measurements recorded after that dt and append the result to the existing join files. The metrics are updated with the
+appended rows from the state kept in the file analysis_state_{city}.json (medae is then estimated).
+See function 'analyse_city_data' for more details.
+
+When the spiders join the data themselves (see 'common.complete_joins'), the analysis can be run in prejoined mode,
+which calculates the metrics from the prejoin_{city}.csv files of the spiders without reading the weather and forecast
+files. Those files are only read, the join_{city}.csv files are left as they are.
+
+Cities whose weather and forecast files have not changed since their last analysis are skipped: the size and modification
+time of the input files, the options of the analysis and a hash of the code are recorded in the file
+analysis_cache_{city}.json (see function 'analyse_data').
+
+Files too large to be loaded in memory can be analysed in streaming mode, which joins them chunk by chunk and calculates
+the metrics incrementally. See function 'analyse_city_data_streaming' for more details.
+
+Metric calculations can be circumbscribed to a subset of data points by specifying segments, either ranges of rows of
+the join of each weather variable (the one generated by taking into account all data points) or ranges of datetimes.
+The metrics are calculated over the union of the segments and the file metrics_segments_{city}.csv compares the metrics
+of each segment and of their union. In doing so, the exported join files of the weather variables will be re-written
+with only the rows of the segments.
+The segments can also be analysed on their own from the existing join files, without joining the data again
+(see function 'analyse_segments').
+CAUTION: while row limits apply to all cities and weather variables, not all of them may have the same number of data points.
 
 """
 
 import os
-from typing import List, Tuple, Dict
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Dict, Iterator, Optional
 import logging
-from math import sqrt
 import pandas as pd
-from sklearn.metrics import mean_absolute_error as mae
-from sklearn.metrics import mean_squared_error as mse
-from sklearn.metrics import median_absolute_error as medae
-from roboclimate.metrics import mean_absolute_scaled_error_tx as masetx
+import numpy as np
+from roboclimate.metrics import forecast_metrics, rolling_forecast_metrics, naive_forecast_errors, ForecastMetricsAccumulator, GroupedMetricsAccumulator
 import roboclimate.config as config
 import roboclimate.util as util
+import roboclimate.storage as storage
 
 logger = logging.getLogger(__name__)
-
-
-def load_data(file):
-    return pd.read_csv(file, dtype={'dt': 'int64'})
-
-
-def join_actual_values_and_forecast(actual_values_df, forecast_df) -> Dict[str, pd.DataFrame]:
+LOG_FORMAT = '%(asctime)s - %(processName)s - %(message)s'
+LOG_DATE_FORMAT = '%d-%b-%y %H:%M:%S'
+TX_HEADERS = ['t5', 't4', 't3', 't2', 't1']
+# in streaming mode, number of chunks that may be in memory at the same time: pyarrow reads up to 32 chunks ahead of
+# each file, and the weather chunk, forecasts of the following days and wide join take about 30 more
+STREAMING_CHUNKS = 128
+# approximate memory taken by DataFrame.to_csv to format a row of the join, which it turns into one python string per value
+CSV_WRITE_ROW_BYTES = 2 ** 11
+# modules whose code determines the output files of the analysis (see 'analysis_cache_key')
+CODE_MODULES = ['config', 'data_analysis', 'metrics', 'storage', 'util']
+# meteorological seasons
+SEASONS = {12: 'DJF', 1: 'DJF', 2: 'DJF', 3: 'MAM', 4: 'MAM', 5: 'MAM', 6: 'JJA', 7: 'JJA', 8: 'JJA', 9: 'SON', 10: 'SON', 11: 'SON'}
+# predefined groupings of data points based on their UTC datetime
+GROUPINGS = {
+    'hour': lambda datetimes: datetimes.dt.hour,
+    'month': lambda datetimes: datetimes.dt.month,
+    'season': lambda datetimes: datetimes.dt.month.map(SEASONS),
+    'year': lambda datetimes: datetimes.dt.year
+}
+
+
+def load_data(file, dt_range: Optional[Tuple[Optional[int], Optional[int]]] = None, mirror: bool = False):
+    """Load a weather, forecast or join file from its Parquet mirror, if any, or from the csv file (see module 'storage')"""
+    return storage.load(file, dt_range=dt_range, mirror=mirror)
+
+
+def join_weather_and_forecast(actual_values_df: pd.DataFrame, forecast_df: pd.DataFrame) -> pd.DataFrame:
     """
     Joins the records from weather.csv (actual_values_df) and forecast.csv (forecast_df) by the field dt, effectively
-    matching the actual values of the weather variables with the forecast done over the 5 previous days.
+    matching the actual values of all the weather variables with the forecast done over the 5 previous days.
     If the forecast of any of the 5 previous days is not available, the entire record is discarded
 
-    Return a dict mapping each weather variable to its corresponding join
+    The result is a wide table with the actual value and the 5 forecasts of every weather variable. Empty values are kept
+    as they only affect the corresponding weather variable (see function 'weather_variable_join')
 
     actual_values_df
     -----------------
@@ -82,6 +129,79 @@ def join_actual_values_and_forecast(actual_values_df, forecast_df) -> Dict[str,
     result
     ------
 
+       dt   today       temp  temp_t5  temp_t4  temp_t3  temp_t2  temp_t1  pressure  pressure_t5  ....
+    0  100  2019-11-30  0.5   4.0      1.5      2.0      3.0      1.0      1010      992
+    1  200  2019-11-30  0.6   1.0      4.0      2.0      3.0      5.0      999       1000
+
+    """
+
+    # weather variables missing from any of the dataframes are not part of the join
+    weather_variables = [weather_variable for weather_variable in config.weather_variables.values()
+                         if weather_variable in actual_values_df and weather_variable in forecast_df]
+
+    # only the dts with exactly 5 forecasts take part in the join
+    forecast_df = forecast_df[forecast_df.groupby('dt')['dt'].transform('size') == len(TX_HEADERS)]
+    if forecast_df.empty or not weather_variables:
+        return pd.DataFrame()
+
+    # rank of each forecast among the forecasts of the same dt: the oldest one (rank 0) is t5 and the most recent one is t1
+    #
+    #       temp     pressure     ....    dt      today        rank
+    # 0     4.0      992                  100     2019-11-25   0
+    # 1     1.5      990                  100     2019-11-26   1
+    # ....
+    #
+    forecast_df = forecast_df.sort_values(['dt', 'today'], kind='stable')
+    forecast_df = forecast_df.assign(rank=forecast_df.groupby('dt').cumcount())
+
+    # all weather variables are transposed at once
+    #
+    #       temp_t5  temp_t4  temp_t3  temp_t2  temp_t1  pressure_t5  ....
+    # dt
+    # 100   4.0      1.5      2.0      3.0      1.0      992
+    # 200   1.0      4.0      2.0      3.0      5.0      1000
+    #
+    tees_df = forecast_df.set_index(['dt', 'rank'])[weather_variables].unstack('rank')
+    tees_df.columns = [f"{weather_variable}_{TX_HEADERS[rank]}" for weather_variable, rank in tees_df.columns]
+
+    joined_df = actual_values_df[['dt', 'today'] + weather_variables].merge(tees_df, how='inner', left_on='dt', right_index=True)
+    if joined_df.empty:
+        return pd.DataFrame()
+    columns = ['dt', 'today'] + [column for weather_variable in weather_variables for column in weather_variable_columns(weather_variable)]
+    return joined_df[columns].reset_index(drop=True)
+
+
+def weather_variable_columns(weather_variable: str) -> List[str]:
+    """Columns of the wide join table corresponding to the given weather variable"""
+    return [weather_variable] + [f"{weather_variable}_{tx}" for tx in TX_HEADERS]
+
+
+def weather_variable_join(join_df: pd.DataFrame, weather_variable: str) -> pd.DataFrame:
+    """
+    Derive the join of a single weather variable from the wide join table (see function 'join_weather_and_forecast')
+
+    Records with any empty value are discarded
+
+    result
+    ------
+
+       temp   dt       today   t5   t4   t3   t2   t1
+    0   0.5  100  2019-11-30  4.0  1.5  2.0  3.0  1.0
+    1   0.6  200  2019-11-30  1.0  4.0  2.0  3.0  5.0
+
+    An empty DataFrame is returned if the weather variable is not present in the wide join table
+    """
+    if weather_variable not in join_df:
+        return pd.DataFrame()
+    tees_columns = {f"{weather_variable}_{tx}": tx for tx in TX_HEADERS}
+    view_df = join_df[[weather_variable, 'dt', 'today'] + list(tees_columns)].rename(columns=tees_columns)
+    return view_df.dropna().reset_index(drop=True)
+
+
+def join_actual_values_and_forecast(actual_values_df: pd.DataFrame, forecast_df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    Return a dict mapping each weather variable to its corresponding join
+
        temp   dt       today   t5   t4   t3   t2   t1
     0   0.5  100  2019-11-30  4.0  1.5  2.0  3.0  1.0
     1   0.6  200  2019-11-30  1.0  4.0  2.0  3.0  5.0
@@ -93,140 +213,749 @@ def join_actual_values_and_forecast(actual_values_df, forecast_df) -> Dict[str,
 
     .....
 
+    See functions 'join_weather_and_forecast' and 'weather_variable_join' for more details.
     """
+    join_df = join_weather_and_forecast(actual_values_df, forecast_df)
+    return {weather_variable: weather_variable_join(join_df, weather_variable) for weather_variable in config.weather_variables.values()}
 
-    headers = ['t5', 't4', 't3', 't2', 't1']
-    # initializing dataframes
-    dfs_dict = {weather_variable: pd.DataFrame() for _, weather_variable in config.weather_variables.items()}
 
-    for row in actual_values_df.iterrows():
-        try:
-            # 1st row (dt=100)
-            # -----------------
-            #               0           1           2           3           4
-            # temp          4.0         1.5         2.0         3.0         1.0
-            # pressure      991         990         1002        1020        1000
-            # ....
-            # dt            100         100         100         100         100
-            # today         2019-11-25  2019-11-26  2019-11-27  2019-11-28  2019-11-29
-            #
-            transposed_forecast_df = forecast_df[forecast_df['dt'] == row[1]['dt']].sort_values('today').T
-            if transposed_forecast_df.shape[1] == len(headers):
-                for weather_variable, df in dfs_dict.items():
-
-                    # weather_variable = temp
-                    # ------------------------
-                    #
-                    #       t5  t4  t3  t2  t1
-                    # 0     4.0 1.5 2.0 3.0 1.0
-                    #
-                    tees_df = pd.DataFrame({i: [j] for i, j in zip(headers, transposed_forecast_df.loc[weather_variable])}, index=[row[0]])
-
-                    # weather_variable = temp
-                    # ------------------------
-                    #     temp  dt   today
-                    # 0   0.5   100  2019-11-30
-                    #
-                    weather_variable_df = pd.DataFrame({weather_variable: [row[1][weather_variable]], 'dt': [
-                                                       row[1]['dt']], 'today': [row[1]['today']]}, index=[row[0]])
-
-                    # weather_variable = temp
-                    # ------------------------
-                    #     temp  dt   today      t5  t4  t3  t2  t1
-                    # 0   0.5   100  2019-11-30 4.0 1.5 2.0 3.0 1.0
-                    #
-                    joined_df = weather_variable_df.join(tees_df)
-                    # discarding row if there is any empty value
-                    joined_df.dropna(inplace=True)
-                    dfs_dict[weather_variable] = pd.concat([df, joined_df], ignore_index=True)
-            # else:
-            #     logger.warning(f"number of {weather_variable} {len(temps)} != 5 for timestamp {row[1]['dt']}")
-        except Exception:
-            logger.error("Error while processing row \n %s", row[1], exc_info=True)
-
-    return dfs_dict
+def forecast_precision(joined_data: pd.DataFrame, weather_variable: str):
+    """Calculate mae, rmse, medae and mase of each tx forecast (see function 'metrics.forecast_metrics')
+    """
+    return forecast_metrics(joined_data[weather_variable].to_numpy(), joined_data[TX_HEADERS].to_numpy(), joined_data['dt'].to_numpy())
 
 
-def forecast_precision(joined_data: pd.DataFrame, weather_variable: str):
-    return {
-        "mae": [mae(joined_data[weather_variable], joined_data[f't{i}']) for i in range(5, 0, -1)],
-        "rmse": [sqrt(mse(joined_data[weather_variable], joined_data[f't{i}'])) for i in range(5, 0, -1)],
-        "medae": [medae(joined_data[weather_variable], joined_data[f't{i}']) for i in range(5, 0, -1)],
-        "mase": masetx(joined_data, weather_variable)
-    }
+def rolling_precision(joined_data: pd.DataFrame, weather_variable: str, windows: List[int]) -> pd.DataFrame:
+    """Calculate mae, rmse and mase of each tx forecast over rolling windows ending at each dt
+    (see function 'metrics.rolling_forecast_metrics')
+
+    Args:
+        joined_data (pd.DataFrame): join of the weather variable
+        weather_variable (str): name of the weather variable
+        windows (List[int]): length in days of the windows
 
+    Returns:
+        pd.DataFrame: time series of the metrics of each window, one row per dt and window
 
-def select_intervals(join_data_df: pd.DataFrame, segments: List[Tuple[int, int]]) -> pd.DataFrame:
-    """Filter in rows of 'join_data_df' contained in the given segments
+           dt          window  count  mae_t5  ....  mae_t1  rmse_t5  ....  rmse_t1  mase_t5  ....  mase_t1
+        0  1575072000  7       1      1.5           0.5     1.5            0.5      NaN            NaN
+        1  1575082800  7       2      1.2           0.6     1.3            0.7      NaN            NaN
+        ....
     """
-    for interval in segments:
-        join_data_df = join_data_df.iloc[interval[0]:interval[1]]
-    return join_data_df
+    joined_data = joined_data.sort_values('dt', kind='stable')
+    rolling_dfs = []
+    for window in windows:
+        metrics = rolling_forecast_metrics(joined_data[weather_variable].to_numpy(), joined_data[TX_HEADERS].to_numpy(), joined_data['dt'].to_numpy(), window)
+        rolling_dfs.append(pd.DataFrame({'dt': joined_data['dt'].to_numpy(), 'window': window, 'count': metrics['count'],
+                                         **{f"{metric}_{tx}": metrics[metric][:, j] for metric in ['mae', 'rmse', 'mase'] for j, tx in enumerate(TX_HEADERS)}}))
+    return pd.concat(rolling_dfs, ignore_index=True)
 
 
-def analyse_city_data(city_name: str, segments: List[Tuple[int, int]] = []) -> None:
+def forecast_precision_by_group(joined_data: pd.DataFrame, weather_variable: str, by) -> pd.DataFrame:
+    """Calculate mae, rmse, medae and mase of each tx forecast for each group of data points
+
+    All groups and tx forecasts are calculated in one go by grouping the errors of every data point and tx forecast.
+    The prior period of each data point (mase) is looked for in the whole join, not only in its group.
+
+    Args:
+        joined_data (pd.DataFrame): join of the weather variable
+        weather_variable (str): name of the weather variable
+        by: either the name of a predefined grouping (see GROUPINGS: 'hour', 'month', 'season' or 'year') or an array
+        with the group of each data point
+
+    Returns:
+        pd.DataFrame: metrics of each group, one row per group and tx forecast
+
+           hour  tx  mae   rmse  medae  mase
+        0  0     t5  1.2   1.5   1.0    0.9
+        1  0     t4  1.1   1.4   0.9    0.8
+        ....
+        5  3     t5  1.3   1.6   1.1    0.9
+        ....
+    """
+    real_data = joined_data[weather_variable].to_numpy(dtype=np.float64)
+    dts = joined_data['dt'].to_numpy()
+    errors = np.abs(real_data[:, np.newaxis] - joined_data[TX_HEADERS].to_numpy(dtype=np.float64))
+    scaled_errors, naive_errors = naive_forecast_errors(real_data, errors, dts)
+
+    if isinstance(by, str):
+        group_name = by
+        groups = GROUPINGS[by](pd.to_datetime(joined_data['dt'], unit='s', utc=True)).to_numpy()
+    else:
+        group_name = 'group'
+        groups = np.asarray(by)
+
+    # one row per data point and tx forecast
+    terms_df = pd.DataFrame({group_name: np.repeat(groups, len(TX_HEADERS)),
+                             'tx': pd.Categorical(np.tile(TX_HEADERS, len(real_data)), categories=TX_HEADERS, ordered=True),
+                             'abs_error': errors.ravel(), 'squared_error': (errors ** 2).ravel(),
+                             'scaled_error': scaled_errors.ravel(), 'naive_error': naive_errors.ravel()})
+    metrics_df = terms_df.groupby([group_name, 'tx'], observed=True).agg(
+        mae=('abs_error', 'mean'), rmse=('squared_error', 'mean'), medae=('abs_error', 'median'),
+        scaled_error=('scaled_error', 'sum'), naive_error=('naive_error', 'sum')).reset_index()
+    metrics_df['rmse'] = np.sqrt(metrics_df['rmse'])
+    metrics_df['mase'] = (metrics_df['scaled_error'] / metrics_df['naive_error']).where(metrics_df['naive_error'] != 0)
+    metrics_df['tx'] = metrics_df['tx'].astype(str)
+    return metrics_df.drop(columns=['scaled_error', 'naive_error'])
+
+
+def segment_mask(join_data_df: pd.DataFrame, segment: Tuple) -> np.ndarray:
+    """Boolean mask of the rows of 'join_data_df' contained in the given segment
+
+    A segment is either a range of rows (start, end), which works like 'iloc[start:end]', or a range of datetimes
+    (start, end) given as ISO strings, both ends included (e.g. the intervals returned by 'data_explorer.data_point_gaps',
+    whose row positions are converted to row segments by 'gap_free_segments')
+    """
+    start, end = segment
+    if isinstance(start, str) and isinstance(end, str):
+        dts = join_data_df['dt'].to_numpy()
+        return (dts >= util.iso_to_timestamp(start)) & (dts <= util.iso_to_timestamp(end))
+    mask = np.zeros(len(join_data_df), dtype=bool)
+    mask[start:end] = True
+    return mask
+
+
+def gap_free_segments(intervals: List[Tuple[int, str, int, str]]) -> List[Tuple[int, int]]:
+    """Row segments of the gap-free intervals returned by 'data_explorer.data_point_gaps'
+
+    The last row of those intervals is included, whereas the end of a row segment is not (see 'segment_mask')
+    """
+    return [(first_row, last_row + 1) for first_row, _, last_row, _ in intervals]
+
+
+def select_intervals(join_data_df: pd.DataFrame, segments: List[Tuple]) -> pd.DataFrame:
+    """Filter in rows of 'join_data_df' contained in any of the given segments (see function 'segment_mask')
+    """
+    if not segments:
+        return join_data_df
+    mask = np.logical_or.reduce([segment_mask(join_data_df, segment) for segment in segments])
+    return join_data_df[mask]
+
+
+def segment_precision(joined_data: pd.DataFrame, weather_variable: str, segments: List[Tuple]) -> pd.DataFrame:
+    """Calculate mae, rmse, medae and mase of each tx forecast for each segment and for the union of all of them
+
+    The errors of the whole join are calculated once and then reduced for each segment, instead of filtering the join
+    and recalculating the metrics for every segment. As in 'forecast_precision_by_group', the prior period of each
+    data point (mase) is looked for in the whole join.
+
+    Args:
+        joined_data (pd.DataFrame): join of the weather variable
+        weather_variable (str): name of the weather variable
+        segments (List[Tuple]): ranges of rows or datetimes (see function 'segment_mask')
+
+    Returns:
+        pd.DataFrame: metrics of each segment, one row per segment and tx forecast. Empty segments are left out
+
+           segment                 count  tx  mae   rmse  medae  mase
+        0  0:100                   100    t5  1.2   1.5   1.0    0.9
+        ....
+        5  2020-01-01T00:00:00...  80     t5  1.3   1.6   1.1    0.9
+        ....
+        10 union                   180    t5  1.2   1.5   1.0    0.9
+        ....
+    """
+    real_data = joined_data[weather_variable].to_numpy(dtype=np.float64)
+    dts = joined_data['dt'].to_numpy()
+    errors = np.abs(real_data[:, np.newaxis] - joined_data[TX_HEADERS].to_numpy(dtype=np.float64))
+    scaled_errors, naive_errors = naive_forecast_errors(real_data, errors, dts)
+
+    masks = {f"{start}:{end}": segment_mask(joined_data, (start, end)) for start, end in segments}
+    masks['union'] = np.logical_or.reduce(list(masks.values())) if segments else np.ones(len(joined_data), dtype=bool)
+    segment_dfs = []
+    for label, mask in masks.items():
+        count = int(mask.sum())
+        if count == 0:
+            logger.warning("Segment %s of %s has no data points", label, weather_variable)
+            continue
+        naive_error = naive_errors[mask].sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mase = np.where(naive_error != 0, scaled_errors[mask].sum(axis=0) / naive_error, np.nan)
+        segment_dfs.append(pd.DataFrame({'segment': label, 'count': count, 'tx': TX_HEADERS,
+                                         'mae': errors[mask].mean(axis=0), 'rmse': np.sqrt((errors[mask] ** 2).mean(axis=0)),
+                                         'medae': np.median(errors[mask], axis=0), 'mase': mase}))
+    if not segment_dfs:
+        return pd.DataFrame(columns=['segment', 'count', 'tx', 'mae', 'rmse', 'medae', 'mase'])
+    return pd.concat(segment_dfs, ignore_index=True)
+
+
+def read_watermark(city_name: str) -> Optional[int]:
+    """Return the last dt joined for the given city
+
+    None is returned if the city has never been analysed in incremental mode
+    """
+    watermark_file = util.csv_file_path(config.csv_folder, "watermark", city_name)
+    if not os.path.exists(watermark_file):
+        return None
+    return int(pd.read_csv(watermark_file, dtype={'dt': 'int64'})['dt'].iloc[0])
+
+
+def write_watermark(city_name: str, watermark: int) -> None:
+    watermark_file = util.csv_file_path(config.csv_folder, "watermark", city_name)
+    pd.DataFrame({'dt': [watermark]}).to_csv(watermark_file, index=False)
+
+
+def remove_watermark(city_name: str) -> None:
+    """Remove the watermark and the metrics state of the city (see 'update_city_metrics')
+
+    Called before the join file is rewritten by a non-incremental run, so that the next incremental run builds it from
+    scratch instead of appending rows that are already in it
+    """
+    for file in [util.csv_file_path(config.csv_folder, "watermark", city_name), analysis_state_file_path(city_name)]:
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def settled_actual_values(actual_values_df: pd.DataFrame, forecast_df: pd.DataFrame) -> pd.DataFrame:
+    """Filter in the weather records whose forecasts cannot change anymore
+
+    Forecasts are only made for future dts, therefore once the forecast spider has run on a date later than the date of
+    a weather record, no more forecasts will be recorded for it: either the record has already got its 5 forecasts or it
+    will never get them
+    """
+    return actual_values_df[actual_values_df['today'] < forecast_df['today'].max()]
+
+
+def join_columns() -> List[str]:
+    return ['dt', 'today'] + [column for weather_variable in config.weather_variables.values() for column in weather_variable_columns(weather_variable)]
+
+
+def write_join(join_df: pd.DataFrame, join_file: str) -> None:
+    if join_df.empty:
+        # header is written anyway so that the file can be read and appended to
+        join_df = pd.DataFrame(columns=join_columns())
+    join_df.to_csv(join_file, index=False)
+
+
+def stream_join(weather_file: str, forecast_file: str, block_size: int) -> Iterator[pd.DataFrame]:
+    """Join the weather and forecast files chunk by chunk (see function 'join_weather_and_forecast')
+
+    Both files are read in chunks of about 'block_size' bytes. The weather records are expected in dt order and the
+    forecasts in the order in which they were recorded ('today'), as written by the spiders.
+    Forecasts are only made for future dts (see 'settled_actual_values'), so once a forecast recorded after the last
+    weather record of a chunk has been read, all the forecasts of the chunk have been read too. The forecasts of later
+    dts are kept for the next chunks, the rest are discarded.
+
+    Yields:
+        pd.DataFrame: wide join of each chunk of the weather file, in the same order as 'join_weather_and_forecast'
+    """
+    forecast_chunks = storage.iter_csv(forecast_file, block_size)
+    pending_forecast_dfs = []
+    last_today = None
+    for actual_values_df in storage.iter_csv(weather_file, block_size):
+        if actual_values_df.empty:
+            continue
+        while last_today is None or last_today <= actual_values_df['today'].max():
+            forecast_chunk_df = next(forecast_chunks, None)
+            if forecast_chunk_df is None:
+                break
+            pending_forecast_dfs.append(forecast_chunk_df)
+            if not forecast_chunk_df.empty:
+                last_today = forecast_chunk_df['today'].max()
+
+        forecast_df = pd.concat(pending_forecast_dfs, ignore_index=True)
+        settled = forecast_df['dt'] <= actual_values_df['dt'].max()
+        pending_forecast_dfs = [forecast_df[~settled]]
+        join_df = join_weather_and_forecast(actual_values_df, forecast_df[settled])
+        if not join_df.empty:
+            yield join_df
+
+
+def join_city_data(city_name: str, weather_file: str, forecast_file: str, join_file: str, incremental: bool) -> Tuple[pd.DataFrame, Optional[int]]:
+    """Join the weather and forecast files of the city and write the result to its join file (see 'analyse_city_data')
+
+    In incremental mode, only the weather records and forecasts after the watermark are loaded: forecasts are made for
+    future dts, so the forecasts of those records are after the watermark too, and so are the latest forecasts, which
+    tell which records are settled (see 'settled_actual_values'). The files are mirrored (see 'storage.load'), so that
+    only the partitions of the latest years are read.
+
+    Returns:
+        Tuple[pd.DataFrame, Optional[int]]: the rows written to the join file and the watermark after which they were
+        appended, None if the join file was written from scratch (the rows are then the whole join of the city)
+    """
+    watermark = read_watermark(city_name) if incremental and os.path.exists(join_file) else None
+    dt_range = None if watermark is None else (watermark + 1, None)
+    actual_values_df = load_data(weather_file, dt_range, mirror=incremental)
+    forecast_df = load_data(forecast_file, dt_range, mirror=incremental)
+    if incremental:
+        actual_values_df = settled_actual_values(actual_values_df, forecast_df)
+
+    join_df = join_weather_and_forecast(actual_values_df, forecast_df)
+    if watermark is not None:
+        if not join_df.empty:
+            join_df.to_csv(join_file, mode='a', header=False, index=False)
+    else:
+        if not incremental:
+            remove_watermark(city_name)
+        write_join(join_df, join_file)
+
+    if incremental and not actual_values_df.empty:
+        write_watermark(city_name, actual_values_df['dt'].max())
+    return join_df, watermark
+
+
+def analysis_state_file_path(city_name: str) -> str:
+    return f"{config.csv_folder}/analysis_state_{city_name}.json"
+
+
+def read_analysis_state(city_name: str) -> Optional[dict]:
+    state_file = analysis_state_file_path(city_name)
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_analysis_state(city_name: str, state: dict) -> None:
+    with open(analysis_state_file_path(city_name), 'w', encoding="utf-8") as file:
+        json.dump(state, file)
+
+
+def history_seconds() -> int:
+    """Length of the join before a data point that its metrics depend on: the longest rolling window plus the longest
+    prior period of mase (5 days)"""
+    step_3hours = 3 * 60 * 60
+    return max(config.rolling_windows, default=0) * 24 * 60 * 60 + 5 * config.day_factor * step_3hours
+
+
+def breakdown_precision(accumulator: GroupedMetricsAccumulator, group_name: str) -> pd.DataFrame:
+    """Metrics of each group of the accumulator, with the same format as the result of 'forecast_precision_by_group'"""
+    return pd.DataFrame([{group_name: group, 'tx': tx, **{metric: values[j] for metric, values in metrics.items()}}
+                         for group, metrics in accumulator.finalize().items() for j, tx in enumerate(TX_HEADERS)],
+                        columns=[group_name, 'tx', 'mae', 'rmse', 'medae', 'mase'])
+
+
+def update_city_metrics(city_name: str, join_df: pd.DataFrame, watermark: Optional[int], join_file: str,
+                        export_variable_joins: bool = False) -> List[str]:
+    """Update the metrics files of the city with the rows appended to its join file in incremental mode
+
+    The metrics and their breakdowns are accumulated (see 'metrics.ForecastMetricsAccumulator' and
+    'metrics.GroupedMetricsAccumulator'), and the accumulators are persisted together with the watermark in the file
+    analysis_state_{city}.json, so that only the new rows are added to them. The rolling metrics of the new dts are
+    calculated from the end of the join file that their windows span (see 'history_seconds') and appended to the
+    rolling metrics files. medae is estimated.
+
+    If the state does not match the watermark after which the rows were appended (e.g. the join file was built before
+    the state was kept or the last update failed), the metrics are calculated again from the whole join file.
+
+    Args:
+        join_df (pd.DataFrame): rows appended to the join file (see 'join_city_data')
+        watermark (Optional[int]): watermark after which the rows were appended, None if the join file was written from
+        scratch
+
+    Returns:
+        List[str]: errors of the weather variables that could not be processed (see 'analyse_city_data')
+    """
+    state = read_analysis_state(city_name)
+    if watermark is not None and (state is None or state['watermark'] != watermark):
+        logger.info("Metrics of %s out of date, calculating them from its join file", city_name)
+        join_df = load_data(join_file, mirror=True)
+        watermark = None
+    if watermark is None:
+        state = {'metrics': {}, 'breakdowns': {}}
+        history_df = join_df
+    elif join_df.empty:
+        # nothing new to add
+        history_df = join_df.reindex(columns=join_columns())
+    else:
+        history_df = load_data(join_file, dt_range=(watermark + 1 - history_seconds(), None), mirror=True)
+
+    errors = []
+    for weather_variable in config.weather_variables.values():
+        try:
+            os.makedirs(f"{config.csv_folder}/{weather_variable}", exist_ok=True)
+            metrics_file = util.csv_file_path(config.csv_folder, "metrics", city_name, weather_variable)
+            rolling_metrics_file = util.csv_file_path(config.csv_folder, "rolling_metrics", city_name, weather_variable)
+            # the rows are written from scratch or appended
+            write_mode = {'mode': 'w' if watermark is None else 'a', 'header': watermark is None, 'index': False}
+
+            history_variable_df = weather_variable_join(history_df, weather_variable).sort_values('dt', kind='stable')
+            new_rows = history_variable_df['dt'].to_numpy() > (watermark if watermark is not None else np.iinfo(np.int64).min)
+            new_df = history_variable_df[new_rows]
+            accumulator = ForecastMetricsAccumulator.from_dict(state['metrics'][weather_variable]) \
+                if weather_variable in state['metrics'] else ForecastMetricsAccumulator()
+            breakdowns = {grouping: GroupedMetricsAccumulator.from_dict(state['breakdowns'][weather_variable][grouping])
+                          if grouping in state['breakdowns'].get(weather_variable, {}) else GroupedMetricsAccumulator()
+                          for grouping in config.metric_breakdowns}
+
+            if not new_df.empty:
+                if export_variable_joins:
+                    new_df.to_csv(util.csv_file_path(config.csv_folder, "join", city_name, weather_variable), **write_mode)
+                accumulator.update(new_df[weather_variable], new_df[TX_HEADERS], new_df['dt'])
+                rolling_df = rolling_precision(history_variable_df, weather_variable, config.rolling_windows)
+                rolling_df[rolling_df['dt'].isin(new_df['dt'])].to_csv(rolling_metrics_file, **write_mode)
+
+                real_data = history_variable_df[weather_variable].to_numpy(dtype=np.float64)
+                abs_errors = np.abs(real_data[:, np.newaxis] - history_variable_df[TX_HEADERS].to_numpy(dtype=np.float64))
+                scaled_errors, naive_errors = naive_forecast_errors(real_data, abs_errors, history_variable_df['dt'].to_numpy())
+                datetimes = pd.to_datetime(new_df['dt'], unit='s', utc=True)
+                for grouping, breakdown in breakdowns.items():
+                    breakdown.update(GROUPINGS[grouping](datetimes).to_numpy(), abs_errors[new_rows], scaled_errors[new_rows], naive_errors[new_rows])
+
+            pd.DataFrame(accumulator.finalize()).to_csv(metrics_file, index=False)
+            for grouping, breakdown in breakdowns.items():
+                breakdown_file = util.csv_file_path(config.csv_folder, f"metrics_{grouping}", city_name, weather_variable)
+                breakdown_precision(breakdown, grouping).to_csv(breakdown_file, index=False)
+            state['metrics'][weather_variable] = accumulator.to_dict()
+            state['breakdowns'][weather_variable] = {grouping: breakdown.to_dict() for grouping, breakdown in breakdowns.items()}
+        except Exception as ex:
+            logger.error("Error while processing %s for %s", weather_variable, city_name, exc_info=True)
+            errors.append(f"{weather_variable}: {ex!r}")
+
+    if errors:
+        # the metrics are calculated again by the next run
+        if os.path.exists(analysis_state_file_path(city_name)):
+            os.remove(analysis_state_file_path(city_name))
+    else:
+        state['watermark'] = read_watermark(city_name)
+        write_analysis_state(city_name, state)
+    return errors
+
+
+def analyse_city_data(city_name: str, segments: List[Tuple] = [], incremental: bool = False,
+                      export_variable_joins: bool = False, prejoined: bool = False) -> List[str]:
     # disable pylint warning as 'segments' is never mutated
     # pylint: disable=dangerous-default-value
     """Calculate metrics corresponding to the given city in the specified segments
 
-    Two file types are generated for each weather variable: join_{city}.csv and
-    metrics_{city}.csv.
+    The join of each weather measurement with its 5 forecasts is stored in the file join_{city}.csv, which contains the
+    values of all the weather variables. See function 'join_weather_and_forecast' for more details.
+
+    metrics_{city}.csv files contain the values of the different metrics for each tx forecast of a weather variable.
+    First row is t5, second row t4 and so on up to the fifth row that is t1.
+    rolling_metrics_{city}.csv files contain the time series of the metrics over the windows defined in 'config.rolling_windows'
+    (see function 'rolling_precision').
+    metrics_{grouping}_{city}.csv files contain the metrics broken down by each of the groupings defined in
+    'config.metric_breakdowns' (see function 'forecast_precision_by_group').
+    When segments are given, the metrics are calculated over the rows contained in any of them and the
+    metrics_segments_{city}.csv files contain the metrics of each segment and of their union (see 'segment_precision').
     The files are stored in folders named after the corresponding weather variable.
 
-    join* files contain the result of joining each weather measurement with its 5
-    forecasts. See function 'join_actual_values_and_forecast' for more details.
+    Optionally, the join of each weather variable can be exported too (see function 'weather_variable_join'). Those files
+    are named join_{city}.csv as well and are stored in the folders of the weather variables.
 
-    metrics* files contain the values of the different metrics for each tx forecast.
-    First row is t5, second row t4 and so on up to the fifth row that is t1.
+    In incremental mode, only the weather measurements recorded after the watermark of the city are loaded and joined,
+    and only once their forecasts are settled (see 'join_city_data'). The result is appended to the existing join file,
+    the metrics are updated with the appended rows (see 'update_city_metrics') and the watermark is moved forward.
+    If there is no watermark, the join file is built from scratch. Non-incremental runs, which rewrite the join file,
+    remove the watermark (see 'remove_watermark').
+    Incremental mode is not compatible with 'segments'.
+
+    In prejoined mode, the join written by the spiders (prejoin_{city}.csv, see 'common.complete_joins') is read instead
+    of joining the weather and forecast files, and the join file is not written. Prejoined mode is not compatible with
+    incremental mode.
 
+    Errors are logged and returned so that the caller can report them: the processing of a weather variable carries on
+    even if another one fails.
 
     """
+    if incremental and segments:
+        raise ValueError("segments cannot be used in incremental mode")
+    if incremental and prejoined:
+        raise ValueError("incremental mode cannot be used in prejoined mode")
+
+    errors = []
     try:
         # file pointers
         weather_file = util.csv_file_path(config.csv_folder, config.weather_resources[0], city_name)
         forecast_file = util.csv_file_path(config.csv_folder, config.weather_resources[1], city_name)
+        join_file = util.csv_file_path(config.csv_folder, "join", city_name)
 
-        join_data_dict = join_actual_values_and_forecast(load_data(weather_file), load_data(forecast_file))
+        if prejoined:
+            join_df = load_data(util.csv_file_path(config.csv_folder, config.prejoin_resource, city_name))
+        else:
+            join_df, watermark = join_city_data(city_name, weather_file, forecast_file, join_file, incremental)
+        if incremental:
+            return update_city_metrics(city_name, join_df, watermark, join_file, export_variable_joins)
 
         for _, weather_variable in config.weather_variables.items():
             try:
                 # create folders if they don't exist
-                weather_variable_folder = f"{config.csv_folder}/{weather_variable}"
-                if not os.path.exists(weather_variable_folder):
-                    os.mkdir(weather_variable_folder)
-                
+                # (several cities may be processed concurrently)
+                os.makedirs(f"{config.csv_folder}/{weather_variable}", exist_ok=True)
 
                 # file pointers
-                join_file = util.csv_file_path(config.csv_folder, "join", city_name, weather_variable)
                 metrics_file = util.csv_file_path(config.csv_folder, "metrics", city_name, weather_variable)
+                rolling_metrics_file = util.csv_file_path(config.csv_folder, "rolling_metrics", city_name, weather_variable)
 
-                selected_df = select_intervals(join_data_dict[weather_variable], segments)
-                selected_df.to_csv(join_file, index=False)
+                selected_df = select_intervals(weather_variable_join(join_df, weather_variable), segments)
+                if export_variable_joins:
+                    selected_df.to_csv(util.csv_file_path(config.csv_folder, "join", city_name, weather_variable), index=False)
                 metrics = forecast_precision(selected_df, weather_variable)
                 pd.DataFrame(metrics).to_csv(metrics_file, index=False)
-            except Exception:
+                rolling_precision(selected_df, weather_variable, config.rolling_windows).to_csv(rolling_metrics_file, index=False)
+                for grouping in config.metric_breakdowns:
+                    breakdown_file = util.csv_file_path(config.csv_folder, f"metrics_{grouping}", city_name, weather_variable)
+                    forecast_precision_by_group(selected_df, weather_variable, grouping).to_csv(breakdown_file, index=False)
+                if segments:
+                    write_segment_metrics(join_df, city_name, weather_variable, segments)
+            except Exception as ex:
+                logger.error("Error while processing %s for %s", weather_variable, city_name, exc_info=True)
+                errors.append(f"{weather_variable}: {ex!r}")
+    except Exception as ex:
+        logger.error("Error while processing %s", city_name, exc_info=True)
+        errors.append(repr(ex))
+    return errors
+
+
+def analyse_city_data_streaming(city_name: str, export_variable_joins: bool = False) -> List[str]:
+    """Calculate the metrics of the given city without loading the weather and forecast files in memory
+
+    The files are joined chunk by chunk (see function 'stream_join'), so that the memory used stays around
+    'config.streaming_memory_cap' whatever the size of the files. Each chunk is appended to the join file and added to
+    the accumulators of the metrics (see 'metrics.ForecastMetricsAccumulator').
+
+    The join and metrics files are the same as the ones written by 'analyse_city_data', except for medae, which is
+    estimated. The files of metrics that need the whole join (rolling metrics and breakdowns) are not written, and those
+    left by earlier runs are removed so that they are not taken for current ones.
+
+    Errors are logged and returned as in 'analyse_city_data'.
+    """
+    errors = []
+    try:
+        weather_file = util.csv_file_path(config.csv_folder, config.weather_resources[0], city_name)
+        forecast_file = util.csv_file_path(config.csv_folder, config.weather_resources[1], city_name)
+        join_file = util.csv_file_path(config.csv_folder, "join", city_name)
+        variable_join_files = {weather_variable: util.csv_file_path(config.csv_folder, "join", city_name, weather_variable)
+                               for weather_variable in config.weather_variables.values()}
+        for weather_variable in config.weather_variables.values():
+            os.makedirs(f"{config.csv_folder}/{weather_variable}", exist_ok=True)
+            if export_variable_joins:
+                pd.DataFrame(columns=[weather_variable, 'dt', 'today'] + TX_HEADERS).to_csv(variable_join_files[weather_variable], index=False)
+
+        for weather_variable in config.weather_variables.values():
+            for resource in ["rolling_metrics"] + [f"metrics_{grouping}" for grouping in config.metric_breakdowns]:
+                stale_file = util.csv_file_path(config.csv_folder, resource, city_name, weather_variable)
+                if os.path.exists(stale_file):
+                    os.remove(stale_file)
+
+        remove_watermark(city_name)
+        write_join(pd.DataFrame(), join_file)
+        accumulators = {weather_variable: ForecastMetricsAccumulator() for weather_variable in config.weather_variables.values()}
+        block_size = max(config.streaming_memory_cap // STREAMING_CHUNKS, 2 ** 10)
+        write_options = {'mode': 'a', 'header': False, 'index': False, 'chunksize': max(block_size // CSV_WRITE_ROW_BYTES, 1)}
+        for join_df in stream_join(weather_file, forecast_file, block_size):
+            join_df.reindex(columns=join_columns()).to_csv(join_file, **write_options)
+            for weather_variable, accumulator in accumulators.items():
+                variable_join_df = weather_variable_join(join_df, weather_variable)
+                if variable_join_df.empty:
+                    continue
+                if export_variable_joins:
+                    variable_join_df.to_csv(variable_join_files[weather_variable], **write_options)
+                accumulator.update(variable_join_df[weather_variable], variable_join_df[TX_HEADERS], variable_join_df['dt'])
+
+        for weather_variable, accumulator in accumulators.items():
+            try:
+                metrics_file = util.csv_file_path(config.csv_folder, "metrics", city_name, weather_variable)
+                pd.DataFrame(accumulator.finalize()).to_csv(metrics_file, index=False)
+            except Exception as ex:
+                logger.error("Error while processing %s for %s", weather_variable, city_name, exc_info=True)
+                errors.append(f"{weather_variable}: {ex!r}")
+    except Exception as ex:
+        logger.error("Error while processing %s", city_name, exc_info=True)
+        errors.append(repr(ex))
+    return errors
+
+
+def write_segment_metrics(join_df: pd.DataFrame, city_name: str, weather_variable: str, segments: List[Tuple]) -> None:
+    segments_file = util.csv_file_path(config.csv_folder, "metrics_segments", city_name, weather_variable)
+    segment_precision(weather_variable_join(join_df, weather_variable), weather_variable, segments).to_csv(segments_file, index=False)
+
+
+def analyse_city_segments(city_name: str, segments: List[Tuple]) -> List[str]:
+    """Calculate the metrics of each segment and of their union from the existing join file of the given city
+
+    The join file is read once and is not re-written, so different sets of segments (e.g. the gap-free intervals found
+    by 'data_explorer.data_point_gaps') can be compared without analysing the data again.
+    Only the metrics_segments_{city}.csv files are written.
+
+    Errors are logged and returned as in 'analyse_city_data'.
+    """
+    errors = []
+    try:
+        join_df = load_data(util.csv_file_path(config.csv_folder, "join", city_name))
+        for _, weather_variable in config.weather_variables.items():
+            try:
+                os.makedirs(f"{config.csv_folder}/{weather_variable}", exist_ok=True)
+                write_segment_metrics(join_df, city_name, weather_variable, segments)
+            except Exception as ex:
                 logger.error("Error while processing %s for %s", weather_variable, city_name, exc_info=True)
-    except Exception:
+                errors.append(f"{weather_variable}: {ex!r}")
+    except Exception as ex:
         logger.error("Error while processing %s", city_name, exc_info=True)
+        errors.append(repr(ex))
+    return errors
 
 
-def analyse_data(segments: List[Tuple[int, int]] = []):
+def analyse_segments(segments: List[Tuple]) -> Dict[str, List[str]]:
+    """Compare the metrics of the given segments for all weather variables and cities (see 'analyse_city_segments')
+
+    Returns:
+        dict: errors of each city that could not be processed successfully
+    """
+    errors = {city_name: analyse_city_segments(city_name, segments) for city_name in config.cities}
+    errors = {city_name: city_errors for city_name, city_errors in errors.items() if city_errors}
+    if errors:
+        logger.warning("%d of %d cities processed with errors: %s", len(errors), len(config.cities), ", ".join(errors))
+    return errors
+
+
+def parse_segment_limit(limit: str):
+    """Row positions are given as integers, anything else is taken as an ISO datetime"""
+    try:
+        return int(limit)
+    except ValueError:
+        return limit
+
+
+def init_worker(csv_folder: str, log_level: int) -> None:
+    """Set up the processes of the pool used by 'analyse_data'
+
+    Processes may not inherit the parent's state (e.g. when using the 'spawn' start method), so the csv folder and the
+    logging configuration are set explicitly
+    """
+    config.csv_folder = csv_folder
+    logging.basicConfig(format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT, level=log_level)
+
+
+def code_version() -> str:
+    """Hash of the source code of the modules that determine the output files of the analysis"""
+    digest = hashlib.sha256()
+    for module in CODE_MODULES:
+        with open(os.path.join(os.path.dirname(__file__), f"{module}.py"), 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def cache_file_path(city_name: str) -> str:
+    return f"{config.csv_folder}/analysis_cache_{city_name}.json"
+
+
+def analysis_cache_key(city_name: str, input_resources: List[str], options: dict, version: str) -> Optional[dict]:
+    """Key of the output files of the analysis of the city: size and modification time of its input files, options of
+    the analysis and version of the code
+
+    None is returned if any input file is missing, in which case the analysis is not cached
+    """
+    inputs = {}
+    for resource in input_resources:
+        input_file = util.csv_file_path(config.csv_folder, resource, city_name)
+        if not os.path.exists(input_file):
+            return None
+        inputs[resource] = storage.csv_signature(input_file)
+    # segments are stored as lists in the cache file
+    return json.loads(json.dumps({'inputs': inputs, 'options': options, 'code_version': version}))
+
+
+def is_cached(city_name: str, key: dict) -> bool:
+    """Whether the output files of the city were calculated with the given key and are still there"""
+    cache_file = cache_file_path(city_name)
+    # the join file is not written in prejoined mode
+    output_files = ([] if key['options']['prejoined'] else [util.csv_file_path(config.csv_folder, "join", city_name)]) + \
+        [util.csv_file_path(config.csv_folder, "metrics", city_name, weather_variable) for weather_variable in config.weather_variables.values()]
+    if not os.path.exists(cache_file) or not all(os.path.exists(output_file) for output_file in output_files):
+        return False
+    with open(cache_file, encoding="utf-8") as file:
+        return json.load(file) == key
+
+
+def write_cache(city_name: str, key: dict) -> None:
+    with open(cache_file_path(city_name), 'w', encoding="utf-8") as file:
+        json.dump(key, file)
+
+
+def analyse_data(segments: List[Tuple] = [], incremental: bool = False, workers: int = 1,
+                 export_variable_joins: bool = False, streaming: bool = False, prejoined: bool = False,
+                 force: bool = False) -> Dict[str, List[str]]:
     # disable pylint warning as 'segments' is never mutated
     # pylint: disable=dangerous-default-value
     """Compute metrics for all weather variables and cities
 
+    Cities are independent from each other, so they can be processed in parallel by a pool of processes.
+    Each city writes its own files, therefore the result is the same as when processing the cities one after another.
+
+    Cities whose input files have not changed since they were last analysed with the same options and version of the
+    code are skipped, as their output files would be the same (see function 'analysis_cache_key').
+
     Args:
-        segments (List[Tuple[int, int]], optional): Segments of rows from the join* files to include in the calculations. Defaults to [].
+        segments (List[Tuple], optional): Segments of rows or datetimes from the join* files to include in the calculations
+            (see function 'segment_mask'). Defaults to [].
+        incremental (bool, optional): Join only the data recorded since the last run. Defaults to False.
+        workers (int, optional): Number of processes used to analyse the cities. Defaults to 1 (no parallelism).
+        export_variable_joins (bool, optional): Write the join of each weather variable too. Defaults to False.
+        streaming (bool, optional): Read the files of each city in chunks (see function 'analyse_city_data_streaming').
+            Not compatible with segments nor incremental mode. Defaults to False.
+        prejoined (bool, optional): Use the join files written by the spiders (prejoin_{city}.csv) instead of joining the
+            weather and forecast files (see function 'common.complete_joins'). Not compatible with incremental mode. Defaults to False.
+        force (bool, optional): Analyse all the cities, even those whose output files are up to date. Defaults to False.
+
+    Returns:
+        dict: errors of each city that could not be processed successfully
     """
-    for city_name in config.cities:
-        analyse_city_data(city_name, segments)
+    if incremental and segments:
+        raise ValueError("segments cannot be used in incremental mode")
+    if incremental and prejoined:
+        raise ValueError("incremental mode cannot be used in prejoined mode")
+    if streaming and (incremental or segments or prejoined):
+        raise ValueError("segments, incremental and prejoined modes cannot be used in streaming mode")
+    if streaming:
+        analyse_city, args = analyse_city_data_streaming, (export_variable_joins,)
+    else:
+        analyse_city, args = analyse_city_data, (segments, incremental, export_variable_joins, prejoined)
+
+    input_resources = [config.prejoin_resource] if prejoined else config.weather_resources
+    options = {'segments': segments, 'incremental': incremental, 'export_variable_joins': export_variable_joins,
+               'streaming': streaming, 'prejoined': prejoined}
+    version = code_version()
+    # keys are taken before the analysis, so that input files changed in the meantime are analysed again next time
+    cache_keys = {city_name: analysis_cache_key(city_name, input_resources, options, version) for city_name in config.cities}
+    city_names = [city_name for city_name, key in cache_keys.items() if force or key is None or not is_cached(city_name, key)]
+    logger.info("Analysis cache: %d hits, %d misses%s", len(config.cities) - len(city_names), len(city_names), " (forced)" if force else "")
+
+    if workers > 1 and len(city_names) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(city_names)), initializer=init_worker,
+                                 initargs=(config.csv_folder, logging.getLogger().getEffectiveLevel())) as executor:
+            futures = {city_name: executor.submit(analyse_city, city_name, *args) for city_name in city_names}
+            errors = {}
+            for city_name, future in futures.items():
+                try:
+                    errors[city_name] = future.result()
+                except Exception as ex:
+                    # the worker process died or the arguments were wrong
+                    logger.error("Error while processing %s", city_name, exc_info=True)
+                    errors[city_name] = [repr(ex)]
+    else:
+        errors = {city_name: analyse_city(city_name, *args) for city_name in city_names}
+
+    for city_name, city_errors in errors.items():
+        if not city_errors and cache_keys[city_name] is not None:
+            write_cache(city_name, cache_keys[city_name])
+    errors = {city_name: city_errors for city_name, city_errors in errors.items() if city_errors}
+    if errors:
+        logger.warning("%d of %d cities processed with errors: %s", len(errors), len(config.cities), ", ".join(errors))
+    return errors
 
 
 def main():
-    logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', level='INFO')
+    parser = argparse.ArgumentParser(description="Calculate the metrics of the forecasts of every city and weather variable")
+    parser.add_argument('--incremental', action='store_true', help="join only the data recorded since the last run")
+    parser.add_argument('--workers', type=int, default=1, help="number of cities analysed in parallel")
+    parser.add_argument('--export-variable-joins', action='store_true', help="write the join of each weather variable too")
+    parser.add_argument('--streaming', action='store_true', help="read the files in chunks to bound the memory used (see 'config.streaming_memory_cap')")
+    parser.add_argument('--prejoined', action='store_true', help="use the join files written by the spiders (ROBOCLIMATE_PREJOIN)")
+    parser.add_argument('--force', action='store_true', help="analyse all the cities, even those whose files have not changed")
+    parser.add_argument('--segment', nargs=2, action='append', default=[], metavar=('START', 'END'),
+                        help="compare the metrics of this range of rows or ISO datetimes using the existing join files (can be repeated)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT, level='INFO')
     # analyse_city_data('tokyo')
     # analyse_city_data('madrid', [(2328,2840)])
-    analyse_data()
+    if args.segment:
+        analyse_segments([tuple(parse_segment_limit(limit) for limit in segment) for segment in args.segment])
+    else:
+        analyse_data(incremental=args.incremental, workers=args.workers, export_variable_joins=args.export_variable_joins,
+                     streaming=args.streaming, prejoined=args.prejoined, force=args.force)
     logger.info('END')
 
 
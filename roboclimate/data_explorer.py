@@ -11,32 +11,46 @@ Running some of these functions presume the existence of the 'join*' files gener
 
 """
 
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import datetime as dt
 import pandas as pd
 import roboclimate.config as rconf
 from roboclimate.config import City
 from roboclimate.util import csv_file_path
 import roboclimate.util as rutil
+import roboclimate.data_analysis as rda
+import roboclimate.storage as storage
 
 
-def load_weather_file(city: City):
+def load_weather_file(city: City, dt_range: Optional[Tuple[int, int]] = None):
     weather_file = csv_file_path(rconf.csv_folder, rconf.weather_resources[0], city.name)
-    return pd.read_csv(weather_file, dtype={'dt': 'int64'})
+    return storage.load(weather_file, dt_range=dt_range)
 
 
-def load_forecast_file(city: City):
+def load_forecast_file(city: City, dt_range: Optional[Tuple[int, int]] = None):
     forecast_file = csv_file_path(rconf.csv_folder, rconf.weather_resources[1], city.name)
-    return pd.read_csv(forecast_file, dtype={'dt': 'int64'})
+    return storage.load(forecast_file, dt_range=dt_range)
 
 def load_metrics_file(city: City, weather_variable: str):    
     return pd.read_csv(f"{rconf.csv_folder}/{weather_variable}/metrics_{city.name}.csv")
 
 
+def load_rolling_metrics_file(city: City, weather_variable: str, window: int):
+    rolling_metrics_df = pd.read_csv(csv_file_path(rconf.csv_folder, "rolling_metrics", city.name, weather_variable), dtype={'dt': 'int64'})
+    return rolling_metrics_df[rolling_metrics_df['window'] == window].reset_index(drop=True)
+
+
+def load_join_file(city: City, weather_variable: str) -> pd.DataFrame:
+    """Load the join of the given weather variable from the join file of the city (see 'data_analysis.join_weather_and_forecast')"""
+    join_file = csv_file_path(rconf.csv_folder, "join", city.name)
+    join_df = storage.load(join_file, columns=['dt', 'today'] + rda.weather_variable_columns(weather_variable))
+    return rda.weather_variable_join(join_df, weather_variable)
+
+
 def load_csv_files(city: City, weather_variable: str) -> "dict[str, pd.DataFrame]":
-    actual_value_df = pd.read_csv(csv_file_path(rconf.csv_folder, rconf.weather_resources[0], city.name), usecols=[weather_variable, 'dt', 'today'], dtype={'dt': 'int64'})
-    forecast_value_df = pd.read_csv(csv_file_path(rconf.csv_folder, rconf.weather_resources[1], city.name), usecols=[weather_variable, 'dt', 'today'], dtype={'dt': 'int64'})
-    join_data_df = pd.read_csv(f"{rconf.csv_folder}/{weather_variable}/join_{city.name}.csv", usecols=[weather_variable, 'dt', 'today', 't5', 't4', 't3', 't2', 't1'])
+    actual_value_df = storage.load(csv_file_path(rconf.csv_folder, rconf.weather_resources[0], city.name), columns=[weather_variable, 'dt', 'today'])
+    forecast_value_df = storage.load(csv_file_path(rconf.csv_folder, rconf.weather_resources[1], city.name), columns=[weather_variable, 'dt', 'today'])
+    join_data_df = load_join_file(city, weather_variable)
     metrics_df = pd.read_csv(f"{rconf.csv_folder}/{weather_variable}/metrics_{city.name}.csv")
     return {"true_temp_df": actual_value_df, "forecast_temp_df": forecast_value_df, "join_data_df": join_data_df, "metrics_df": metrics_df}
 
@@ -94,6 +108,8 @@ def missing_forecast_datapoints(city: City, start_dt: dt.datetime = None, end_dt
     """
     start_dt = start_dt if start_dt else city.firstMeasurement
     df = load_forecast_file(city)
+    # 'today' is loaded as a date (see 'config.column_dtypes') whereas 'dts' returns iso strings
+    df['today'] = pd.to_datetime(df['today']).dt.strftime('%Y-%m-%d')
     merged = df.merge(dts(start_dt, end_dt), how='right', on='today', indicator=True)
     return merged[merged['_merge'] == 'right_only'].groupby('today').count().index.values
 
@@ -114,7 +130,8 @@ def data_point_gaps(city: City, weather_variable: str) -> List[Tuple[int, str, i
         list: list of intervals, each interval is represented by a tuple, the values of a tuple t are:
         t[0] --> position of the first row of the interval in the join_data dataframe
         t[1] --> datetime (iso format) of the beginning of the interval
-        t[2] --> position of the last row of the interval in the join_data dataframe
+        t[2] --> position of the last row of the interval in the join_data dataframe (included, unlike the end of the
+        row segments of 'data_analysis', see 'data_analysis.gap_free_segments')
         t[3] --> datetime (iso format) of the end of the interval
     """
     step_3hours = 3 * 60 * 60  # number of seconds in between datapoints
@@ -128,7 +145,9 @@ def data_point_gaps(city: City, weather_variable: str) -> List[Tuple[int, str, i
             interval_left_side = dts[i]
             left_index = i
 
-    intervals.append((left_index, dt.datetime.fromtimestamp(interval_left_side, dt.timezone.utc).isoformat(), i - 1, dt.datetime.fromtimestamp(dts[i - 1], dt.timezone.utc).isoformat()))
+    # the last interval ends at the last row
+    last_index = len(dts) - 1
+    intervals.append((left_index, dt.datetime.fromtimestamp(interval_left_side, dt.timezone.utc).isoformat(), last_index, dt.datetime.fromtimestamp(dts[last_index], dt.timezone.utc).isoformat()))
     return intervals
 
 
@@ -1,5 +1,5 @@
 import os
-from common import logger, run_city, utcnow_date, CITIES
+from common import logger, run_cities, utcnow_date, add_pending_forecasts, invocation_deadline, CITIES
 
 # constants
 WEATHER_RESOURCE = "forecast"
@@ -18,15 +18,18 @@ def forecast_handler(event, context):
         logger.info('running on local env')
 
     run_params = {
+        'deadline': invocation_deadline(context),
         'utcnow_date': utcnow_date(),
         'json_to_csv_f': transform_weather_data_to_csv,
         'csv_files_path': os.environ.get('ROBOCLIMATE_CSV_FILES_PATH'),
         'csv_header': CSV_HEADER,
-        'weather_resource': WEATHER_RESOURCE
+        'weather_resource': WEATHER_RESOURCE,
+        # the join files are maintained by the spiders instead of the 'data_analysis' module
+        'prejoin_f': add_pending_forecasts if os.environ.get('ROBOCLIMATE_PREJOIN') == 'true' else None
     }
-    for city_name, city_id in CITIES.items():
-        run_params['weather_resource_url'] = f"http://api.openweathermap.org/data/2.5/{WEATHER_RESOURCE}?id={city_id}&units=metric&appid={os.environ.get('OPEN_WEATHER_API')}"
-        run_city(city_name, run_params)
+    skipped = run_cities({city_name: {**run_params, 'weather_resource_url': f"http://api.openweathermap.org/data/2.5/{WEATHER_RESOURCE}?id={city_id}&units=metric&appid={os.environ.get('OPEN_WEATHER_API')}"}
+                          for city_name, city_id in CITIES.items()})
+    return {'skipped': skipped}
 
 
 # when running on AWS env, __name__ = file name specified in AWS runtime's handler
@@ -15,23 +15,104 @@ This module contain functions to calculate both seasonal and non-seasonal mase.
 An additional problem to contend with is data quality: if there are missing values in the time series, it may not be
 possible to get the value corresponding to the prior period.
 The implementation of this module rests on the content of the 'join_*.csv' files, therefore any 'hole' in those files 
-will have an impact on the calculation of the mase. The function 'data_explorer.weather_datapoints_without_five_forecasts'
+will have an impact on the calculation of the mase: values are matched with their prior period by timestamp, so the values
+whose prior period falls in a 'hole' are left out of the calculation. The function 'data_explorer.weather_datapoints_without_five_forecasts'
 can be used to identify the 'holes' in 'join_*.csv' files.
 
 """
 
-from datetime import datetime, timezone
-# from sklearn.metrics import mean_absolute_error as mae
+import json
 import numpy as np
-from roboclimate.util import n_years_ago, remove_29_feb
+from roboclimate.climatology import build_climatology, years_average
 import roboclimate.config as rconf
 
 
+def find_positions(dts, targets):
+    """
+    Find the position in 'dts' (not necessarily sorted) of each of the 'targets', -1 if the target is not found
+    """
+    dts = np.asarray(dts, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    if len(dts) == 0:
+        return np.full(len(targets), -1, dtype=np.int64)
+    # join files are sorted by dt, in which case sorting can be skipped
+    order = np.arange(len(dts)) if np.all(dts[1:] >= dts[:-1]) else np.argsort(dts, kind='stable')
+    sorted_dts = dts[order]
+    candidates = np.minimum(np.searchsorted(sorted_dts, targets), len(dts) - 1)
+    return np.where(sorted_dts[candidates] == targets, order[candidates], -1)
+
+
+def prior_period_positions(dts, offset):
+    """
+    Find, for each dt, the position of the dt that is exactly 'offset' seconds earlier
+
+    Parameters
+    ----------
+
+    dts: array
+
+        array of POSIX timestamps (not necessarily sorted)
+
+    offset: int
+
+        number of seconds between a dt and its "prior period"
+
+    Returns
+    -------
+
+    array
+
+        array of the same length as 'dts' with the positions of the "prior period" dts or -1 when there is no such dt
+
+    """
+    dts = np.asarray(dts, dtype=np.int64)
+    return find_positions(dts, dts - offset)
+
+
+def years_ago_positions(dts, n=1):
+    """
+    Find, for each dt, the position of the dt corresponding to the same UTC month, day and time 'n' years earlier
+
+    Dates are shifted by whole months, so that the result does not depend on whether the years in between are leap years.
+    29 February has no counterpart in non-leap years, therefore its dts are never matched.
+
+    Parameters
+    ----------
+
+    dts: array
+
+        array of POSIX timestamps (not necessarily sorted)
+
+    n: int
+
+        number of years between a dt and its "prior period"
+
+    Returns
+    -------
+
+    array
+
+        array of the same length as 'dts' with the positions of the "prior period" dts or -1 when there is no such dt
+
+    """
+    datetimes = np.asarray(dts, dtype=np.int64).astype('datetime64[s]')
+    months = datetimes.astype('datetime64[M]')
+    prior_months = months - np.timedelta64(12 * n, 'M')
+    targets = prior_months.astype('datetime64[s]') + (datetimes - months.astype('datetime64[s]'))
+    # the day does not exist in the prior month (29 February) and the target overflows into the next month
+    overflows = targets.astype('datetime64[M]') != prior_months
+    positions = find_positions(datetimes.astype(np.int64), targets.astype(np.int64))
+    return np.where(overflows, -1, positions)
+
+
 def mean_absolute_scaled_error(real_data, predicted_data, dts, period=1) -> float:
     """
     This function is the basic building block of this module.
     By default this function takes as prior period the previous value in the time series, that is the temperature corresponding to 3 hours ago.
 
+    The prior period of each value is found by timestamp, not by position, so that the gaps in the time series are skipped:
+    values whose prior period is missing are not taken into account.
+
     Parameters
     ----------
 
@@ -43,9 +124,13 @@ def mean_absolute_scaled_error(real_data, predicted_data, dts, period=1) -> floa
 
         data predicted by the model under evaluation
 
+    dts: array
+
+        POSIX timestamps of the actual values
+
     period: int
 
-        relative position in the time series corresponding to the "prior period"
+        number of 3-hour steps between a value and its "prior period"
 
     Returns
     -------
@@ -59,38 +144,20 @@ def mean_absolute_scaled_error(real_data, predicted_data, dts, period=1) -> floa
         elements in the data series), np.nan is returned
 
     """
-    step_3hours = 3 * 60 * 60  # number of seconds in between datapoints
-
-    if len(real_data) <= period:
-        return np.nan
-
-    period_in_seconds = step_3hours * period
-    forecast_zip = zip(real_data[period:], predicted_data[period:])
-    naive_forecast_zip = zip(real_data[period:], real_data[:-period])
-    dt_zip = zip(dts[period:], dts[:-period])
-    mae1 = 0
-    mae2 = 0
-
-    for dt_current, dt_previous in dt_zip:
-        real_value, forecast_value = next(forecast_zip)
-        _, naive_forecast_value = next(naive_forecast_zip)
-        if dt_current - dt_previous == period_in_seconds:
-            mae1 += abs(real_value - forecast_value)
-            mae2 += abs(real_value - naive_forecast_value)
-
-    try:
-        return mae1 / mae2
-    except ZeroDivisionError:
-        return np.nan
-    # return mae(real_data[period:], predicted_data[period:], dts) / mae(real_data[period:], real_data[:-period], dts)
+    real_data = np.asarray(real_data, dtype=np.float64)
+    errors = np.abs(real_data - np.asarray(predicted_data, dtype=np.float64))
+    return _scaled_error(real_data, errors, dts, period)
 
 
 def mean_absolute_scaled_error_1year(joined_data, weather_variable):
     """
-    This function considers as "prior period" the temperature corresponding to 1 year ago, on the same day at the same time.
+    This function considers as "prior period" the temperature corresponding to 1 year ago, on the same day at the same time (UTC).
 
     It calculates the mase for each of the 5 forecast predictions, namely: t1, t2, t3, t4 and t5
 
+    Each value is matched with its prior period by timestamp (see 'years_ago_positions'): values whose prior period is
+    missing, including the ones recorded on 29 February, are not taken into account
+
     Parameters
     ----------
 
@@ -113,12 +180,18 @@ def mean_absolute_scaled_error_1year(joined_data, weather_variable):
         list containing the mase for each tx model: [mase(t5), mase(t4), mase(t3), mase(t2), mase(t1)]
 
         if there is no "prior period" for any of the elements in the series (this may happen if there are no enough
-        elements in the data series), np.nan is returned
+        elements in the data series), np.nan is returned for every model
 
-    TODO: instead of stopping the entire calculation, just discard the offending data point and continue calculation with rest of data
     """
-    joined_data_without_29_feb = remove_29_feb(joined_data)
-    return [mean_absolute_scaled_error(joined_data_without_29_feb[weather_variable], joined_data_without_29_feb[f't{i}'], 365 * rconf.day_factor) for i in range(5, 0, -1)]
+    real_data = joined_data[weather_variable].to_numpy(dtype=np.float64)
+    errors = np.abs(real_data[:, np.newaxis] - joined_data[[f't{i}' for i in range(5, 0, -1)]].to_numpy(dtype=np.float64))
+    prior_positions = years_ago_positions(joined_data['dt'].to_numpy())
+    matches = prior_positions >= 0
+    # the naive forecast is the same for all the models
+    naive_error = np.abs(real_data[matches] - real_data[prior_positions[matches]]).sum()
+    if naive_error == 0:
+        return [np.nan] * 5
+    return (errors[matches].sum(axis=0) / naive_error).tolist()
 
 
 def mean_absolute_scaled_error_year_avg(joined_data, historical_data, weather_variable, years_back=19):
@@ -126,23 +199,49 @@ def mean_absolute_scaled_error_year_avg(joined_data, historical_data, weather_va
     This function considers as "last period" the avg temperature, on the same date at the same time, over the years present in 
     the historical data (currently up to 19 years for London)
 
-    In case the historical data does not contain the data point for any of the datetimes considered, the mae is not calculated
-    and np.nan is returned
+    The naive forecasts of all the data points are gathered at once from the climatology of the historical data
+    (see module 'climatology'). Years missing from the historical data are left out of the average and data points
+    without historical data in any of the years (including the ones recorded on 29 February) are not taken into account
 
-    TODO: instead of stopping the entire calculation, just discard the offending data point and continue calculation with rest of data
-    """
+    Parameters
+    ----------
+
+    joined_data: DataFrame
 
-    def previous_years_avg(dt):
-        date_time = datetime.fromtimestamp(dt, tz=timezone.utc)
-        return np.average([historical_data[weather_variable][n_years_ago(date_time, n)] for n in range(1, years_back + 1)])
+        join of the weather variable (see 'mean_absolute_scaled_error_tx')
 
-    try:
-        joined_data_without_29_feb = remove_29_feb(joined_data)
-        naive_prediction = [previous_years_avg(dt) for dt in joined_data_without_29_feb['dt']]
-        return [mae(joined_data_without_29_feb[weather_variable], joined_data_without_29_feb[f't{i}']) / mae(joined_data_without_29_feb[weather_variable], naive_prediction) for i in range(5, 0, -1)]
-    except KeyError as err:
-        print(f"{err} not found in historical data")
-        return np.nan
+    historical_data: DataFrame or dict
+
+        historical data as returned by 'util.read_historical_data' or its climatology, already built or loaded from
+        disk with 'climatology.load_climatology'
+
+    weather_variable: str
+
+        name of the weather variable
+
+    years_back: int
+
+        number of previous years to average
+
+    Returns
+    -------
+
+    list[float]
+
+        list containing the mase for each tx model: [mase(t5), mase(t4), mase(t3), mase(t2), mase(t1)]
+
+        if there is no historical data for any of the data points, np.nan is returned for every model
+
+    """
+    climatology = historical_data if isinstance(historical_data, dict) else build_climatology(historical_data, weather_variable)
+    naive_prediction = years_average(climatology, joined_data['dt'].to_numpy(), years_back)
+    matches = ~np.isnan(naive_prediction)
+    real_data = joined_data[weather_variable].to_numpy(dtype=np.float64)[matches]
+    predicted_data = joined_data[[f't{i}' for i in range(5, 0, -1)]].to_numpy(dtype=np.float64)[matches]
+    naive_error = np.abs(real_data - naive_prediction[matches]).sum()
+    if naive_error == 0:
+        return [np.nan] * 5
+    return (np.abs(real_data[:, np.newaxis] - predicted_data).sum(axis=0) / naive_error).tolist()
 
 
 def mean_absolute_scaled_error_tx(joined_data, weather_variable) -> 'list[float]':
@@ -152,9 +251,7 @@ def mean_absolute_scaled_error_tx(joined_data, weather_variable) -> 'list[float]
     This function calculates the mase for each of the 5 forecast models: t1, t2, t3, t4 and t5.
     For each model, the natural "prior period" is the number of days of the forecast: 1, 2, 3, 4, 5
 
-    Data quality issues like missing values of the "prior period" are considered negligible since any effect will 
-    be very localised: 'mase(tx)' calculation will be affected only in those cases where there are missing values in the 
-    previous 'x*rconf.day_factor' elements of the time series (in such a case, the wrong datetimes will be compared)
+    Values whose "prior period" is missing (e.g. due to gaps in the time series) are not taken into account
 
     Parameters
     ----------
@@ -180,3 +277,506 @@ def mean_absolute_scaled_error_tx(joined_data, weather_variable) -> 'list[float]
         if a model cannot be calculated becase there are no enough elements in the data series, np.nan is returned for said model   
     """
     return [mean_absolute_scaled_error(joined_data[weather_variable], joined_data[f't{i}'], joined_data['dt'], i * rconf.day_factor) for i in range(5, 0, -1)]
+
+
+def forecast_metrics(real_data, predicted_data, dts) -> 'dict[str, list[float]]':
+    """
+    Calculates all the metrics of the 5 forecast models (t5, t4, t3, t2 and t1) at once.
+
+    The absolute errors of the 5 models are computed as a single matrix that is reduced column-wise to get each metric,
+    instead of calculating each metric and model separately.
+
+    Parameters
+    ----------
+
+    real_data: array
+
+        array of n actual values recorded at 3-hour intervals
+
+    predicted_data: array
+
+        (n, 5) matrix whose columns are the values predicted by the models t5, t4, t3, t2 and t1
+
+    dts: array
+
+        array of n POSIX timestamps corresponding to the actual values
+
+    Returns
+    -------
+
+    dict[str, list[float]]
+
+        dict mapping each metric (mae, rmse, medae and mase) to the list of its values for each model:
+        [metric(t5), metric(t4), metric(t3), metric(t2), metric(t1)]
+
+        mase is calculated as in 'mean_absolute_scaled_error_tx'
+
+    """
+    real_data = np.asarray(real_data, dtype=np.float64)
+    predicted_data = np.asarray(predicted_data, dtype=np.float64)
+    dts = np.asarray(dts)
+    if len(real_data) == 0:
+        raise ValueError("no data points to calculate the metrics")
+
+    errors = np.abs(real_data[:, np.newaxis] - predicted_data)
+    return {
+        "mae": errors.mean(axis=0).tolist(),
+        "rmse": np.sqrt((errors ** 2).mean(axis=0)).tolist(),
+        "medae": np.median(errors, axis=0).tolist(),
+        "mase": [_scaled_error(real_data, errors[:, j], dts, i * rconf.day_factor) for j, i in enumerate(range(5, 0, -1))]
+    }
+
+
+def _scaled_error(real_data, errors, dts, period) -> float:
+    """
+    Implementation of 'mean_absolute_scaled_error' that takes the absolute errors of the model under evaluation
+    """
+    step_3hours = 3 * 60 * 60  # number of seconds in between datapoints
+
+    prior_positions = prior_period_positions(dts, step_3hours * period)
+    matches = prior_positions >= 0
+    mae1 = errors[matches].sum()
+    mae2 = np.abs(real_data[matches] - real_data[prior_positions[matches]]).sum()
+    return mae1 / mae2 if mae2 != 0 else np.nan
+
+
+def naive_forecast_errors(real_data, errors, dts) -> 'tuple[np.ndarray, np.ndarray]':
+    """
+    Terms of the mase of the 5 forecast models (see 'mean_absolute_scaled_error_tx') for each value of the series
+
+    Parameters
+    ----------
+
+    real_data: array
+
+        array of n actual values recorded at 3-hour intervals
+
+    errors: array
+
+        (n, 5) matrix with the absolute errors of the models t5, t4, t3, t2 and t1
+
+    dts: array
+
+        array of n POSIX timestamps corresponding to the actual values
+
+    Returns
+    -------
+
+    tuple[np.ndarray, np.ndarray]
+
+        two (n, 5) matrices with the absolute errors of each model and of its naive forecast respectively, both being 0
+        for the values whose prior period is not known. The mase of any subset of values is the ratio between the sums
+        of the corresponding rows of both matrices
+
+    """
+    step_3hours = 3 * 60 * 60  # number of seconds in between datapoints
+
+    scaled_errors = np.zeros(errors.shape)
+    naive_errors = np.zeros(errors.shape)
+    for j, i in enumerate(range(5, 0, -1)):
+        prior_positions = prior_period_positions(dts, i * rconf.day_factor * step_3hours)
+        matches = prior_positions >= 0
+        scaled_errors[matches, j] = errors[matches, j]
+        naive_errors[matches, j] = np.abs(real_data[matches] - real_data[prior_positions[matches]])
+    return scaled_errors, naive_errors
+
+
+def rolling_forecast_metrics(real_data, predicted_data, dts, window_days) -> 'dict[str, np.ndarray]':
+    """
+    Calculates mae, rmse and mase of the 5 forecast models over a rolling time window ending at each dt
+
+    The window of a dt comprises the values whose dt is in the interval (dt - window_days, dt].
+    Sums of errors are accumulated once over the whole series, so that the metrics of each window are obtained as the
+    difference between the accumulated sums at both ends of the window, in constant time.
+
+    Parameters
+    ----------
+
+    real_data, predicted_data, dts:
+
+        see 'forecast_metrics' (dts must be sorted)
+
+    window_days: int
+
+        length of the window in days
+
+    Returns
+    -------
+
+    dict[str, np.ndarray]
+
+        dict mapping 'count' to the array with the number of values of each window and each metric (mae, rmse and mase)
+        to a (n, 5) matrix whose columns are the values of the models t5, t4, t3, t2 and t1 in each window
+
+        mase is calculated as in 'mean_absolute_scaled_error_tx' with the values of the window (the prior period of a
+        value may fall out of the window)
+
+    """
+    seconds_in_a_day = 24 * 60 * 60
+
+    real_data = np.asarray(real_data, dtype=np.float64)
+    dts = np.asarray(dts, dtype=np.int64)
+    errors = np.abs(real_data[:, np.newaxis] - np.asarray(predicted_data, dtype=np.float64))
+
+    scaled_errors, naive_errors = naive_forecast_errors(real_data, errors, dts)
+
+    def window_sums(values):
+        cumulative_sums = np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+        return cumulative_sums[1:] - cumulative_sums[window_starts]
+
+    window_starts = np.searchsorted(dts, dts - window_days * seconds_in_a_day, side='right')
+    count = np.arange(1, len(dts) + 1) - window_starts
+    naive_sums = window_sums(naive_errors)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mase = np.where(naive_sums != 0, window_sums(scaled_errors) / naive_sums, np.nan)
+    return {
+        "count": count,
+        "mae": window_sums(errors) / count[:, np.newaxis],
+        # accumulated sums are subtracted, therefore rounding errors may result in tiny negative numbers
+        "rmse": np.sqrt(np.maximum(window_sums(errors ** 2) / count[:, np.newaxis], 0)),
+        "mase": mase
+    }
+
+
+class QuantileSketch:
+    """
+    Mergeable sketch to estimate the quantiles of a stream of non-negative values using bounded memory
+
+    Values are counted in buckets whose boundaries grow geometrically (see DDSketch, https://arxiv.org/abs/1908.10693),
+    so that any quantile is estimated with a relative error lower than 'relative_accuracy'.
+    If the number of buckets exceeds 'max_buckets', the lowest buckets are collapsed, thus losing accuracy only in the
+    lowest quantiles.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.zero_count = 0
+        self.buckets = {}
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + sum(self.buckets.values())
+
+    def update(self, values) -> 'QuantileSketch':
+        values = np.asarray(values, dtype=np.float64)
+        zeros = values <= 0
+        self.zero_count += int(zeros.sum())
+        keys, counts = np.unique(np.ceil(np.log(values[~zeros]) / np.log(self.gamma)).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self._collapse()
+        return self
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("sketches with different relative accuracy cannot be merged")
+        self.zero_count += other.zero_count
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self._collapse()
+        return self
+
+    def _collapse(self):
+        if len(self.buckets) > self.max_buckets:
+            keys = sorted(self.buckets)
+            lowest_key = keys[-self.max_buckets]
+            self.buckets[lowest_key] += sum(self.buckets.pop(key) for key in keys[:-self.max_buckets])
+
+    def quantile(self, q) -> float:
+        """
+        Estimation of the q-quantile (0 <= q <= 1) of the values seen so far, np.nan if no value has been seen
+        """
+        count = self.count
+        if count == 0:
+            return np.nan
+        rank = q * (count - 1)
+        cumulative_count = self.zero_count
+        if rank < cumulative_count:
+            return 0.0
+        for key in sorted(self.buckets):
+            cumulative_count += self.buckets[key]
+            if rank < cumulative_count:
+                # middle point of the bucket (gamma^(key-1), gamma^key] in terms of relative error
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self) -> dict:
+        return {'relative_accuracy': self.relative_accuracy, 'max_buckets': self.max_buckets,
+                'zero_count': self.zero_count, 'buckets': [[key, count] for key, count in self.buckets.items()]}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'QuantileSketch':
+        sketch = cls(state['relative_accuracy'], state['max_buckets'])
+        sketch.zero_count = state['zero_count']
+        sketch.buckets = {key: count for key, count in state['buckets']}
+        return sketch
+
+
+class ForecastMetricsAccumulator:
+    """
+    Sufficient statistics to calculate the metrics of the 5 forecast models (t5, t4, t3, t2 and t1) incrementally
+
+    Instead of keeping the whole series in memory, the accumulator keeps, for each model:
+
+        - number of values, sum of absolute errors and sum of squared errors (mae and rmse)
+        - quantile sketch of the absolute errors (medae, see 'QuantileSketch')
+        - sum of the absolute errors of the model and of the naive forecast over the values whose prior period is
+          known (mase, see 'mean_absolute_scaled_error_tx')
+
+    To match values with their prior period across batches, it also keeps the values of the last 5 days ('tail') and,
+    of the first 5 days, those whose prior period may be found in earlier data ('head').
+
+    Accumulators can be updated with new batches of data, merged with the accumulators of other time shards (or
+    calculated by other processes) and saved to disk. A batch or shard must not overlap in time with the data
+    already accumulated.
+
+    Usage
+    -----
+
+        accumulator = ForecastMetricsAccumulator()
+        accumulator.update(real_data, predicted_data, dts)
+        ....
+        accumulator.finalize()  # same result as 'forecast_metrics' (except for medae, which is an estimation)
+
+    """
+
+    step_3hours = 3 * 60 * 60  # number of seconds in between datapoints
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.periods = np.array([i * rconf.day_factor * self.step_3hours for i in range(5, 0, -1)])
+        self.count = 0
+        self.sum_abs_errors = np.zeros(5)
+        self.sum_squared_errors = np.zeros(5)
+        self.sum_scaled_abs_errors = np.zeros(5)
+        self.sum_naive_abs_errors = np.zeros(5)
+        self.sketches = [QuantileSketch(relative_accuracy) for _ in range(5)]
+        self.min_dt = None
+        self.max_dt = None
+        # head: dt, actual value, absolute errors of each model and whether the prior period of each model is pending
+        self.head = (np.empty(0, dtype=np.int64), np.empty(0), np.empty((0, 5)), np.empty((0, 5), dtype=bool))
+        # tail: dt and actual value
+        self.tail = (np.empty(0, dtype=np.int64), np.empty(0))
+
+    def update(self, real_data, predicted_data, dts) -> 'ForecastMetricsAccumulator':
+        """
+        Add a batch of data (see 'forecast_metrics' for a description of the parameters)
+        """
+        real_data = np.asarray(real_data, dtype=np.float64)
+        dts = np.asarray(dts, dtype=np.int64)
+        if len(real_data) == 0:
+            return self
+        batch = ForecastMetricsAccumulator(self.relative_accuracy)
+        errors = np.abs(real_data[:, np.newaxis] - np.asarray(predicted_data, dtype=np.float64))
+
+        batch.count = len(real_data)
+        batch.sum_abs_errors = errors.sum(axis=0)
+        batch.sum_squared_errors = (errors ** 2).sum(axis=0)
+        for j, sketch in enumerate(batch.sketches):
+            sketch.update(errors[:, j])
+        batch.min_dt = int(dts.min())
+        batch.max_dt = int(dts.max())
+
+        pending = np.zeros(errors.shape, dtype=bool)
+        for j, period in enumerate(self.periods):
+            prior_positions = prior_period_positions(dts, period)
+            matches = prior_positions >= 0
+            batch.sum_scaled_abs_errors[j] = errors[matches, j].sum()
+            batch.sum_naive_abs_errors[j] = np.abs(real_data[matches] - real_data[prior_positions[matches]]).sum()
+            pending[:, j] = ~matches & (dts - period < batch.min_dt)
+
+        in_head = dts < batch.min_dt + self.periods.max()
+        batch.head = (dts[in_head], real_data[in_head], errors[in_head], pending[in_head])
+        in_tail = dts > batch.max_dt - self.periods.max()
+        batch.tail = (dts[in_tail], real_data[in_tail])
+        return self.merge(batch)
+
+    def merge(self, other: 'ForecastMetricsAccumulator') -> 'ForecastMetricsAccumulator':
+        """
+        Add the statistics of another accumulator, whose data must be either entirely before or entirely after the data
+        of this one
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self._copy_state(other)
+            return self
+        if self.max_dt < other.min_dt:
+            earlier, later = self, other
+        elif other.max_dt < self.min_dt:
+            earlier, later = other, self
+        else:
+            raise ValueError("accumulators with overlapping data cannot be merged")
+
+        # values at the beginning of 'later' whose prior period is at the end of 'earlier'
+        later_head_dts, later_head_real, later_head_errors, later_head_pending = later.head
+        earlier_tail_dts, earlier_tail_real = earlier.tail
+        later_head_pending = later_head_pending.copy()
+        for j, period in enumerate(self.periods):
+            prior_dts = later_head_dts - period
+            prior_positions = find_positions(earlier_tail_dts, prior_dts)
+            matches = later_head_pending[:, j] & (prior_positions >= 0)
+            self.sum_scaled_abs_errors[j] += later_head_errors[matches, j].sum()
+            self.sum_naive_abs_errors[j] += np.abs(later_head_real[matches] - earlier_tail_real[prior_positions[matches]]).sum()
+            # values whose prior period falls in 'earlier' but was not found will never be matched
+            later_head_pending[:, j] &= ~matches & (prior_dts < earlier.min_dt)
+
+        self.count += other.count
+        self.sum_abs_errors = self.sum_abs_errors + other.sum_abs_errors
+        self.sum_squared_errors = self.sum_squared_errors + other.sum_squared_errors
+        self.sum_scaled_abs_errors = self.sum_scaled_abs_errors + other.sum_scaled_abs_errors
+        self.sum_naive_abs_errors = self.sum_naive_abs_errors + other.sum_naive_abs_errors
+        for sketch, other_sketch in zip(self.sketches, other.sketches):
+            sketch.merge(other_sketch)
+        self.min_dt = earlier.min_dt
+        self.max_dt = later.max_dt
+
+        head = [np.concatenate(arrays) for arrays in zip(earlier.head, (later_head_dts, later_head_real, later_head_errors, later_head_pending))]
+        in_head = head[0] < self.min_dt + self.periods.max()
+        self.head = tuple(array[in_head] for array in head)
+        tail = [np.concatenate(arrays) for arrays in zip(earlier.tail, later.tail)]
+        in_tail = tail[0] > self.max_dt - self.periods.max()
+        self.tail = tuple(array[in_tail] for array in tail)
+        return self
+
+    def _copy_state(self, other: 'ForecastMetricsAccumulator'):
+        self.relative_accuracy = other.relative_accuracy
+        self._set_state(other.to_dict())
+
+    def finalize(self) -> 'dict[str, list[float]]':
+        """
+        Metrics of the data accumulated so far, with the same format as the result of 'forecast_metrics'
+        """
+        if self.count == 0:
+            raise ValueError("no data points to calculate the metrics")
+        return {
+            "mae": (self.sum_abs_errors / self.count).tolist(),
+            "rmse": np.sqrt(self.sum_squared_errors / self.count).tolist(),
+            "medae": [sketch.quantile(0.5) for sketch in self.sketches],
+            "mase": [scaled / naive if naive != 0 else np.nan for scaled, naive in zip(self.sum_scaled_abs_errors.tolist(), self.sum_naive_abs_errors.tolist())]
+        }
+
+    def to_dict(self) -> dict:
+        return {'relative_accuracy': self.relative_accuracy, 'count': self.count,
+                'sum_abs_errors': self.sum_abs_errors.tolist(), 'sum_squared_errors': self.sum_squared_errors.tolist(),
+                'sum_scaled_abs_errors': self.sum_scaled_abs_errors.tolist(), 'sum_naive_abs_errors': self.sum_naive_abs_errors.tolist(),
+                'sketches': [sketch.to_dict() for sketch in self.sketches], 'min_dt': self.min_dt, 'max_dt': self.max_dt,
+                'head': [array.tolist() for array in self.head], 'tail': [array.tolist() for array in self.tail]}
+
+    def _set_state(self, state: dict):
+        self.count = state['count']
+        self.sum_abs_errors = np.array(state['sum_abs_errors'])
+        self.sum_squared_errors = np.array(state['sum_squared_errors'])
+        self.sum_scaled_abs_errors = np.array(state['sum_scaled_abs_errors'])
+        self.sum_naive_abs_errors = np.array(state['sum_naive_abs_errors'])
+        self.sketches = [QuantileSketch.from_dict(sketch) for sketch in state['sketches']]
+        self.min_dt = state['min_dt']
+        self.max_dt = state['max_dt']
+        head_dts, head_real, head_errors, head_pending = state['head']
+        self.head = (np.array(head_dts, dtype=np.int64), np.array(head_real, dtype=np.float64),
+                     np.array(head_errors, dtype=np.float64).reshape(-1, 5), np.array(head_pending, dtype=bool).reshape(-1, 5))
+        tail_dts, tail_real = state['tail']
+        self.tail = (np.array(tail_dts, dtype=np.int64), np.array(tail_real, dtype=np.float64))
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'ForecastMetricsAccumulator':
+        accumulator = cls(state['relative_accuracy'])
+        accumulator._set_state(state)
+        return accumulator
+
+    def save(self, file):
+        with open(file, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, file) -> 'ForecastMetricsAccumulator':
+        with open(file, encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+class GroupedMetricsAccumulator:
+    """
+    Sufficient statistics to calculate the metrics of the 5 forecast models incrementally for each group of values
+    (e.g. the hour of the day or the month of the year of each value)
+
+    The statistics of each group are the ones of 'ForecastMetricsAccumulator', but the terms of the mase of each value
+    are given instead of being calculated (see 'naive_forecast_errors'), as the prior period of a value may belong to
+    another group.
+
+    Usage
+    -----
+
+        accumulator = GroupedMetricsAccumulator()
+        accumulator.update(groups, errors, scaled_errors, naive_errors)
+        ....
+        accumulator.finalize()  # metrics of each group (medae is an estimation)
+
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.groups = {}
+
+    def _empty_statistics(self) -> dict:
+        return {'count': 0, 'sum_abs_errors': np.zeros(5), 'sum_squared_errors': np.zeros(5), 'sum_scaled_abs_errors': np.zeros(5),
+                'sum_naive_abs_errors': np.zeros(5), 'sketches': [QuantileSketch(self.relative_accuracy) for _ in range(5)]}
+
+    def update(self, groups, errors, scaled_errors, naive_errors) -> 'GroupedMetricsAccumulator':
+        """
+        Add a batch of data
+
+        Parameters
+        ----------
+
+        groups: array
+
+            array with the group of each of the n values
+
+        errors, scaled_errors, naive_errors: array
+
+            (n, 5) matrices with the absolute errors of the models t5, t4, t3, t2 and t1 and the terms of their mase, as
+            returned by 'naive_forecast_errors'
+
+        """
+        groups = np.asarray(groups)
+        errors = np.asarray(errors, dtype=np.float64)
+        for group in np.unique(groups):
+            in_group = groups == group
+            # numpy scalars are stored as python values so that the groups can be saved as JSON
+            statistics = self.groups.setdefault(group.item() if isinstance(group, np.generic) else group, self._empty_statistics())
+            statistics['count'] += int(in_group.sum())
+            statistics['sum_abs_errors'] += errors[in_group].sum(axis=0)
+            statistics['sum_squared_errors'] += (errors[in_group] ** 2).sum(axis=0)
+            statistics['sum_scaled_abs_errors'] += np.asarray(scaled_errors)[in_group].sum(axis=0)
+            statistics['sum_naive_abs_errors'] += np.asarray(naive_errors)[in_group].sum(axis=0)
+            for j, sketch in enumerate(statistics['sketches']):
+                sketch.update(errors[in_group, j])
+        return self
+
+    def finalize(self) -> 'dict[object, dict[str, list[float]]]':
+        """
+        Metrics of each group, sorted by group, with the same format as the result of 'forecast_metrics'
+        """
+        return {group: {
+            "mae": (statistics['sum_abs_errors'] / statistics['count']).tolist(),
+            "rmse": np.sqrt(statistics['sum_squared_errors'] / statistics['count']).tolist(),
+            "medae": [sketch.quantile(0.5) for sketch in statistics['sketches']],
+            "mase": [scaled / naive if naive != 0 else np.nan for scaled, naive in zip(statistics['sum_scaled_abs_errors'].tolist(), statistics['sum_naive_abs_errors'].tolist())]
+        } for group, statistics in sorted(self.groups.items())}
+
+    def to_dict(self) -> dict:
+        # groups are stored as a list, as JSON objects only have string keys
+        return {'relative_accuracy': self.relative_accuracy,
+                'groups': [[group, {**{key: value.tolist() for key, value in statistics.items() if key not in ['count', 'sketches']},
+                                    'count': statistics['count'], 'sketches': [sketch.to_dict() for sketch in statistics['sketches']]}]
+                           for group, statistics in self.groups.items()]}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'GroupedMetricsAccumulator':
+        accumulator = cls(state['relative_accuracy'])
+        accumulator.groups = {group: {**{key: np.array(value) for key, value in statistics.items() if key not in ['count', 'sketches']},
+                                      'count': statistics['count'], 'sketches': [QuantileSketch.from_dict(sketch) for sketch in statistics['sketches']]}
+                              for group, statistics in state['groups']}
+        return accumulator
@@ -0,0 +1,175 @@
+"""Metrics Refresh
+
+Module to keep the metrics of every weather variable up to date as the spiders append new rows to their join files,
+prejoin_{city}.csv (see 'common.complete_joins').
+
+The spiders are the only writers of those files: the join_{city}.csv files written by 'data_analysis' are not followed,
+as they are rebuilt or appended to independently of the spiders.
+
+Instead of analysing the whole join file again, the rows appended since the last refresh are added to the accumulators
+of the metrics of each weather variable (see 'metrics.ForecastMetricsAccumulator'), which are persisted, together with
+the position of the join file up to which rows have been read (see 'storage.read_appended_rows'), in the file
+metrics_state_{city}.json. The cost of a refresh is therefore proportional to the number of new rows, not to the size
+of the join file.
+
+The metrics are written to the files prejoin_metrics_{city}.csv of the folders of the weather variables, with the same
+format as the metrics_{city}.csv files of 'data_analysis', except for medae, which is estimated. The metrics_{city}.csv
+files are only written by 'data_analysis' (from its join files or, in prejoined mode, from the prejoin files), so that
+each file has a single writer and the analysis cache of 'data_analysis' stays valid. The files of metrics that need the whole
+join (rolling metrics, breakdowns and segments) are left to 'data_analysis'.
+
+If the join file is replaced or truncated (e.g. restored from a backup), the change is detected and the state of the
+city is rebuilt from scratch.
+
+The metrics of every city are refreshed with:
+
+    python -m roboclimate.metrics_refresh
+
+and kept up to date whenever a join file changes with:
+
+    python -m roboclimate.metrics_refresh --watch
+
+"""
+
+import io
+import os
+import json
+import time
+import argparse
+import logging
+from typing import List
+import pandas as pd
+from roboclimate.metrics import ForecastMetricsAccumulator
+import roboclimate.config as config
+import roboclimate.util as util
+import roboclimate.storage as storage
+from roboclimate.data_analysis import TX_HEADERS, weather_variable_join
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = "metrics_state"
+METRICS_RESOURCE = "prejoin_metrics"
+
+
+def state_file_path(city_name: str) -> str:
+    return f"{config.csv_folder}/{STATE_FILE}_{city_name}.json"
+
+
+def empty_state() -> dict:
+    return {'offset': 0, 'check': "", 'accumulators': {}}
+
+
+def read_state(city_name: str) -> dict:
+    state_file = state_file_path(city_name)
+    if not os.path.exists(state_file):
+        return empty_state()
+    with open(state_file, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_atomically(file_name: str, content: str) -> None:
+    """Write the file so that readers see either its previous or its new content, never a partial one"""
+    tmp_file = f"{file_name}.tmp"
+    with open(tmp_file, 'w', encoding="utf-8") as file:
+        file.write(content)
+    os.replace(tmp_file, file_name)
+
+
+def refresh_city(city_name: str) -> int:
+    """Add the rows appended to the join file of the spiders to the metrics of the city and rewrite its metrics files
+
+    Returns:
+        int: number of rows added
+    """
+    join_file = util.csv_file_path(config.csv_folder, config.prejoin_resource, city_name)
+    if not os.path.exists(join_file):
+        return 0
+
+    state = read_state(city_name)
+    appended_rows = storage.read_appended_rows(join_file, state['offset'], state['check'])
+    if appended_rows is None:
+        logger.info("%s has been replaced, refreshing its metrics from scratch", join_file)
+        state = empty_state()
+        appended_rows = storage.read_appended_rows(join_file)
+    if not appended_rows.rows:
+        return 0
+
+    join_df = storage.read_csv(io.BytesIO(appended_rows.header + appended_rows.rows))
+    accumulators = {weather_variable: ForecastMetricsAccumulator.from_dict(state['accumulators'][weather_variable])
+                    if weather_variable in state['accumulators'] else ForecastMetricsAccumulator()
+                    for weather_variable in config.weather_variables.values()}
+    for weather_variable, accumulator in accumulators.items():
+        variable_join_df = weather_variable_join(join_df, weather_variable)
+        if not variable_join_df.empty:
+            accumulator.update(variable_join_df[weather_variable], variable_join_df[TX_HEADERS], variable_join_df['dt'])
+
+    state['offset'] = appended_rows.offset
+    state['check'] = appended_rows.check
+    state['accumulators'] = {weather_variable: accumulator.to_dict() for weather_variable, accumulator in accumulators.items()}
+    # the state is written first: if the metrics files could not be written, they are written by the next refresh
+    write_atomically(state_file_path(city_name), json.dumps(state))
+    write_metrics(city_name, accumulators)
+    return len(join_df)
+
+
+def write_metrics(city_name: str, accumulators: dict) -> None:
+    for weather_variable, accumulator in accumulators.items():
+        if accumulator.count == 0:
+            continue
+        os.makedirs(f"{config.csv_folder}/{weather_variable}", exist_ok=True)
+        metrics_file = util.csv_file_path(config.csv_folder, METRICS_RESOURCE, city_name, weather_variable)
+        write_atomically(metrics_file, pd.DataFrame(accumulator.finalize()).to_csv(index=False))
+
+
+def refresh(city_names: List[str]) -> None:
+    for city_name in city_names:
+        try:
+            start = time.perf_counter()
+            rows = refresh_city(city_name)
+            if rows:
+                logger.info("%d rows added to the metrics of %s in %.3f s", rows, city_name, time.perf_counter() - start)
+        except Exception:
+            logger.error("Error while refreshing the metrics of %s", city_name, exc_info=True)
+
+
+def watch() -> None:
+    """Refresh the metrics of a city whenever its join file changes"""
+    # only needed in watch mode
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+
+    join_files = {os.path.abspath(util.csv_file_path(config.csv_folder, config.prejoin_resource, city_name)): city_name for city_name in config.cities}
+
+    class JoinFileHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            city_name = join_files.get(os.path.abspath(getattr(event, 'dest_path', '') or event.src_path))
+            if city_name is not None and not event.is_directory:
+                refresh([city_name])
+
+    observer = Observer()
+    observer.schedule(JoinFileHandler(), config.csv_folder, recursive=False)
+    observer.start()
+    logger.info("Watching the join files in %s", config.csv_folder)
+    try:
+        while observer.is_alive():
+            observer.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the metrics of every city with the rows appended to the join files")
+    parser.add_argument('--watch', action='store_true', help="keep refreshing the metrics whenever a join file changes")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level='INFO')
+    refresh(config.cities)
+    if args.watch:
+        watch()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""Storage
+
+Module to keep a columnar (Parquet) mirror of the csv files of the weather, forecast and join archives.
+
+The spiders keep appending rows to the csv files, which have to be parsed in full every time they are read. The mirror
+stores the same rows with the compact dtypes of 'config.column_dtypes' (float32 measurements, int64 dt and 'today' as a
+datetime), partitioned by city and year, under the folder 'parquet' of the csv folder:
+
+    parquet/{resource}/city={city}/year={year}/part-0.parquet
+
+so that readers only decode the columns they need and skip the years outside the requested dt range.
+
+The size and modification time of the csv file mirrored are recorded next to the partitions of each city. A mirror is
+only read while it is fresh, i.e. while the csv file has not changed since it was converted. Stale mirrors are refreshed
+when they are loaded (see function 'load'): as the csv files are appended to, only the partitions of the years of the
+appended rows are rewritten, usually the current year (see function 'refresh_mirror'). Either way, the columns are loaded
+with the dtypes of 'config.column_dtypes'.
+
+The mirror of the existing archives is (re)built with:
+
+    python -m roboclimate.storage
+
+"""
+
+import io
+import os
+import json
+import shutil
+import argparse
+import logging
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+import pandas as pd
+import pyarrow as pa
+from pyarrow import csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import roboclimate.config as config
+import roboclimate.util as util
+
+logger = logging.getLogger(__name__)
+
+MIRROR_FOLDER = "parquet"
+SOURCE_FILE = "_source.json"
+JOIN_RESOURCE = "join"
+# size of the end of the content read that is compared to detect that a csv file has been rewritten (see 'read_appended_rows')
+CHECK_BYTES = 256
+# dates are read as timestamps so that both '2019-11-30' and '2019-11-30 00:00:00' are accepted
+ARROW_TYPES = {'int64': pa.int64(), 'float32': pa.float32(), 'float64': pa.float64(), 'datetime64[s]': pa.timestamp('s')}
+# types of the columns of the csv files written by the spiders (temp,pressure,humidity,wind_speed,wind_deg,dt,today) and
+# of the forecasts in the join files ({weather variable}_{tx}), see 'config.column_dtypes'
+# measurements are read as floats as integer columns with empty values are written back as floats by pandas (e.g. 37.0)
+COLUMN_TYPES = {column: ARROW_TYPES[dtype] for column, dtype in config.column_dtypes.items()}
+# integer columns are parsed as floats and then cast (see 'cast_table'), as the weather spider writes the normalised dts
+# as floats (e.g. 1575061200.0)
+CSV_COLUMN_TYPES = {column: pa.float64() if column_type == pa.int64() else column_type for column, column_type in COLUMN_TYPES.items()}
+
+
+def mirror_path(csv_file: str) -> str:
+    """Folder of the mirror of the given csv file, e.g. {csv_folder}/weather_london.csv -> {csv_folder}/parquet/weather/city=london"""
+    folder, file_name = os.path.split(csv_file)
+    resource, _, city_name = os.path.splitext(file_name)[0].rpartition('_')
+    return os.path.join(folder, MIRROR_FOLDER, resource, f"city={city_name}")
+
+
+def csv_signature(csv_file: str) -> dict:
+    stat = os.stat(csv_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_source(csv_file: str) -> Optional[dict]:
+    """Signature of the csv file when it was last mirrored, None if the mirror is missing or incomplete"""
+    source_file = os.path.join(mirror_path(csv_file), SOURCE_FILE)
+    if not os.path.exists(source_file):
+        return None
+    with open(source_file, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_source(csv_file: str, signature: dict, check: str) -> None:
+    # the end of the rows mirrored is kept to check that they are still there when the mirror is refreshed
+    with open(os.path.join(mirror_path(csv_file), SOURCE_FILE), 'w', encoding="utf-8") as file:
+        json.dump({**signature, 'check': check}, file)
+
+
+def is_fresh(csv_file: str) -> bool:
+    """Whether the mirror of the csv file exists and the csv file has not changed since it was mirrored"""
+    source = read_source(csv_file)
+    if source is None or not os.path.exists(csv_file):
+        return False
+    return all(source.get(key) == value for key, value in csv_signature(csv_file).items())
+
+
+def to_pandas(table: pa.Table) -> pd.DataFrame:
+    """Convert an Arrow table to a DataFrame with the dtypes of 'config.column_dtypes'"""
+    df = table.to_pandas(date_as_object=False)
+    return df.astype({column: config.column_dtypes[column] for column in df.columns if column in config.column_dtypes})
+
+
+def cast_table(table: pa.Table) -> pa.Table:
+    """Cast the columns parsed as floats to their types in 'COLUMN_TYPES' (values with a fractional part are rejected)"""
+    schema = pa.schema([field.with_type(COLUMN_TYPES.get(field.name, field.type)) for field in table.schema])
+    return table.cast(schema)
+
+
+def read_csv_table(csv_file, columns: Optional[List[str]] = None) -> pa.Table:
+    convert_options = csv.ConvertOptions(column_types=CSV_COLUMN_TYPES, include_columns=columns)
+    return cast_table(csv.read_csv(csv_file, read_options=csv.ReadOptions(use_threads=True), convert_options=convert_options))
+
+
+def read_csv(csv_file: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read a weather, forecast or join csv file with the multithreaded Arrow csv reader
+
+    The types of the columns are fixed (see 'config.column_dtypes') instead of inferred. As with pandas, empty values are
+    read as NaN
+    """
+    return to_pandas(read_csv_table(csv_file, columns))
+
+
+def iter_csv(csv_file: str, block_size: int) -> Iterator[pd.DataFrame]:
+    """Read a weather, forecast or join csv file in chunks of about 'block_size' bytes of the file, in file order
+
+    Chunks are loaded with the same dtypes as 'read_csv'
+    """
+    convert_options = csv.ConvertOptions(column_types=CSV_COLUMN_TYPES)
+    with csv.open_csv(csv_file, read_options=csv.ReadOptions(block_size=block_size), convert_options=convert_options) as reader:
+        for batch in reader:
+            yield to_pandas(cast_table(pa.Table.from_batches([batch])))
+
+
+def complete_rows(data: bytes) -> bytes:
+    # the last row may still be being written
+    return data[:data.rfind(b'\n') + 1]
+
+
+def tail_check(data: bytes) -> str:
+    """End of the content read from a csv file, as stored to detect that the file has been rewritten
+
+    The end is cut at an arbitrary byte, hence it is decoded as latin-1, which maps every byte to a character
+    """
+    return data[-CHECK_BYTES:].decode("latin-1")
+
+
+class AppendedRows(NamedTuple):
+    header: bytes
+    rows: bytes
+    # position of the end of the rows and end of the content up to it, to read the rows appended afterwards
+    offset: int
+    check: str
+
+
+def read_appended_rows(csv_file: str, offset: int = 0, check: str = "") -> Optional[AppendedRows]:
+    """Read the header and the complete rows appended to a csv file after the position 'offset'
+
+    Files that are only appended to (e.g. by the spiders) are followed by keeping the position up to which they have
+    been read and the end of the content read up to it ('check', see 'tail_check'). Offset 0 means that no row has been
+    read yet.
+
+    Returns:
+        Optional[AppendedRows]: header, new rows and position and check to read the next ones, None if the file no longer
+        has the content read (it has been rewritten or truncated)
+    """
+    check_bytes = check.encode("latin-1")
+    with open(csv_file, 'rb') as file:
+        header = file.readline()
+        offset = max(offset, len(header))
+        file.seek(max(offset - len(check_bytes), 0))
+        if file.read(len(check_bytes)) != check_bytes:
+            return None
+        rows = complete_rows(file.read())
+    return AppendedRows(header, rows, offset + len(rows), tail_check(check_bytes + rows))
+
+
+def table_years(table: pa.Table):
+    return pd.to_datetime(table.column('dt').to_numpy(), unit='s', utc=True).year.to_numpy()
+
+
+def partition_path(csv_file: str, year) -> str:
+    return os.path.join(mirror_path(csv_file), f"year={year}", "part-0.parquet")
+
+
+def write_mirror(csv_file: str) -> bool:
+    """(Re)build the mirror of the given csv file
+
+    Returns:
+        bool: whether the mirror was written (csv files without rows are not mirrored)
+    """
+    signature = csv_signature(csv_file)
+    with open(csv_file, 'rb') as file:
+        rows = complete_rows(file.read())
+    # only the rows read are recorded as mirrored, as the csv file may have been appended to since it was stat'ed
+    signature['size'] = len(rows)
+    table = read_csv_table(io.BytesIO(rows))
+    mirror_folder = mirror_path(csv_file)
+    if os.path.exists(mirror_folder):
+        shutil.rmtree(mirror_folder)
+    if table.num_rows == 0:
+        return False
+
+    years = table_years(table)
+    for year in pd.unique(years):
+        os.makedirs(os.path.dirname(partition_path(csv_file, year)))
+        pq.write_table(table.filter(pa.array(years == year)), partition_path(csv_file, year))
+    # written last, so that a mirror whose conversion was interrupted is never taken as fresh
+    write_source(csv_file, signature, tail_check(rows))
+    return True
+
+
+def refresh_mirror(csv_file: str) -> bool:
+    """Bring the mirror of the csv file, if any, up to date
+
+    When rows have been appended to the csv file since it was mirrored, only the partitions of the years of the new rows
+    are rewritten. The whole mirror is rebuilt if the rows mirrored have changed (see 'read_appended_rows').
+
+    Returns:
+        bool: whether the csv file is mirrored, up to its last complete row (mirrors are only created by 'write_mirror')
+    """
+    if not os.path.exists(mirror_path(csv_file)) or not os.path.exists(csv_file):
+        return False
+    if is_fresh(csv_file):
+        return True
+    source = read_source(csv_file)
+    signature = csv_signature(csv_file)
+    appended_rows = None
+    if source is not None and 'check' in source and signature['size'] >= source['size']:
+        appended_rows = read_appended_rows(csv_file, source['size'], source['check'])
+    if appended_rows is None:
+        logger.info("%s has changed, rebuilding its mirror", csv_file)
+        return write_mirror(csv_file)
+
+    table = read_csv_table(io.BytesIO(appended_rows.header + appended_rows.rows))
+    # until the new source is written, the mirror is neither fresh nor refreshed incrementally (it is rebuilt)
+    os.remove(os.path.join(mirror_path(csv_file), SOURCE_FILE))
+    try:
+        years = table_years(table)
+        for year in pd.unique(years):
+            year_table = table.filter(pa.array(years == year))
+            partition_file = partition_path(csv_file, year)
+            if os.path.exists(partition_file):
+                mirrored_table = pq.ParquetFile(partition_file).read()
+                year_table = pa.concat_tables([mirrored_table, year_table.cast(mirrored_table.schema)])
+            else:
+                os.makedirs(os.path.dirname(partition_file))
+            # hidden files are not read as part of the dataset (see 'read_mirror')
+            tmp_file = os.path.join(os.path.dirname(partition_file), f".{os.path.basename(partition_file)}.tmp")
+            pq.write_table(year_table, tmp_file)
+            os.replace(tmp_file, partition_file)
+    except (pa.ArrowException, ValueError):
+        logger.info("Rows appended to %s do not match its mirror, rebuilding it", csv_file, exc_info=True)
+        return write_mirror(csv_file)
+
+    signature['size'] = appended_rows.offset
+    write_source(csv_file, signature, appended_rows.check)
+    logger.debug("%d rows of %s added to its mirror", table.num_rows, csv_file)
+    return True
+
+
+def year(dt: int) -> int:
+    return pd.Timestamp(dt, unit='s', tz='UTC').year
+
+
+def read_mirror(csv_file: str, columns: Optional[List[str]] = None, dt_range: Optional[Tuple[Optional[int], Optional[int]]] = None) -> pd.DataFrame:
+    """Read the mirror of the csv file, decoding only the given columns and the rows with start <= dt < end (either end
+    may be None)"""
+    dataset = ds.dataset(mirror_path(csv_file), format='parquet', partitioning='hive', exclude_invalid_files=True)
+    row_filter = None
+    if dt_range is not None:
+        start, end = dt_range
+        # partitions of the years outside the range are skipped
+        if start is not None:
+            row_filter = (ds.field('year') >= year(start)) & (ds.field('dt') >= start)
+        if end is not None:
+            end_filter = (ds.field('year') <= year(end - 1)) & (ds.field('dt') < end)
+            row_filter = end_filter if row_filter is None else row_filter & end_filter
+    return to_pandas(dataset.to_table(columns=columns or [name for name in dataset.schema.names if name != 'year'], filter=row_filter))
+
+
+def load(csv_file: str, columns: Optional[List[str]] = None, dt_range: Optional[Tuple[Optional[int], Optional[int]]] = None,
+         mirror: bool = False) -> pd.DataFrame:
+    """Load the rows of a weather, forecast or join csv file with start <= dt < end (all rows by default, either end may
+    be None)
+
+    The mirror of the file, refreshed if it is stale (see 'refresh_mirror'), is read if the file is mirrored, otherwise
+    the csv file itself. With 'mirror', a file not mirrored yet is mirrored first, so that the next loads only read the
+    partitions of the years in the dt range
+    """
+    if refresh_mirror(csv_file) or (mirror and os.path.exists(csv_file) and write_mirror(csv_file)):
+        return read_mirror(csv_file, columns, dt_range)
+
+    df = read_csv(csv_file, columns)
+    if dt_range is not None:
+        start, end = dt_range
+        in_range = pd.Series(True, index=df.index)
+        if start is not None:
+            in_range &= df['dt'] >= start
+        if end is not None:
+            in_range &= df['dt'] < end
+        df = df[in_range].reset_index(drop=True)
+    return df
+
+
+def convert(resources: List[str]) -> None:
+    """(Re)build the mirror of the csv files of the given resources for all cities"""
+    for resource in resources:
+        for city_name in config.cities:
+            csv_file = util.csv_file_path(config.csv_folder, resource, city_name)
+            if not os.path.exists(csv_file):
+                logger.warning("%s not found", csv_file)
+            elif write_mirror(csv_file):
+                logger.info("%s mirrored", csv_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the Parquet mirror of the csv files of every city")
+    parser.add_argument('resources', nargs='*', default=config.weather_resources + [JOIN_RESOURCE],
+                        help="resources to mirror (default: weather, forecast and join)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level='INFO')
+    convert(args.resources)
+
+
+if __name__ == "__main__":
+    main()
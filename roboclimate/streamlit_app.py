@@ -101,6 +101,30 @@ def load_metrics_file(city, weather_var):
     return rde.load_metrics_file(city, weather_var)
 
 
+@st.cache_data
+def load_rolling_metrics_file(city_name, weather_var, window):
+    return rde.load_rolling_metrics_file(rconf.cities[city_name], weather_var, window)
+
+
+def plot_rolling_metrics(city_name, weather_var, window, metric):
+    rolling_metrics_df = load_rolling_metrics_file(city_name, weather_var, window)
+    # partial windows at the beginning of the series are left out
+    rolling_metrics_df = rolling_metrics_df[rolling_metrics_df['count'] >= window * rconf.day_factor // 2]
+    x = pd.to_datetime(rolling_metrics_df['dt'], unit='s')
+
+    fig, ax = plt.subplots()
+    plt.grid(True)
+    for tx in ['t5', 't4', 't3', 't2', 't1']:
+        plt.plot(x, rolling_metrics_df[f'{metric}_{tx}'].to_numpy(), label=tx)
+    if metric == 'mase':
+        plt.plot(x, np.ones(len(x)), label='1', color='red')
+    fig.autofmt_xdate()
+    plt.ylabel(metric)
+    plt.title(f"{metric} over the last {window} days - {city_name}")
+    plt.legend()
+    st.pyplot(fig)
+
+
 def plot_cities():
     fig, ax = plt.subplots()
     plt.grid(True)
@@ -123,8 +147,8 @@ def plot_cities():
 #################################################
 
 with st.sidebar:
-    selected = option_menu('Roboclimate', ["Intro", 'Forecast vs Actual', 'Forecast Metrics', 'City Comparison'],
-                           icons=['play-btn', 'cloud-rain', 'thermometer-sun', 'building'], menu_icon='tropical-storm', default_index=0)
+    selected = option_menu('Roboclimate', ["Intro", 'Forecast vs Actual', 'Forecast Metrics', 'Metrics over Time', 'City Comparison'],
+                           icons=['play-btn', 'cloud-rain', 'thermometer-sun', 'graph-up', 'building'], menu_icon='tropical-storm', default_index=0)
 
     if selected == 'Forecast vs Actual':
         st.markdown('---')  # Horizontal line for visual separation
@@ -163,6 +187,29 @@ with st.sidebar:
             [city.name for city in rconf.cities.values()],
             key='city_name_option2')
 
+    if selected == 'Metrics over Time':
+        st.markdown('---')  # Horizontal line for visual separation
+
+        weather_var_option4 = st.selectbox(
+            'choose a weather variable',
+            list(rconf.weather_variables_with_units.values()),
+            key='weather_var_option4')
+
+        weather_var_option4 = weather_var_option4.split('(')[0].strip()
+
+        city_name_option4 = st.sidebar.selectbox(
+            'select a city',
+            [city.name for city in rconf.cities.values()],
+            key='city_name_option4')
+
+        window_option = st.sidebar.selectbox(
+            'select window (days)',
+            rconf.rolling_windows)
+
+        rolling_metric_option = st.sidebar.selectbox(
+            'select metric',
+            ['mae', 'rmse', 'mase'])
+
     if selected == 'City Comparison':
         st.markdown('---')  # Horizontal line for visual separation
 
@@ -274,5 +321,8 @@ if selected == 'Forecast Metrics':
         with st.expander("Show data"):
             st.dataframe(y_mase)
 
+if selected == 'Metrics over Time':
+    plot_rolling_metrics(city_name_option4, weather_var_option4, window_option, rolling_metric_option)
+
 if selected == 'City Comparison':
     plot_cities()
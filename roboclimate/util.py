@@ -3,10 +3,13 @@ import csv
 import os
 import logging
 import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
 from roboclimate.config import weather_resources
 from roboclimate import config
 
 logger = logging.getLogger(__name__)
+HISTORICAL_DATA_SOURCE_KEY = b'roboclimate.source'  # size and modification time of the csv file of a cache
 
 def current_utc_date_generator():
     current_utc_dt = datetime.utcnow()
@@ -25,8 +28,22 @@ def n_years_ago(date_time, n):
 
 
 def remove_29_feb(df):
-    df['dt_iso'] = df['dt'].apply(datetime.fromtimestamp)
-    return df.drop(df[df['dt_iso'].apply(lambda x: (x.month, x.day)) == (2, 29)].index)
+    df['dt_iso'] = pd.to_datetime(df['dt'], unit='s', utc=True)
+    return df[~((df['dt_iso'].dt.month == 2) & (df['dt_iso'].dt.day == 29))]
+
+
+def iso_to_timestamp(iso_datetime):
+    """
+    Args:
+        iso_datetime: '2019-11-30T03:00:00+00:00' or '2019-11-30T03:00:00' (taken as UTC)
+
+    Returns:
+        int: POSIX timestamp 1575082800
+    """
+    timestamp = pd.Timestamp(iso_datetime)
+    if timestamp.tz is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return int(timestamp.timestamp())
 
 
 def csv_file_path(csv_folder, filename, city_name, weather_variable=None):
@@ -49,11 +66,43 @@ def date_and_timestamp(start_datetime, end_datetime_not_included):
     return [(x, date.fromtimestamp(x).isoformat()) for x in range(int(start_datetime.timestamp()), int(end_datetime_not_included.timestamp()), step_3hours)]
 
 
-def read_historical_data(file):
+def parse_historical_data(file):
     df = pd.read_csv(file)
-    df['parsed_dt'] = df['dt_iso'].apply(lambda x: x[:19])
+    # dt_iso looks like '2019-11-30 03:00:00 +0000 UTC'
+    df['parsed_dt'] = df['dt_iso'].str.slice(0, 19)
     df = df.drop_duplicates('parsed_dt')
-    return df.set_index(pd.DatetimeIndex(df['parsed_dt']))
+    return df.set_index(pd.DatetimeIndex(pd.to_datetime(df['parsed_dt'], format='%Y-%m-%d %H:%M:%S'), name='parsed_dt'))
+
+
+def historical_data_cache_path(file):
+    return f"{os.path.splitext(file)[0]}.feather"
+
+
+def read_historical_data(file, cache=True):
+    """
+    Read the historical data of a city, indexed by datetime (UTC) and without duplicate datetimes
+
+    Unless 'cache' is False, the parsed data is cached in a Feather file next to the csv file. The size and modification
+    time of the csv file are stored in the metadata of the cache, so that the cache is only used while the csv file does
+    not change
+    """
+    if not cache:
+        return parse_historical_data(file)
+    cache_file = historical_data_cache_path(file)
+    stat = os.stat(file)
+    source = f"{stat.st_size}:{stat.st_mtime_ns}".encode()
+    if os.path.exists(cache_file):
+        table = feather.read_table(cache_file)
+        if (table.schema.metadata or {}).get(HISTORICAL_DATA_SOURCE_KEY) == source:
+            return table.to_pandas()
+
+    df = parse_historical_data(file)
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    try:
+        feather.write_feather(table.replace_schema_metadata({**table.schema.metadata, HISTORICAL_DATA_SOURCE_KEY: source}), cache_file)
+    except OSError:
+        logger.warning("Historical data of %s could not be cached", file, exc_info=True)
+    return df
 
 
 def write_rows(csv_file, rows):
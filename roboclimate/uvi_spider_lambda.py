@@ -16,7 +16,7 @@ Technical details
 """
 import os
 from datetime import timedelta, timezone, datetime, date
-from common import CITY_PARAMS, logger, run_city, csv_rows
+from common import CITY_PARAMS, logger, run_cities, invocation_deadline, csv_rows
 
 # constants
 WEATHER_RESOURCE = "uvi"
@@ -46,20 +46,24 @@ def handler(event, context):
     yesterday = get_yesterday()
 
     run_params = {
+        'deadline': invocation_deadline(context),
         'json_to_csv_f': transform_weather_data_to_csv,
         'csv_files_path': os.environ.get('ROBOCLIMATE_CSV_FILES_PATH'),
         'csv_header': CSV_HEADER,
         'weather_resource': WEATHER_RESOURCE
     }
+    cities_run_params = {}
     for city_name, city_params in CITY_PARAMS.items():
         # using 'offset' time zone to avoid dealing with DST
         tz = timezone(timedelta(hours=city_params.tz_offset))
-        run_params['timezone'] = tz
-
         solar_noon_dt = int(datetime(yesterday.year, yesterday.month, yesterday.day, 12, 0, 0, tzinfo=tz).timestamp())
-        run_params['solar_noon_dt'] = solar_noon_dt
-        run_params['weather_resource_url'] = f"https://api.openweathermap.org/data/3.0/onecall/timemachine?lat={city_params.lat}&lon={city_params.lon}&units=metric&dt={solar_noon_dt}&appid={os.environ.get('OPEN_WEATHER_API')}"
-        run_city(city_name, run_params)
+        cities_run_params[city_name] = {
+            **run_params,
+            'timezone': tz,
+            'solar_noon_dt': solar_noon_dt,
+            'weather_resource_url': f"https://api.openweathermap.org/data/3.0/onecall/timemachine?lat={city_params.lat}&lon={city_params.lon}&units=metric&dt={solar_noon_dt}&appid={os.environ.get('OPEN_WEATHER_API')}"
+        }
+    return {'skipped': run_cities(cities_run_params)}
 
 
 # when running on AWS env, __name__ = file name specified in AWS runtime's handler
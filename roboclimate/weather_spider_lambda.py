@@ -1,9 +1,12 @@
 import os
 from datetime import timezone, datetime, date
-from common import logger, utcnow_date, run_city, csv_rows, CITIES
+from common import logger, utcnow_date, run_cities, complete_joins, fetch_data, store_city_data, invocation_deadline, DeadlineExceeded, csv_rows, CITIES
 
 # constants
 WEATHER_RESOURCE = "weather"
+# endpoint returning the current weather of several cities at once (see 'run_groups')
+GROUP_RESOURCE = "group"
+GROUP_SIZE = 20  # maximum number of city ids per request
 CSV_HEADER = 'temp,pressure,humidity,wind_speed,wind_deg,dt,today'
 TOLERANCE = {'positive_tolerance': 1200, 'negative_tolerance': 60}  # tolerance in seconds
 
@@ -93,6 +96,57 @@ def transform_weather_data_to_csv(weather_data_json: dict, run_params: dict) ->
     return [[weather_data_json['main']['temp'], weather_data_json['main']['pressure'], weather_data_json['main']['humidity'], weather_data_json['wind']['speed'], weather_data_json['wind'].get('deg', ""), normalise_datetime(weather_data_json['dt'], current_utc_date, tolerance), str(current_utc_date)]]
 
 
+def city_groups(cities: 'dict[str, int]', group_size: int = GROUP_SIZE) -> 'list[dict[str, int]]':
+    city_items = list(cities.items())
+    return [dict(city_items[i:i + group_size]) for i in range(0, len(city_items), group_size)]
+
+
+def run_group(cities: 'dict[str, int]', run_params: dict) -> bool:
+    """
+    Fetch the current weather of several cities with a single request to the "group" endpoint, whose response contains
+    the same data as the "current weather" endpoint for each city, and process each city as 'run_city' does:
+
+        {"cnt": 2, "list": [{"main": {...}, "wind": {...}, "dt": 1485790200, "id": 2643743, ...}, {...}]}
+
+    The errors of a city do not affect the rest of cities of the group
+
+    Returns:
+        bool: False if the group was skipped because the deadline of the invocation was reached (see 'common.run_city')
+    """
+    group_url = f"{run_params['group_resource_url']}&id={','.join(map(str, cities.values()))}"
+    try:
+        weather_data_json = fetch_data(group_url, run_params.get('deadline')).json()
+        cities_json = {city_json['id']: city_json for city_json in weather_data_json['list']}
+    except DeadlineExceeded:
+        return False
+    except Exception as ex:
+        logger.error("Error '%s' while processing '%s'", ex, ', '.join(cities), exc_info=True)
+        return True
+
+    for city_name, city_id in cities.items():
+        try:
+            if city_id not in cities_json:
+                raise ValueError(f"city id {city_id} not found in the response")
+            store_city_data(city_name, transform_weather_data_to_csv(cities_json[city_id], run_params), run_params)
+        except Exception as ex:
+            logger.error("Error '%s' while processing '%s'", ex, city_name, exc_info=True)
+    return True
+
+
+def run_groups(cities: 'dict[str, int]', run_params: dict, group_size: int = GROUP_SIZE) -> 'list[str]':
+    """
+    Batched alternative to 'run_cities': cities are fetched in groups of up to 'group_size' cities (see 'run_group'),
+    dividing the number of requests by the size of the groups
+
+    Returns:
+        list[str]: cities skipped because of the deadline
+    """
+    skipped = [city_name for group in city_groups(cities, group_size) if not run_group(group, run_params) for city_name in group]
+    if skipped:
+        logger.warning("Deadline reached, cities skipped: %s", ', '.join(skipped))
+    return skipped
+
+
 def weather_handler(event, context):
     if event is not None:
         logger.info('running on AWS env')
@@ -100,16 +154,23 @@ def weather_handler(event, context):
         logger.info('running on local env')
 
     run_params = {
+        'deadline': invocation_deadline(context),
         'utcnow_date': utcnow_date(),
         'tolerance': TOLERANCE,
         'json_to_csv_f': transform_weather_data_to_csv,
         'csv_files_path': os.environ.get('ROBOCLIMATE_CSV_FILES_PATH'),
         'csv_header': CSV_HEADER,
-        'weather_resource': WEATHER_RESOURCE
+        'weather_resource': WEATHER_RESOURCE,
+        # the join files are maintained by the spiders instead of the 'data_analysis' module
+        'prejoin_f': complete_joins if os.environ.get('ROBOCLIMATE_PREJOIN') == 'true' else None
     }
-    for city_name, city_id in CITIES.items():
-        run_params['weather_resource_url'] = f"http://api.openweathermap.org/data/2.5/{WEATHER_RESOURCE}?id={city_id}&units=metric&appid={os.environ.get('OPEN_WEATHER_API')}"
-        run_city(city_name, run_params)
+    if os.environ.get('ROBOCLIMATE_WEATHER_GROUPS') == 'true':
+        run_params['group_resource_url'] = f"http://api.openweathermap.org/data/2.5/{GROUP_RESOURCE}?units=metric&appid={os.environ.get('OPEN_WEATHER_API')}"
+        skipped = run_groups(CITIES, run_params)
+    else:
+        skipped = run_cities({city_name: {**run_params, 'weather_resource_url': f"http://api.openweathermap.org/data/2.5/{WEATHER_RESOURCE}?id={city_id}&units=metric&appid={os.environ.get('OPEN_WEATHER_API')}"}
+                              for city_name, city_id in CITIES.items()})
+    return {'skipped': skipped}
 
 
 # when running on AWS env, __name__ = file name specified in AWS runtime's handler
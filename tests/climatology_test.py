@@ -0,0 +1,78 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+import roboclimate.climatology as rclim
+import roboclimate.util as rutil
+
+
+@pytest.fixture(scope='function')
+def historical_file():
+    folder = "tests/temp"
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    shutil.copy("tests/csv_files/historical_data_year_avg.csv", folder)
+    yield f"{folder}/historical_data_year_avg.csv"
+    shutil.rmtree(folder)
+
+
+def timestamp(iso_datetime):
+    return rutil.iso_to_timestamp(iso_datetime)
+
+
+def test_slots():
+    assert list(rclim.slots([1, 2, 3, 12], [1, 29, 1, 31], [0, 12, 3, 23])) == [0, (31 + 28) * 24 + 12, 60 * 24 + 3, rclim.SLOTS - 1]
+
+
+def test_build_climatology():
+    climatology = rclim.build_climatology(rutil.read_historical_data("tests/csv_files/historical_data_year_avg.csv", cache=False), 'temp')
+
+    assert climatology['first_year'] == 2017
+    assert climatology['values'].shape == (2, rclim.SLOTS)
+    assert np.count_nonzero(~np.isnan(climatology['values'])) == 2
+    assert climatology['values'][1, rclim.slots([11], [30], [3])[0]] == 3
+
+
+def test_years_average():
+    climatology = rclim.build_climatology(rutil.read_historical_data("tests/csv_files/historical_data_year_avg.csv", cache=False), 'temp')
+    dts = [timestamp('2019-11-30T03:00:00'), timestamp('2019-11-30T06:00:00'), timestamp('2020-02-29T03:00:00')]
+
+    result = rclim.years_average(climatology, dts, years_back=19)
+
+    # 2018 (3) and 2017 (5), no data at 06:00 nor on 29 February
+    assert result[0] == 4
+    assert np.isnan(result[1:]).all()
+    # only 2018 is one year back
+    assert rclim.years_average(climatology, dts[:1], years_back=1)[0] == 3
+
+
+def test_years_average_same_result_as_lookup_of_each_year():
+    datetimes = pd.date_range('2000-01-01', '2009-12-31 21:00', freq='3h')
+    rng = np.random.default_rng(0)
+    historical_data = pd.DataFrame({'temp': rng.normal(10, 3, len(datetimes))}, index=datetimes).drop(datetimes[1000:3000])
+    climatology = rclim.build_climatology(historical_data, 'temp')
+    dts = [timestamp('2010-03-01T03:00:00'), timestamp('2009-06-15T21:00:00'), timestamp('2012-12-31T00:00:00')]
+
+    result = rclim.years_average(climatology, dts, years_back=5)
+
+    for dt, average in zip(dts, result):
+        date_time = pd.Timestamp(dt, unit='s')
+        previous_values = [historical_data['temp'].get(rutil.n_years_ago(date_time, n)) for n in range(1, 6)]
+        assert average == pytest.approx(np.mean([value for value in previous_values if value is not None]))
+
+
+def test_climatology_cached_on_disk(historical_file):
+    climatology = rclim.load_climatology(historical_file, 'temp')
+    assert os.path.exists(rclim.climatology_file_path(historical_file, 'temp'))
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(rclim, 'build_climatology', lambda *args: pytest.fail("climatology rebuilt"))
+        cached_climatology = rclim.load_climatology(historical_file, 'temp')
+    np.testing.assert_array_equal(cached_climatology['values'], climatology['values'])
+
+    # the cache is rebuilt when the historical data changes
+    with open(historical_file, 'a', encoding="utf-8") as file:
+        file.write("7,2016-11-30 03:00:00\n")
+    assert rclim.load_climatology(historical_file, 'temp')['first_year'] == 2016
@@ -0,0 +1,24 @@
+import shutil
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture(scope='function')
+def csv_folder():
+    folder = "tests/temp"
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    yield folder
+    shutil.rmtree(folder)
+
+
+def synthetic_join(n, gaps=(), seed=0):
+    """Join data with 'n' datapoints at 3-hour intervals, skipping the positions in 'gaps'"""
+    rng = np.random.default_rng(seed)
+    dts = np.array([1575072000 + 3 * 3600 * i for i in range(n) if i not in gaps])
+    temp = rng.normal(10, 3, len(dts)).round(2)
+    return pd.DataFrame({'temp': temp, 'dt': dts, 'today': ['2019-11-30'] * len(dts),
+                         **{f't{i}': (temp + rng.normal(0, i, len(dts))).round(2) for i in range(5, 0, -1)}})
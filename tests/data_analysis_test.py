@@ -1,7 +1,38 @@
+import os
+import tracemalloc
+from contextlib import contextmanager
+from unittest.mock import patch
 import pandas as pd
+import pyarrow as pa
 from roboclimate.data_analysis import join_actual_values_and_forecast
 import roboclimate.data_analysis as rda
+import roboclimate.data_explorer as rde
+from tests.conftest import synthetic_join
+from roboclimate.metrics import ForecastMetricsAccumulator
 import numpy as np
+import pytest
+
+
+def write_city_files(folder, city_name, weather_df, forecast_df):
+    weather_df.to_csv(f"{folder}/weather_{city_name}.csv", index=False)
+    forecast_df.to_csv(f"{folder}/forecast_{city_name}.csv", index=False)
+
+
+def read_output_files(folder, city_name):
+    output_files = {weather_variable: pd.read_csv(f"{folder}/{weather_variable}/metrics_{city_name}.csv")
+                    for weather_variable in rda.config.weather_variables.values()}
+    output_files['join'] = pd.read_csv(f"{folder}/join_{city_name}.csv")
+    return output_files
+
+
+def read_all_output_files(folder, city_name):
+    """Output files including the rolling metrics and the breakdowns"""
+    output_files = read_output_files(folder, city_name)
+    for weather_variable in rda.config.weather_variables.values():
+        output_files[f"{weather_variable}_rolling"] = pd.read_csv(f"{folder}/{weather_variable}/rolling_metrics_{city_name}.csv")
+        for grouping in rda.config.metric_breakdowns:
+            output_files[f"{weather_variable}_{grouping}"] = pd.read_csv(f"{folder}/{weather_variable}/metrics_{grouping}_{city_name}.csv")
+    return output_files
 
 
 def test_forecast_precision():
@@ -118,3 +149,468 @@ def test_join_record_discarded_when_has_empty_value():
 
     result = join_actual_values_and_forecast(current_weather_df, forecast_df)
     assert result['temp'].equals(pd.DataFrame())
+
+
+def iterrows_join(actual_values_df, forecast_df):
+    """
+    Reference implementation of 'join_actual_values_and_forecast' that processes the weather records one by one
+    """
+    headers = ['t5', 't4', 't3', 't2', 't1']
+    dfs_dict = {weather_variable: pd.DataFrame() for weather_variable in rda.config.weather_variables.values()}
+
+    for row in actual_values_df.iterrows():
+        transposed_forecast_df = forecast_df[forecast_df['dt'] == row[1]['dt']].sort_values('today').T
+        if transposed_forecast_df.shape[1] == len(headers):
+            for weather_variable, df in dfs_dict.items():
+                tees_df = pd.DataFrame({i: [j] for i, j in zip(headers, transposed_forecast_df.loc[weather_variable])}, index=[row[0]])
+                weather_variable_df = pd.DataFrame({weather_variable: [row[1][weather_variable]], 'dt': [
+                                                   row[1]['dt']], 'today': [row[1]['today']]}, index=[row[0]])
+                joined_df = weather_variable_df.join(tees_df)
+                joined_df.dropna(inplace=True)
+                dfs_dict[weather_variable] = pd.concat([df, joined_df], ignore_index=True)
+
+    return dfs_dict
+
+
+@pytest.mark.parametrize("weather_file,forecast_file", [
+    ("tests/csv_files/weather.csv", "tests/csv_files/forecast.csv"),
+    ("tests/csv_files/weather_join.csv", "tests/csv_files/forecast_join.csv")
+])
+def test_join_same_result_as_iterrows_join(weather_file, forecast_file):
+    actual_values_df = rda.load_data(weather_file)
+    forecast_df = rda.load_data(forecast_file)
+
+    result = join_actual_values_and_forecast(actual_values_df, forecast_df)
+    expected = iterrows_join(actual_values_df, forecast_df)
+
+    for weather_variable in rda.config.weather_variables.values():
+        # the reference implementation does not keep the float32 dtype of the measurements
+        pd.testing.assert_frame_equal(result[weather_variable], expected[weather_variable], check_dtype=False)
+
+
+def test_join_fixture_discards_incomplete_forecasts():
+    """
+    weather_join.csv contains 16 dts, of which:
+        - 1575104400 has only 4 forecasts
+        - 1575147600 has 6 forecasts
+        - 1575169200 has no forecasts at all
+    and there is a missing value of wind_deg in both files
+    """
+    result = join_actual_values_and_forecast(rda.load_data("tests/csv_files/weather_join.csv"), rda.load_data("tests/csv_files/forecast_join.csv"))
+
+    assert result['temp'].shape[0] == 13
+    assert result['wind_deg'].shape[0] == 11
+    assert not result['temp']['dt'].isin([1575104400, 1575147600, 1575169200]).any()
+
+
+def test_wide_join_contains_all_weather_variables():
+    result = rda.join_weather_and_forecast(rda.load_data("tests/csv_files/weather_join.csv"), rda.load_data("tests/csv_files/forecast_join.csv"))
+
+    assert list(result.columns[:8]) == ['dt', 'today', 'temp', 'temp_t5', 'temp_t4', 'temp_t3', 'temp_t2', 'temp_t1']
+    assert result.shape == (13, 2 + 6 * len(rda.config.weather_variables))
+    # empty values are only discarded from the join of the corresponding weather variable
+    assert result['wind_deg'].isna().sum() == 1
+    assert rda.weather_variable_join(result, 'wind_deg').shape[0] == 11
+
+
+def test_variable_joins_only_exported_on_demand(csv_folder):
+    weather_df = rda.load_data("tests/csv_files/weather_join.csv")
+    forecast_df = rda.load_data("tests/csv_files/forecast_join.csv")
+
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        write_city_files(csv_folder, 'london', weather_df, forecast_df)
+        rda.analyse_city_data('london')
+        assert os.path.exists(f"{csv_folder}/join_london.csv")
+        assert not os.path.exists(f"{csv_folder}/temp/join_london.csv")
+
+        rda.analyse_city_data('london', export_variable_joins=True)
+
+    expected = join_actual_values_and_forecast(weather_df, forecast_df)
+    for weather_variable in rda.config.weather_variables.values():
+        pd.testing.assert_frame_equal(rda.load_data(f"{csv_folder}/{weather_variable}/join_london.csv"), expected[weather_variable], check_dtype=False)
+
+
+def test_incremental_analysis_same_result_as_full_analysis(csv_folder):
+    weather_df = rda.load_data("tests/csv_files/weather_join.csv")
+    forecast_df = rda.load_data("tests/csv_files/forecast_join.csv")
+    # forecasts made after the last weather record so that all of them are settled
+    later_forecast_df = pd.DataFrame({'temp': [1.0], 'pressure': [1000], 'humidity': [80], 'wind_speed': [1.0], 'wind_deg': [10],
+                                      'dt': [1576000000], 'today': ['2019-12-02']})
+
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        # first run: only the weather records of 2019-11-30 are settled
+        first_day_df = weather_df[weather_df['today'] == '2019-11-30']
+        write_city_files(csv_folder, 'london', first_day_df, pd.concat([forecast_df, later_forecast_df.assign(today='2019-12-01')]))
+        rda.analyse_city_data('london', incremental=True)
+        assert rda.read_watermark('london') == first_day_df['dt'].max()
+
+        # second run: the records of 2019-12-01 are appended
+        write_city_files(csv_folder, 'london', weather_df, pd.concat([forecast_df, later_forecast_df.assign(today='2019-12-01'), later_forecast_df]))
+        with patch.object(rda.storage, 'load', wraps=rda.storage.load) as load_mock:
+            assert rda.analyse_city_data('london', incremental=True) == []
+        assert rda.read_watermark('london') == weather_df['dt'].max()
+        incremental_result = read_all_output_files(csv_folder, 'london')
+
+        # full analysis of the same files
+        rda.analyse_city_data('london')
+        full_result = read_all_output_files(csv_folder, 'london')
+
+    # only the rows after the watermark are loaded, and the end of the join file spanned by the rolling windows
+    loaded_files = {os.path.basename(call.args[0]): call.kwargs['dt_range'] for call in load_mock.call_args_list}
+    assert loaded_files == {'weather_london.csv': (first_day_df['dt'].max() + 1, None),
+                            'forecast_london.csv': (first_day_df['dt'].max() + 1, None),
+                            'join_london.csv': (first_day_df['dt'].max() + 1 - rda.history_seconds(), None)}
+
+    pd.testing.assert_frame_equal(incremental_result['join'], full_result['join'])
+    for weather_variable in rda.config.weather_variables.values():
+        variable_join_df = rda.weather_variable_join(full_result['join'], weather_variable)
+        for key in [weather_variable] + [f"{weather_variable}_{grouping}" for grouping in rda.config.metric_breakdowns]:
+            pd.testing.assert_frame_equal(incremental_result[key].drop(columns='medae'), full_result[key].drop(columns='medae'))
+        # medae is estimated
+        accumulator = ForecastMetricsAccumulator().update(variable_join_df[weather_variable], variable_join_df[rda.TX_HEADERS], variable_join_df['dt'])
+        np.testing.assert_allclose(incremental_result[weather_variable]['medae'], accumulator.finalize()['medae'])
+        # rolling metrics are appended at each run
+        rolling_df = incremental_result[f"{weather_variable}_rolling"].sort_values(['window', 'dt'], ignore_index=True)
+        pd.testing.assert_frame_equal(rolling_df, full_result[f"{weather_variable}_rolling"])
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_incremental_analysis_after_full_analysis(csv_folder, streaming):
+    weather_df = rda.load_data("tests/csv_files/weather_join.csv")
+    forecast_df = rda.load_data("tests/csv_files/forecast_join.csv")
+    later_forecast_df = pd.DataFrame({'temp': [1.0], 'pressure': [1000], 'humidity': [80], 'wind_speed': [1.0], 'wind_deg': [10],
+                                      'dt': [1576000000], 'today': ['2019-12-02']})
+
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        write_city_files(csv_folder, 'london', weather_df, pd.concat([forecast_df, later_forecast_df]))
+        rda.analyse_city_data('london', incremental=True)
+        # the full analysis rewrites the join file
+        if streaming:
+            rda.analyse_city_data_streaming('london')
+        else:
+            rda.analyse_city_data('london')
+        assert rda.read_watermark('london') is None
+        assert not os.path.exists(rda.analysis_state_file_path('london'))
+
+        assert rda.analyse_city_data('london', incremental=True) == []
+        join_df = pd.read_csv(f"{csv_folder}/join_london.csv")
+
+    assert len(join_df) == 13
+    assert join_df['dt'].is_unique
+
+
+def test_incremental_analysis_recalculated_without_state(csv_folder):
+    weather_df = rda.load_data("tests/csv_files/weather_join.csv")
+    forecast_df = rda.load_data("tests/csv_files/forecast_join.csv")
+    later_forecast_df = pd.DataFrame({'temp': [1.0], 'pressure': [1000], 'humidity': [80], 'wind_speed': [1.0], 'wind_deg': [10],
+                                      'dt': [1576000000], 'today': ['2019-12-02']})
+
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        first_day_df = weather_df[weather_df['today'] == '2019-11-30']
+        write_city_files(csv_folder, 'london', first_day_df, pd.concat([forecast_df, later_forecast_df.assign(today='2019-12-01')]))
+        rda.analyse_city_data('london', incremental=True)
+        first_result = read_all_output_files(csv_folder, 'london')
+
+        # e.g. join file built by a version that did not keep the state
+        os.remove(rda.analysis_state_file_path('london'))
+        write_city_files(csv_folder, 'london', weather_df, pd.concat([forecast_df, later_forecast_df.assign(today='2019-12-01'), later_forecast_df]))
+        assert rda.analyse_city_data('london', incremental=True) == []
+        recalculated_result = read_all_output_files(csv_folder, 'london')
+
+        # the state kept this time is used by the next run
+        rda.analyse_city_data('london', incremental=True)
+        assert rda.read_analysis_state('london')['watermark'] == weather_df['dt'].max()
+
+    assert len(recalculated_result['join']) > len(first_result['join'])
+    pd.testing.assert_frame_equal(recalculated_result['temp_rolling'].sort_values(['window', 'dt'], ignore_index=True),
+                                  rda.rolling_precision(rda.weather_variable_join(recalculated_result['join'], 'temp'), 'temp', rda.config.rolling_windows),
+                                  check_dtype=False)
+    assert len(read_all_output_files(csv_folder, 'london')['temp_rolling']) == len(recalculated_result['temp_rolling'])
+
+
+def test_prejoined_analysis_same_result_as_full_analysis(csv_folder):
+    weather_df = rda.load_data("tests/csv_files/weather_join.csv")
+    forecast_df = rda.load_data("tests/csv_files/forecast_join.csv")
+
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        write_city_files(csv_folder, 'london', weather_df, forecast_df)
+        rda.analyse_city_data('london')
+        full_result = read_output_files(csv_folder, 'london')
+
+        # the join of the spiders is used as is, the weather and forecast files are not read
+        os.rename(f"{csv_folder}/join_london.csv", f"{csv_folder}/prejoin_london.csv")
+        os.remove(f"{csv_folder}/weather_london.csv")
+        os.remove(f"{csv_folder}/forecast_london.csv")
+        assert rda.analyse_city_data('london', prejoined=True) == []
+        # the join file of data_analysis is not written
+        assert not os.path.exists(f"{csv_folder}/join_london.csv")
+        os.rename(f"{csv_folder}/prejoin_london.csv", f"{csv_folder}/join_london.csv")
+        prejoined_result = read_output_files(csv_folder, 'london')
+
+    for key, df in full_result.items():
+        pd.testing.assert_frame_equal(prejoined_result[key], df)
+
+
+def test_prejoined_analysis_not_incremental():
+    with pytest.raises(ValueError):
+        rda.analyse_city_data('london', incremental=True, prejoined=True)
+
+
+def test_incremental_analysis_without_segments():
+    with pytest.raises(ValueError):
+        rda.analyse_city_data('london', [(0, 10)], incremental=True)
+
+
+def test_parallel_analysis_same_result_as_serial_analysis(csv_folder):
+    weather_df = rda.load_data("tests/csv_files/weather_join.csv")
+    forecast_df = rda.load_data("tests/csv_files/forecast_join.csv")
+    cities = {city_name: rda.config.cities[city_name] for city_name in ['london', 'madrid', 'tokyo']}
+
+    with patch.object(rda.config, 'csv_folder', csv_folder), patch.object(rda.config, 'cities', cities):
+        write_city_files(csv_folder, 'london', weather_df, forecast_df)
+        write_city_files(csv_folder, 'madrid', weather_df.assign(temp=weather_df['temp'] + 1), forecast_df)
+        # tokyo files are missing
+
+        serial_errors = rda.analyse_data()
+        serial_result = {city_name: read_output_files(csv_folder, city_name) for city_name in ['london', 'madrid']}
+        parallel_errors = rda.analyse_data(workers=2, force=True)
+        parallel_result = {city_name: read_output_files(csv_folder, city_name) for city_name in ['london', 'madrid']}
+
+    assert list(serial_errors) == list(parallel_errors) == ['tokyo']
+    for city_name, city_result in serial_result.items():
+        for key, df in city_result.items():
+            pd.testing.assert_frame_equal(parallel_result[city_name][key], df)
+
+
+def test_rolling_metrics_file(csv_folder):
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        write_city_files(csv_folder, 'london', rda.load_data("tests/csv_files/weather_join.csv"), rda.load_data("tests/csv_files/forecast_join.csv"))
+        rda.analyse_city_data('london')
+
+    rolling_metrics_df = pd.read_csv(f"{csv_folder}/temp/rolling_metrics_london.csv")
+    assert rolling_metrics_df.shape[0] == 13 * len(rda.config.rolling_windows)
+    assert list(rolling_metrics_df.columns[:5]) == ['dt', 'window', 'count', 'mae_t5', 'mae_t4']
+    # the last window of 7 days contains all the data points
+    last_row = rolling_metrics_df[rolling_metrics_df['window'] == 7].iloc[-1]
+    metrics_df = pd.read_csv(f"{csv_folder}/temp/metrics_london.csv")
+    np.testing.assert_allclose(last_row[['mae_t5', 'mae_t4', 'mae_t3', 'mae_t2', 'mae_t1']].to_numpy(dtype=float), metrics_df['mae'])
+
+
+def test_forecast_precision_by_hour_same_result_as_forecast_precision_of_each_hour():
+    joined_data = synthetic_join(400)
+
+    result = rda.forecast_precision_by_group(joined_data, 'temp', 'hour')
+
+    assert list(result.columns) == ['hour', 'tx', 'mae', 'rmse', 'medae', 'mase']
+    assert result.shape[0] == 8 * 5
+    for hour in [0, 9, 21]:
+        expected = rda.forecast_precision(joined_data[pd.to_datetime(joined_data['dt'], unit='s').dt.hour == hour], 'temp')
+        hour_result = result[result['hour'] == hour]
+        assert list(hour_result['tx']) == ['t5', 't4', 't3', 't2', 't1']
+        for metric in ['mae', 'rmse', 'medae']:
+            np.testing.assert_allclose(hour_result[metric], expected[metric])
+
+
+def test_forecast_precision_by_single_group_same_result_as_forecast_precision():
+    joined_data = synthetic_join(400)
+
+    result = rda.forecast_precision_by_group(joined_data, 'temp', np.zeros(len(joined_data)))
+    expected = rda.forecast_precision(joined_data, 'temp')
+
+    for metric in ['mae', 'rmse', 'medae', 'mase']:
+        np.testing.assert_allclose(result[metric], expected[metric])
+
+
+def test_select_intervals_union_of_segments():
+    joined_data = synthetic_join(100)
+
+    result = rda.select_intervals(joined_data, [(10, 20), (50, 55), (15, 25)])
+
+    assert list(result.index) == list(range(10, 25)) + list(range(50, 55))
+    assert rda.select_intervals(joined_data, []).equals(joined_data)
+
+
+def test_datetime_segment_same_rows_as_row_segment():
+    joined_data = synthetic_join(100)
+
+    # both ends of a datetime segment are included
+    mask = rda.segment_mask(joined_data, ('2019-11-30T06:00:00+00:00', '2019-12-01T00:00:00'))
+
+    assert (mask == rda.segment_mask(joined_data, (2, 9))).all()
+
+
+def test_segments_of_data_point_gaps(csv_folder):
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        write_city_files(csv_folder, 'london', rda.load_data("tests/csv_files/weather_join.csv"), rda.load_data("tests/csv_files/forecast_join.csv"))
+        rda.analyse_city_data('london')
+        intervals = rde.data_point_gaps(rda.config.cities['london'], 'temp')
+        joined_data = rde.load_join_file(rda.config.cities['london'], 'temp')
+
+    # 3 gaps of one missing data point
+    assert [(first_row, last_row) for first_row, _, last_row, _ in intervals] == [(0, 2), (3, 5), (6, 6), (7, 12)]
+    result = rda.segment_precision(joined_data, 'temp', rda.gap_free_segments(intervals))
+    # the last row of every interval is included
+    assert list(result[result['tx'] == 't1']['count']) == [3, 3, 1, 6, 13]
+    # same rows as the datetime segments of the intervals
+    for (first_row, first_dt, last_row, last_dt), segment in zip(intervals, rda.gap_free_segments(intervals)):
+        assert (rda.segment_mask(joined_data, segment) == rda.segment_mask(joined_data, (first_dt, last_dt))).all()
+
+
+def test_segment_precision_same_result_as_forecast_precision_of_each_segment():
+    joined_data = synthetic_join(400)
+    segments = [(0, 100), (300, 400)]
+
+    result = rda.segment_precision(joined_data, 'temp', segments)
+
+    assert list(result['segment'].unique()) == ['0:100', '300:400', 'union']
+    for label, selected_df in [('0:100', joined_data.iloc[0:100]), ('300:400', joined_data.iloc[300:400]),
+                               ('union', rda.select_intervals(joined_data, segments))]:
+        segment_result = result[result['segment'] == label]
+        expected = rda.forecast_precision(selected_df, 'temp')
+        assert (segment_result['count'] == selected_df.shape[0]).all()
+        for metric in ['mae', 'rmse', 'medae']:
+            np.testing.assert_allclose(segment_result[metric], expected[metric])
+
+
+def test_analyse_city_segments_does_not_rewrite_join(csv_folder):
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        write_city_files(csv_folder, 'london', rda.load_data("tests/csv_files/weather_join.csv"), rda.load_data("tests/csv_files/forecast_join.csv"))
+        rda.analyse_city_data('london')
+        with open(f"{csv_folder}/join_london.csv", encoding="utf-8") as join_file:
+            join_content = join_file.read()
+
+        errors = rda.analyse_city_segments('london', [(0, 5), ('2019-11-30T18:00:00', '2019-12-01T21:00:00')])
+
+        with open(f"{csv_folder}/join_london.csv", encoding="utf-8") as join_file:
+            assert join_file.read() == join_content
+
+    assert errors == []
+    segments_df = pd.read_csv(f"{csv_folder}/temp/metrics_segments_london.csv")
+    assert list(segments_df['segment'].unique()) == ['0:5', '2019-11-30T18:00:00:2019-12-01T21:00:00', 'union']
+    # the whole join is the union of the segments
+    metrics_df = pd.read_csv(f"{csv_folder}/temp/metrics_london.csv")
+    np.testing.assert_allclose(segments_df[segments_df['segment'] == 'union']['mae'], metrics_df['mae'])
+
+
+def spider_files(folder, city_name, days, seed=0):
+    """Weather and forecast files as written by the spiders: 5 forecasts of each dt recorded over the 5 previous days"""
+    rng = np.random.default_rng(seed)
+    dts = 1575072000 + 3 * 3600 * np.arange(days * 8)
+    weather_df = pd.DataFrame({'temp': rng.normal(10, 3, len(dts)).round(2), 'pressure': rng.integers(980, 1040, len(dts)),
+                               'humidity': rng.integers(20, 100, len(dts)), 'wind_speed': rng.gamma(2, 2, len(dts)).round(2),
+                               'wind_deg': rng.integers(0, 360, len(dts)), 'dt': dts,
+                               'today': pd.to_datetime(dts, unit='s').strftime('%Y-%m-%d')})
+    # forecast of each day: dts of the 5 following days
+    forecast_dfs = []
+    for day in range(-5, days):
+        day_dts = dts[(dts >= 1575072000 + (day + 1) * 86400) & (dts < 1575072000 + (day + 6) * 86400)]
+        forecast_dfs.append(weather_df.set_index('dt').loc[day_dts].reset_index()
+                            .assign(temp=lambda df: (df['temp'] + rng.normal(0, 2, len(df))).round(2),
+                                    today=pd.Timestamp(1575072000 + day * 86400, unit='s').strftime('%Y-%m-%d')))
+    forecast_df = pd.concat(forecast_dfs, ignore_index=True)
+    # a forecast that was not recorded
+    forecast_df = forecast_df.drop(100)
+    # the weather spider writes the normalised dts as floats
+    write_city_files(folder, city_name, weather_df.assign(dt=weather_df['dt'].astype(float)), forecast_df[weather_df.columns])
+
+
+def test_analysis_cache(csv_folder):
+    weather_df = rda.load_data("tests/csv_files/weather_join.csv")
+    forecast_df = rda.load_data("tests/csv_files/forecast_join.csv")
+    cities = {city_name: rda.config.cities[city_name] for city_name in ['london', 'madrid', 'tokyo']}
+
+    with patch.object(rda.config, 'csv_folder', csv_folder), patch.object(rda.config, 'cities', cities):
+        write_city_files(csv_folder, 'london', weather_df, forecast_df)
+        write_city_files(csv_folder, 'madrid', weather_df, forecast_df)
+        # tokyo files are missing
+        rda.analyse_data()
+
+        with patch.object(rda, 'analyse_city_data', return_value=[]) as analyse_city_data:
+            # nothing changed
+            rda.analyse_data()
+            assert [call.args[0] for call in analyse_city_data.call_args_list] == ['tokyo']
+
+            # new data for madrid
+            analyse_city_data.reset_mock()
+            forecast_df.iloc[:1].to_csv(f"{csv_folder}/forecast_madrid.csv", mode='a', header=False, index=False)
+            rda.analyse_data()
+            assert [call.args[0] for call in analyse_city_data.call_args_list] == ['madrid', 'tokyo']
+
+            # other options
+            analyse_city_data.reset_mock()
+            rda.analyse_data(export_variable_joins=True)
+            assert [call.args[0] for call in analyse_city_data.call_args_list] == ['london', 'madrid', 'tokyo']
+
+            # output file removed
+            analyse_city_data.reset_mock()
+            os.remove(f"{csv_folder}/temp/metrics_london.csv")
+            rda.analyse_data(export_variable_joins=True)
+            assert [call.args[0] for call in analyse_city_data.call_args_list] == ['london', 'tokyo']
+
+            analyse_city_data.reset_mock()
+            rda.analyse_data(export_variable_joins=True, force=True)
+            assert [call.args[0] for call in analyse_city_data.call_args_list] == ['london', 'madrid', 'tokyo']
+
+
+def test_streaming_analysis_same_result_as_in_memory_analysis(csv_folder):
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        spider_files(csv_folder, 'london', days=60)
+        rda.analyse_city_data('london')
+        expected = read_output_files(csv_folder, 'london')
+
+        # chunks of 1 KiB, i.e. about 20 rows of the weather file
+        with patch.object(rda.config, 'streaming_memory_cap', rda.STREAMING_CHUNKS * 2 ** 10), \
+                patch.object(rda.storage, 'iter_csv', wraps=rda.storage.iter_csv) as iter_csv_mock:
+            errors = rda.analyse_city_data_streaming('london', export_variable_joins=True)
+            assert iter_csv_mock.call_args_list[0].args[1] == 2 ** 10
+        result = read_output_files(csv_folder, 'london')
+
+    assert errors == []
+    pd.testing.assert_frame_equal(result['join'], expected['join'])
+    # all dts but the one with a missing forecast
+    assert expected['join'].shape[0] == 60 * 8 - 1
+    for weather_variable in rda.config.weather_variables.values():
+        pd.testing.assert_frame_equal(result[weather_variable].drop(columns='medae'), expected[weather_variable].drop(columns='medae'))
+        np.testing.assert_allclose(result[weather_variable]['medae'], expected[weather_variable]['medae'], rtol=0.02)
+        pd.testing.assert_frame_equal(rda.load_data(f"{csv_folder}/{weather_variable}/join_london.csv"),
+                                      rda.weather_variable_join(rda.load_data(f"{csv_folder}/join_london.csv"), weather_variable))
+        # the rolling metrics and breakdowns of the in-memory analysis are not current anymore
+        assert not os.path.exists(f"{csv_folder}/{weather_variable}/rolling_metrics_london.csv")
+        for grouping in rda.config.metric_breakdowns:
+            assert not os.path.exists(f"{csv_folder}/{weather_variable}/metrics_{grouping}_london.csv")
+
+
+@contextmanager
+def peak_memory():
+    """Peak memory allocated by python and pyarrow while running the block, stored in the yielded list"""
+    result = []
+    default_pool = pa.default_memory_pool()
+    arrow_pool = pa.proxy_memory_pool(default_pool)
+    pa.set_memory_pool(arrow_pool)
+    tracemalloc.start()
+    try:
+        yield result
+        result.append(tracemalloc.get_traced_memory()[1] + arrow_pool.max_memory())
+    finally:
+        tracemalloc.stop()
+        pa.set_memory_pool(default_pool)
+
+
+def test_streaming_analysis_memory_under_cap(csv_folder):
+    memory_cap = 8 * 2 ** 20
+    with patch.object(rda.config, 'csv_folder', csv_folder), patch.object(rda.config, 'streaming_memory_cap', memory_cap):
+        spider_files(csv_folder, 'london', days=1000)
+        with peak_memory() as in_memory_peak:
+            rda.join_city_data('london', f"{csv_folder}/weather_london.csv", f"{csv_folder}/forecast_london.csv",
+                               f"{csv_folder}/join_london.csv", False)
+        with peak_memory() as streaming_peak:
+            errors = rda.analyse_city_data_streaming('london')
+
+    assert errors == []
+    assert in_memory_peak[0] > 2 * memory_cap
+    assert streaming_peak[0] < memory_cap
+
+
+def test_streaming_analysis_without_segments():
+    with pytest.raises(ValueError):
+        rda.analyse_data([(0, 10)], streaming=True)
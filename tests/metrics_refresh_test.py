@@ -0,0 +1,84 @@
+import os
+from unittest.mock import patch
+import numpy as np
+import pandas as pd
+import roboclimate.data_analysis as rda
+from roboclimate.metrics import ForecastMetricsAccumulator
+import roboclimate.metrics_refresh as refresh
+
+
+def join_df():
+    return rda.join_weather_and_forecast(rda.load_data("tests/csv_files/weather_join.csv"), rda.load_data("tests/csv_files/forecast_join.csv"))
+
+
+def read_metrics(folder, city_name):
+    return {weather_variable: pd.read_csv(f"{folder}/{weather_variable}/prejoin_metrics_{city_name}.csv")
+            for weather_variable in rda.config.weather_variables.values()}
+
+
+def assert_metrics(metrics, df):
+    for weather_variable, metrics_df in metrics.items():
+        variable_join_df = rda.weather_variable_join(df, weather_variable)
+        expected = rda.forecast_precision(variable_join_df, weather_variable)
+        for metric in ['mae', 'rmse', 'mase']:
+            np.testing.assert_allclose(metrics_df[metric], expected[metric], rtol=1e-6)
+        # medae is estimated, the same way as when the whole join is accumulated at once
+        accumulator = ForecastMetricsAccumulator().update(variable_join_df[weather_variable], variable_join_df[rda.TX_HEADERS], variable_join_df['dt'])
+        np.testing.assert_allclose(metrics_df['medae'], accumulator.finalize()['medae'])
+
+
+def test_refresh_appended_rows(csv_folder):
+    df = join_df()
+    join_file = f"{csv_folder}/prejoin_london.csv"
+
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        df.iloc[:10].to_csv(join_file, index=False)
+        assert refresh.refresh_city('london') == 10
+        assert_metrics(read_metrics(csv_folder, 'london'), df.iloc[:10])
+
+        df.iloc[10:].to_csv(join_file, mode='a', header=False, index=False)
+        assert refresh.refresh_city('london') == len(df) - 10
+        assert refresh.refresh_city('london') == 0
+
+    assert_metrics(read_metrics(csv_folder, 'london'), df)
+    # the metrics files of data_analysis are not written
+    assert not any(os.path.exists(f"{csv_folder}/{weather_variable}/metrics_london.csv") for weather_variable in rda.config.weather_variables.values())
+
+
+def test_refresh_ignores_incomplete_row(csv_folder):
+    df = join_df()
+    join_file = f"{csv_folder}/prejoin_london.csv"
+
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        df.iloc[:10].to_csv(join_file, index=False)
+        last_row = df.iloc[10:11].to_csv(header=False, index=False)
+        with open(join_file, 'a', encoding='utf-8') as f:
+            f.write(last_row[:10])
+        assert refresh.refresh_city('london') == 10
+
+        with open(join_file, 'a', encoding='utf-8') as f:
+            f.write(last_row[10:])
+        assert refresh.refresh_city('london') == 1
+
+    assert_metrics(read_metrics(csv_folder, 'london'), df.iloc[:11])
+
+
+def test_refresh_replaced_join_file(csv_folder):
+    df = join_df()
+    join_file = f"{csv_folder}/prejoin_london.csv"
+
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        df.iloc[:10].to_csv(join_file, index=False)
+        refresh.refresh_city('london')
+
+        # e.g. restored from a backup
+        df.iloc[5:].to_csv(join_file, index=False)
+        assert refresh.refresh_city('london') == len(df) - 5
+
+    assert_metrics(read_metrics(csv_folder, 'london'), df.iloc[5:])
+
+
+def test_refresh_without_join_file(csv_folder):
+    with patch.object(rda.config, 'csv_folder', csv_folder):
+        assert refresh.refresh_city('london') == 0
+        assert not os.path.exists(refresh.state_file_path('london'))
@@ -1,9 +1,12 @@
+import json
 import pandas as pd
 import numpy as np
+import pytest
 from roboclimate.metrics import mean_absolute_scaled_error_tx as masetx, mean_absolute_scaled_error_1year as mase1y
 from roboclimate.config import day_factor
 import roboclimate.metrics as rmet
 import roboclimate.util as rutil
+from tests.conftest import synthetic_join
 
 
 def test_mase():
@@ -69,6 +72,184 @@ def test_mase_non_consecutive_values():
                                 't2': [1, 5, 1, 5, 1, 5, 1, 5, 1] + [1] * day_factor,
                                 't1': [1.0, 3, 1.0, 3, 1.0, 3, 1.0, 3, 1.0] + [1.0] * day_factor})
     
-    np.testing.assert_allclose(masetx(joined_data, 'temp'), [np.nan, np.nan, np.nan, np.nan, 2.6666666])
+    # prior periods are found by timestamp: 1574899200 (2019-11-28 00:00) is the prior period of
+    # 1575158400 (2019-12-01 00:00) for t3 and of 1575244800 (2019-12-02 00:00) for t4
+    np.testing.assert_allclose(masetx(joined_data, 'temp'), [np.nan, 1, 2, np.nan, 2.6666666])
 
 
+def test_mase_prior_period_found_by_timestamp():
+    """
+    dts are 0h, 3h, 6h, 12h, so there is a gap at 9h
+
+    with period=2, 12h must be compared with 6h (and not with 3h, that is 2 positions before), and 6h with 0h
+    """
+    real_data = [1, 2, 4, 8]
+    dts = [1575072000, 1575082800, 1575093600, 1575115200]
+
+    assert rmet.mean_absolute_scaled_error(real_data, [2, 2, 5, 10], dts, period=2) == (1 + 2) / (3 + 4)
+    assert rmet.mean_absolute_scaled_error(real_data, [2, 2, 5, 10], dts, period=8) is np.nan
+
+
+def test_prior_period_positions():
+    dts = [300, 100, 400, 200]
+    np.testing.assert_array_equal(rmet.prior_period_positions(dts, 100), [3, -1, 0, 1])
+
+
+
+
+def test_forecast_metrics_same_result_as_per_model_calculation():
+    from sklearn.metrics import mean_absolute_error, mean_squared_error, median_absolute_error
+    joined_data = synthetic_join(200, gaps=(10, 11, 50, 120))
+    tees = [f't{i}' for i in range(5, 0, -1)]
+
+    result = rmet.forecast_metrics(joined_data['temp'], joined_data[tees], joined_data['dt'])
+
+    np.testing.assert_allclose(result['mae'], [mean_absolute_error(joined_data['temp'], joined_data[tx]) for tx in tees])
+    np.testing.assert_allclose(result['rmse'], [np.sqrt(mean_squared_error(joined_data['temp'], joined_data[tx])) for tx in tees])
+    np.testing.assert_allclose(result['medae'], [median_absolute_error(joined_data['temp'], joined_data[tx]) for tx in tees])
+    np.testing.assert_allclose(result['mase'], masetx(joined_data, 'temp'))
+
+
+def accumulate(joined_data, accumulator=None):
+    accumulator = accumulator if accumulator else rmet.ForecastMetricsAccumulator()
+    return accumulator.update(joined_data['temp'], joined_data[['t5', 't4', 't3', 't2', 't1']], joined_data['dt'])
+
+
+def assert_same_metrics(result, expected, relative_accuracy=0.01):
+    np.testing.assert_allclose(result['mae'], expected['mae'])
+    np.testing.assert_allclose(result['rmse'], expected['rmse'])
+    np.testing.assert_allclose(result['mase'], expected['mase'])
+    # medae is an estimation
+    np.testing.assert_allclose(result['medae'], expected['medae'], rtol=2 * relative_accuracy)
+
+
+def test_accumulator_updated_in_batches_same_result_as_forecast_metrics():
+    joined_data = synthetic_join(400, gaps=(10, 11, 50, 120, 121, 122, 300))
+    expected = rmet.forecast_metrics(joined_data['temp'], joined_data[['t5', 't4', 't3', 't2', 't1']], joined_data['dt'])
+
+    accumulator = rmet.ForecastMetricsAccumulator()
+    for i in range(0, len(joined_data), 7):
+        accumulate(joined_data.iloc[i:i + 7], accumulator)
+
+    assert_same_metrics(accumulator.finalize(), expected)
+
+
+def test_merged_accumulators_same_result_as_forecast_metrics():
+    joined_data = synthetic_join(400, gaps=(10, 11, 50, 120, 121, 122, 300))
+    expected = rmet.forecast_metrics(joined_data['temp'], joined_data[['t5', 't4', 't3', 't2', 't1']], joined_data['dt'])
+    shards = [accumulate(joined_data.iloc[start:end]) for start, end in [(0, 20), (20, 35), (35, 200), (200, 400)]]
+
+    # earlier shards can be merged into later ones and vice versa
+    result = shards[2].merge(shards[3]).merge(shards[0].merge(shards[1])).finalize()
+
+    assert_same_metrics(result, expected)
+
+
+def test_overlapping_accumulators_cannot_be_merged():
+    joined_data = synthetic_join(100)
+    with pytest.raises(ValueError):
+        accumulate(joined_data.iloc[0:60]).merge(accumulate(joined_data.iloc[50:100]))
+
+
+def test_accumulator_saved_to_disk(tmp_path):
+    joined_data = synthetic_join(200, gaps=(50,))
+    accumulator = accumulate(joined_data.iloc[:100])
+    accumulator.save(tmp_path / "accumulator.json")
+
+    loaded_accumulator = accumulate(joined_data.iloc[100:], rmet.ForecastMetricsAccumulator.load(tmp_path / "accumulator.json"))
+
+    assert loaded_accumulator.finalize() == accumulate(joined_data.iloc[100:], accumulator).finalize()
+
+
+def test_grouped_accumulator_updated_in_batches_same_result_as_metrics_of_each_group():
+    joined_data = synthetic_join(400, gaps=(10, 11, 50, 120, 121, 122, 300))
+    real_data = joined_data['temp'].to_numpy(dtype=np.float64)
+    errors = np.abs(real_data[:, np.newaxis] - joined_data[['t5', 't4', 't3', 't2', 't1']].to_numpy(dtype=np.float64))
+    scaled_errors, naive_errors = rmet.naive_forecast_errors(real_data, errors, joined_data['dt'].to_numpy())
+    groups = np.arange(len(joined_data)) % 3
+
+    accumulator = rmet.GroupedMetricsAccumulator()
+    for i in range(0, len(joined_data), 7):
+        accumulator.update(groups[i:i + 7], errors[i:i + 7], scaled_errors[i:i + 7], naive_errors[i:i + 7])
+        # the state is kept as JSON between batches
+        accumulator = rmet.GroupedMetricsAccumulator.from_dict(json.loads(json.dumps(accumulator.to_dict())))
+
+    result = accumulator.finalize()
+    assert list(result) == [0, 1, 2]
+    for group, metrics in result.items():
+        in_group = groups == group
+        assert_same_metrics(metrics, {'mae': errors[in_group].mean(axis=0), 'rmse': np.sqrt((errors[in_group] ** 2).mean(axis=0)),
+                                      'medae': np.median(errors[in_group], axis=0),
+                                      'mase': scaled_errors[in_group].sum(axis=0) / naive_errors[in_group].sum(axis=0)})
+
+
+def test_quantile_sketch():
+    values = np.random.default_rng(0).exponential(2, 10001)
+    sketch = rmet.QuantileSketch(relative_accuracy=0.01).update(values[:5000]).merge(rmet.QuantileSketch(relative_accuracy=0.01).update(values[5000:]))
+
+    for q in [0.1, 0.5, 0.9]:
+        np.testing.assert_allclose(sketch.quantile(q), np.quantile(values, q), rtol=0.02)
+
+
+def test_rolling_forecast_metrics_same_result_as_metrics_of_each_window():
+    joined_data = synthetic_join(200, gaps=(10, 11, 50, 120, 121, 122))
+    tees = ['t5', 't4', 't3', 't2', 't1']
+    window_in_seconds = 2 * 24 * 60 * 60
+
+    result = rmet.rolling_forecast_metrics(joined_data['temp'], joined_data[tees], joined_data['dt'], 2)
+
+    for k in [0, 5, 15, 16, 60, 130, len(joined_data) - 1]:
+        window_data = joined_data[(joined_data['dt'] > joined_data['dt'][k] - window_in_seconds) & (joined_data['dt'] <= joined_data['dt'][k])]
+        expected = rmet.forecast_metrics(window_data['temp'], window_data[tees], window_data['dt'])
+        assert result['count'][k] == len(window_data)
+        np.testing.assert_allclose(result['mae'][k], expected['mae'])
+        np.testing.assert_allclose(result['rmse'][k], expected['rmse'])
+
+
+def test_rolling_mase_over_whole_series_same_result_as_forecast_metrics():
+    joined_data = synthetic_join(200, gaps=(10, 11, 50, 120, 121, 122))
+    tees = ['t5', 't4', 't3', 't2', 't1']
+
+    result = rmet.rolling_forecast_metrics(joined_data['temp'], joined_data[tees], joined_data['dt'], 365)
+
+    np.testing.assert_allclose(result['mase'][-1], rmet.forecast_metrics(joined_data['temp'], joined_data[tees], joined_data['dt'])['mase'])
+    assert np.isnan(result['mase'][0]).all()
+
+
+def test_years_ago_positions():
+    dts = [int(pd.Timestamp(iso, tz='UTC').timestamp()) for iso in
+           ['2020-02-28T21:00', '2020-03-01T00:00', '2021-02-28T21:00', '2021-03-01T00:00', '2020-02-29T12:00', '2021-06-01T00:00']]
+
+    # 29 February and the dts whose prior year is missing are not matched
+    assert list(rmet.years_ago_positions(dts)) == [-1, -1, 0, 1, -1, -1]
+
+
+def test_mase_1year_same_result_as_matching_by_datetime():
+    from datetime import datetime, timezone
+    joined_data = synthetic_join(3 * 365 * 8, gaps=set(range(1000, 1100)) | {5000, 7000})
+    position = {dt: i for i, dt in enumerate(joined_data['dt'])}
+    matches = []
+    for i, dt in enumerate(joined_data['dt']):
+        prior_datetime = rutil.one_year_ago(datetime.fromtimestamp(dt, tz=timezone.utc))
+        if prior_datetime is not None and int(prior_datetime.timestamp()) in position:
+            matches.append((i, position[int(prior_datetime.timestamp())]))
+    current, prior = np.array(matches).T
+    naive_error = np.abs(joined_data['temp'].to_numpy()[current] - joined_data['temp'].to_numpy()[prior]).sum()
+    expected = [np.abs(joined_data['temp'] - joined_data[f't{i}']).to_numpy()[current].sum() / naive_error for i in range(5, 0, -1)]
+
+    np.testing.assert_allclose(mase1y(joined_data, 'temp'), expected)
+
+
+def test_mase_1year_without_prior_year():
+    assert np.isnan(mase1y(synthetic_join(100), 'temp')).all()
+
+
+def test_mase_year_avg():
+    historical_data = rutil.read_historical_data("tests/csv_files/historical_data_year_avg.csv", cache=False)
+    # 2019-11-30T03:00:00 has historical data (average 4), 2019-11-30T06:00:00 has not
+    joined_data = pd.DataFrame({'temp': [6, 1], 'dt': [1575082800, 1575093600], 'today': ['2019-11-30'] * 2,
+                                't5': [5, 9], 't4': [4, 9], 't3': [8, 9], 't2': [6, 9], 't1': [7, 9]})
+
+    result = rmet.mean_absolute_scaled_error_year_avg(joined_data, historical_data, 'temp')
+
+    assert result == [0.5, 1, 1, 0, 0.5]
@@ -0,0 +1,184 @@
+import os
+import shutil
+from unittest.mock import patch
+import numpy as np
+import pandas as pd
+import pytest
+import roboclimate.storage as rstore
+import roboclimate.data_analysis as rda
+import roboclimate.data_explorer as rde
+
+
+def forecast_file(folder, city_name='london'):
+    """Forecast file spanning several years"""
+    forecast_df = pd.read_csv("tests/csv_files/forecast_join.csv")
+    shifted_df = forecast_df.assign(dt=forecast_df['dt'] + 365 * 24 * 3600, today=forecast_df['today'].str.replace('2019', '2020'))
+    file = f"{folder}/forecast_{city_name}.csv"
+    pd.concat([forecast_df, shifted_df]).to_csv(file, index=False)
+    return file
+
+
+def test_mirror_path():
+    assert rstore.mirror_path("data/weather_london.csv") == os.path.join("data", "parquet", "weather", "city=london")
+
+
+def test_mirror_partitioned_by_year(csv_folder):
+    file = forecast_file(csv_folder)
+
+    assert rstore.write_mirror(file)
+
+    mirror_folder = rstore.mirror_path(file)
+    assert sorted(folder for folder in os.listdir(mirror_folder) if folder.startswith('year=')) == ['year=2019', 'year=2020']
+    assert rstore.is_fresh(file)
+
+
+def test_mirror_same_data_as_csv_file(csv_folder):
+    file = forecast_file(csv_folder)
+    expected = rstore.read_csv(file)
+    rstore.write_mirror(file)
+
+    with patch.object(rstore, 'read_csv_table', side_effect=AssertionError("csv file read")):
+        result = rstore.load(file)
+
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_loaded_with_compact_dtypes(csv_folder):
+    file = forecast_file(csv_folder)
+    pandas_df = pd.read_csv(file)
+
+    result = rstore.load(file)
+
+    assert result.dtypes.to_dict() == {column: np.dtype(rstore.config.column_dtypes[column]) for column in pandas_df.columns}
+    assert (result['today'] == pd.to_datetime(pandas_df['today'])).all()
+    pd.testing.assert_frame_equal(result.drop(columns='today'), pandas_df.drop(columns='today'), check_dtype=False, rtol=1e-6)
+    assert pandas_df.memory_usage(deep=True).sum() / result.memory_usage(deep=True).sum() > 3
+
+
+@pytest.mark.parametrize("mirrored", [False, True])
+def test_load_columns_and_dt_range(csv_folder, mirrored):
+    file = forecast_file(csv_folder)
+    expected = pd.read_csv(file, dtype={'dt': 'int64'})
+    if mirrored:
+        rstore.write_mirror(file)
+    start, end = expected['dt'].iloc[[3, -5]]
+
+    result = rstore.load(file, columns=['dt', 'pressure'], dt_range=(start, end))
+
+    expected = expected[(expected['dt'] >= start) & (expected['dt'] < end)][['dt', 'pressure']].reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_stale_mirror_refreshed_with_appended_rows(csv_folder):
+    file = forecast_file(csv_folder)
+    rstore.write_mirror(file)
+    partition_2019 = rstore.partition_path(file, 2019)
+    mtime_2019 = os.stat(partition_2019).st_mtime_ns
+
+    with open(file, 'a', encoding="utf-8") as f:
+        f.write("1.0,1000,80,1.0,10,1606780800,2020-11-30\n1.0,1000,80,1.0,10,1700000000,2023-11-14\n")
+    assert not rstore.is_fresh(file)
+
+    result = rstore.load(file)
+
+    assert rstore.is_fresh(file)
+    pd.testing.assert_frame_equal(result.sort_values('dt', ignore_index=True), rstore.read_csv(file).sort_values('dt', ignore_index=True))
+    # only the partitions of the years of the appended rows are rewritten
+    assert os.stat(partition_2019).st_mtime_ns == mtime_2019
+    assert os.path.exists(rstore.partition_path(file, 2023))
+
+
+def test_stale_mirror_with_incomplete_row(csv_folder):
+    file = forecast_file(csv_folder)
+    rstore.write_mirror(file)
+
+    with open(file, 'a', encoding="utf-8") as f:
+        f.write("1.0,1000,80,1.0,10,1606780800,2020-11-30\n1.0,1000,8")
+
+    # the last row is left out until it is complete
+    assert rstore.load(file)['dt'].iloc[-1] == 1606780800
+    assert not rstore.is_fresh(file)
+
+    with open(file, 'a', encoding="utf-8") as f:
+        f.write("0,1.0,10,1700000000,2023-11-14\n")
+
+    assert rstore.load(file)['dt'].max() == 1700000000
+    assert rstore.is_fresh(file)
+    assert len(rstore.read_mirror(file)) == len(rstore.read_csv(file))
+
+
+def test_rewritten_csv_file_mirror_rebuilt(csv_folder):
+    file = forecast_file(csv_folder)
+    rstore.write_mirror(file)
+
+    pd.read_csv("tests/csv_files/forecast_join.csv").iloc[:10].to_csv(file, index=False)
+
+    result = rstore.load(file)
+
+    assert rstore.is_fresh(file)
+    assert len(result) == 10
+    assert sorted(folder for folder in os.listdir(rstore.mirror_path(file)) if folder.startswith('year=')) == ['year=2019']
+
+
+def test_empty_csv_file_not_mirrored(csv_folder):
+    file = f"{csv_folder}/weather_london.csv"
+    pd.DataFrame(columns=['temp', 'dt', 'today']).to_csv(file, index=False)
+
+    assert not rstore.write_mirror(file)
+    assert rstore.load(file).empty
+
+
+def test_analysis_from_mirror_same_result_as_from_csv_files(csv_folder):
+    with patch.object(rstore.config, 'csv_folder', csv_folder), patch.object(rstore.config, 'cities', {'london': rstore.config.cities['london']}):
+        rda.load_data("tests/csv_files/weather_join.csv").to_csv(f"{csv_folder}/weather_london.csv", index=False)
+        rda.load_data("tests/csv_files/forecast_join.csv").to_csv(f"{csv_folder}/forecast_london.csv", index=False)
+        rda.analyse_city_data('london')
+        expected = rde.load_join_file(rstore.config.cities['london'], 'temp')
+
+        rstore.convert(['weather', 'forecast', 'join'])
+        assert rstore.is_fresh(f"{csv_folder}/join_london.csv")
+        result = rde.load_join_file(rstore.config.cities['london'], 'temp')
+
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-6)
+
+
+def test_dts_written_as_floats_by_the_weather_spider(csv_folder):
+    # the weather spider writes the normalised dts as floats
+    file = f"{csv_folder}/weather_london.csv"
+    shutil.copy("tests/csv_files/weather_spider.csv", file)
+    expected_dts = [1575061200, 1575072000, 1575082800]
+
+    df = rda.load_data(file)
+    assert df['dt'].dtype == 'int64'
+    assert df['dt'].tolist() == expected_dts
+    assert np.isnan(df['wind_deg'].iloc[1])
+    assert pd.concat(rstore.iter_csv(file, 2 ** 10))['dt'].tolist() == expected_dts
+
+    assert rstore.write_mirror(file)
+    mirrored_df = rstore.load(file, dt_range=(1575072000, 1575082801))
+    assert mirrored_df['dt'].dtype == 'int64'
+    assert mirrored_df['dt'].tolist() == expected_dts[1:]
+
+
+def test_read_appended_rows(csv_folder):
+    file = f"{csv_folder}/join_london.csv"
+    # the end of the content read may split a multibyte character
+    first_rows = "city,dt\n" + "".join(f"Málaga,{dt}\n" for dt in range(100))
+    with open(file, 'w', encoding="utf-8") as f:
+        f.write(first_rows + "Má")
+
+    appended_rows = rstore.read_appended_rows(file)
+    assert appended_rows.header == b"city,dt\n"
+    assert appended_rows.rows == first_rows.encode("utf-8")[len("city,dt\n"):]
+    assert appended_rows.offset == len(first_rows.encode("utf-8"))
+
+    with open(file, 'a', encoding="utf-8") as f:
+        f.write("laga,100\n")
+    for offset in range(appended_rows.offset - rstore.CHECK_BYTES - 10, appended_rows.offset):
+        check = rstore.tail_check(first_rows.encode("utf-8")[:offset])
+        assert rstore.read_appended_rows(file, offset, check).rows.endswith("Málaga,100\n".encode("utf-8"))
+
+    # rewritten file
+    with open(file, 'w', encoding="utf-8") as f:
+        f.write("city,dt\n" + "".join(f"Madrid,{dt}\n" for dt in range(100)))
+    assert rstore.read_appended_rows(file, appended_rows.offset, appended_rows.check) is None
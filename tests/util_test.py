@@ -50,15 +50,16 @@ def test_remove_29_feb():
 
 
 def test_read_historical_data():
-    result = rutil.read_historical_data("tests/csv_files/historical_data.csv")
+    result = rutil.read_historical_data("tests/csv_files/historical_data.csv", cache=False)
 
     assert result.shape[0] == 2
     assert result.iloc[0].temp == 3
     assert result.iloc[1].temp == 5
+    assert not os.path.exists(rutil.historical_data_cache_path("tests/csv_files/historical_data.csv"))
 
 
 def test_remove_duplicates_from_historical_data():
-    historical_data = rutil.read_historical_data("tests/csv_files/historical_data_duplicates.csv")
+    historical_data = rutil.read_historical_data("tests/csv_files/historical_data_duplicates.csv", cache=False)
 
     assert historical_data.shape[0] == 1
     assert historical_data.iloc[0].temp == 3
@@ -81,3 +82,41 @@ def test_init(csv_folder):
     with open(f"{csv_folder}/forecast_madrid.csv") as f:
         assert f.readline() == "field1,field2\n"
 
+
+
+def test_remove_29_feb_in_utc():
+    # 2020-02-29T23:00:00 UTC is 1 March in time zones east of UTC
+    df = pd.DataFrame({'temp': [1, 2, 3], 'dt': [1582930800, 1583017200, 1583020800]})
+
+    df_without_29_feb = rutil.remove_29_feb(df)
+    assert list(df_without_29_feb['dt']) == [1582930800, 1583020800]
+
+
+def test_historical_data_cached_on_disk(csv_folder):
+    os.mkdir(csv_folder)
+    for file in ["historical_data.csv", "historical_data_duplicates.csv"]:
+        shutil.copy(f"tests/csv_files/{file}", csv_folder)
+        historical_file = f"{csv_folder}/{file}"
+        expected = rutil.parse_historical_data(historical_file)
+
+        result = rutil.read_historical_data(historical_file)
+        assert os.path.exists(rutil.historical_data_cache_path(historical_file))
+        with patch.object(rutil, 'parse_historical_data', Mock(side_effect=AssertionError("cache not used"))):
+            cached_result = rutil.read_historical_data(historical_file)
+
+        pd.testing.assert_frame_equal(result, expected)
+        pd.testing.assert_frame_equal(cached_result, expected)
+
+
+def test_historical_data_cache_invalidated_when_csv_changes(csv_folder):
+    os.mkdir(csv_folder)
+    shutil.copy("tests/csv_files/historical_data.csv", csv_folder)
+    historical_file = f"{csv_folder}/historical_data.csv"
+    rutil.read_historical_data(historical_file)
+
+    with open(historical_file, 'a', encoding="utf-8") as f:
+        f.write("\n7,2018-11-30 09:00:00\n")
+
+    result = rutil.read_historical_data(historical_file)
+    assert result.shape[0] == 3
+    assert result.loc['2018-11-30 09:00:00'].temp == 7
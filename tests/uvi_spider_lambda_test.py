@@ -1,4 +1,3 @@
-import shutil
 import os
 import json
 import time
@@ -6,21 +5,22 @@ from datetime import date
 from unittest.mock import patch, call
 import pytest
 import uvi_spider_lambda as rspider
+import common
 from datetime import date
 
 
 tmp_folder = "tests/temp"
 
-@pytest.fixture(scope='module')
-def csv_folder():
-    folder = tmp_folder
-    if not os.path.exists(folder):
-        os.mkdir(folder)
-    yield folder
-    shutil.rmtree(folder)
+@pytest.fixture(autouse=True)
+def no_rate_limit():
+    """Requests are not rate limited, except in the tests of the rate limiter"""
+    with patch.dict('os.environ', {'ROBOCLIMATE_RATE_LIMIT': '0'}):
+        common.rate_limiter, common.rate_limiter_configured = None, False
+        yield
+        common.rate_limiter, common.rate_limiter_configured = None, False
 
 
-@patch('common.requests')
+@patch('common.session')
 @patch('uvi_spider_lambda.get_yesterday')
 @patch.dict('os.environ', {'OPEN_WEATHER_API': 'api_key', 'ROBOCLIMATE_CSV_FILES_PATH': tmp_folder})
 def test_collect_uvi_data(get_yesterday, req, csv_folder):
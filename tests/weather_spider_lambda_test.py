@@ -1,16 +1,30 @@
-import shutil
 import os
 import json
 import time
+import logging
+import threading
 from datetime import date
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
 from unittest.mock import patch
 import pytest
+import pandas as pd
+import roboclimate.data_analysis as rda
 from requests.models import Response
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 import weather_spider_lambda as rspider
 import common
 
 
+@pytest.fixture(autouse=True)
+def no_rate_limit():
+    """Requests are not rate limited, except in the tests of the rate limiter"""
+    with patch.dict('os.environ', {'ROBOCLIMATE_RATE_LIMIT': '0'}):
+        common.rate_limiter, common.rate_limiter_configured = None, False
+        yield
+        common.rate_limiter, common.rate_limiter_configured = None, False
+
+
 @pytest.fixture(scope='function')
 def fixtures():
     return dict(
@@ -21,14 +35,6 @@ def fixtures():
     )
 
 
-@pytest.fixture(scope='module')
-def csv_folder():
-    folder = "tests/temp"
-    if not os.path.exists(folder):
-        os.mkdir(folder)
-    yield folder
-    shutil.rmtree(folder)
-
 # see https://www.epochconverter.com/
 
 
@@ -89,7 +95,7 @@ def test_normalise_dt_fail(mock_epoch_time, fixtures):
     assert rspider.normalise_datetime(fixtures['dt'], fixtures['current_utc_date'], tolerance) == fixtures['dt']
 
 
-@patch('common.requests')
+@patch('common.session')
 def test_collect_current_weather_data(req, csv_folder):
     run_params = {
         'utcnow_date': date(2017, 1, 30),
@@ -106,7 +112,7 @@ def test_collect_current_weather_data(req, csv_folder):
 
     req.get.return_value.json.return_value = json_body
 
-    rspider.run_city('london', run_params)
+    common.run_city('london', run_params)
     time.sleep(1)
 
     req.get.assert_any_call("weather_resource_url", timeout=10)
@@ -163,7 +169,427 @@ def test_log_error_when_running_city(logger, fetch_data):
         'weather_resource_url': 'weather_resource_url'
     }
     fetch_data.side_effect = Exception('error')
-    rspider.run_city('city name', run_params)
+    common.run_city('city name', run_params)
     assert logger.error.call_args[0][0] == "Error '%s' while processing '%s'"
     assert logger.error.call_args[0][1].args[0] == 'error'
     assert logger.error.call_args[0][2] == "city name"
+
+
+def weather_run_params(csv_folder):
+    return {
+        'utcnow_date': date(2017, 1, 30),
+        'tolerance': {'positive_tolerance': 60, 'negative_tolerance': 5},
+        'json_to_csv_f': rspider.transform_weather_data_to_csv,
+        'csv_files_path': csv_folder,
+        'csv_header': rspider.CSV_HEADER,
+        'weather_resource': rspider.WEATHER_RESOURCE
+    }
+
+
+def read_csv_rows(csv_file):
+    with open(csv_file, encoding='UTF-8') as f:
+        return [row.rstrip('\n').split(',') for row in f.readlines()[1:]]
+
+
+@patch('common.fetch_data')
+def test_run_cities_concurrently(fetch_data, csv_folder):
+    with open("tests/json_files/weather.json", encoding='UTF-8') as f:
+        json_body = json.loads(f.read())
+
+    def slow_fetch_data(url, deadline=None):
+        time.sleep(0.5)
+        if url == 'madrid':
+            raise ConnectionError('error')
+        response = Response()
+        response.status_code = 200
+        response._content = json.dumps(json_body).encode()
+        return response
+
+    fetch_data.side_effect = slow_fetch_data
+    csv_folder = f"{csv_folder}/concurrent"
+    os.mkdir(csv_folder)
+    run_params = weather_run_params(csv_folder)
+    start = time.perf_counter()
+    common.run_cities({city_name: {**run_params, 'weather_resource_url': city_name} for city_name in common.CITIES}, concurrency=10)
+
+    # all the cities are fetched at the same time
+    assert time.perf_counter() - start < 2.5
+    assert fetch_data.call_count == len(common.CITIES)
+    # errors of a city do not affect the rest of cities
+    for city_name in common.CITIES:
+        assert os.path.exists(f"{csv_folder}/weather_{city_name}.csv") == (city_name != 'madrid')
+    with open(f"{csv_folder}/weather_london.csv", encoding='UTF-8') as f:
+        assert f.read() == f"{rspider.CSV_HEADER}\n300.15,1007,74,3.6,160,1485790200,2017-01-30\n"
+
+
+class FakeWeatherServer:
+    """Local stand-in of the weather API that serves the responses given by 'respond' (path -> body) and counts the
+    connections opened by the clients"""
+
+    def __init__(self, respond):
+        stats = self.stats = {'connections': 0, 'requests': 0, 'paths': [], 'accept_encoding': None}
+
+        class WeatherHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+
+            def setup(self):
+                super().setup()
+                stats['connections'] += 1
+
+            def do_GET(self):
+                stats['requests'] += 1
+                stats['paths'].append(self.path)
+                stats['accept_encoding'] = self.headers['Accept-Encoding']
+                body = respond(self.path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), WeatherHandler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture(scope='function')
+def weather_server():
+    with open("tests/json_files/weather.json", 'rb') as f:
+        body = f.read()
+    server = FakeWeatherServer(lambda path: body)
+    common.session = None
+    yield server.url, server.stats
+    common.session = None
+    server.close()
+
+
+@pytest.fixture(scope='function')
+def group_server():
+    """Serves the recorded response of the group endpoint, restricted to the requested city ids"""
+    with open("tests/json_files/weather_group.json", encoding='UTF-8') as f:
+        recorded = json.load(f)
+
+    def respond(path):
+        ids = [int(city_id) for city_id in parse_qs(urlparse(path).query)['id'][0].split(',')]
+        cities_json = [city_json for city_json in recorded['list'] if city_json['id'] in ids]
+        return json.dumps({'cnt': len(cities_json), 'list': cities_json}).encode()
+
+    server = FakeWeatherServer(respond)
+    common.session = None
+    yield server.url, server.stats
+    common.session = None
+    server.close()
+
+
+def test_session_reuses_connections(weather_server):
+    url, stats = weather_server
+    for i in range(10):
+        assert common.read_remote_resource(f"{url}/weather?id={i}").json()['main']['temp'] == 300.15
+
+    assert stats['requests'] == 10
+    assert stats['connections'] == 1
+    assert 'gzip' in stats['accept_encoding']
+
+
+def test_session_reused_across_invocations(weather_server, csv_folder):
+    url, stats = weather_server
+    csv_folder = f"{csv_folder}/invocations"
+    os.mkdir(csv_folder)
+    run_params = weather_run_params(csv_folder)
+
+    # two invocations of the handler in the same (warm) environment
+    for _ in range(2):
+        common.run_cities({city_name: {**run_params, 'weather_resource_url': f"{url}/weather?q={city_name}"} for city_name in common.CITIES}, concurrency=5)
+
+    assert stats['requests'] == 2 * len(common.CITIES)
+    assert stats['connections'] <= 5
+
+
+def test_city_groups():
+    cities = {city_name: common.CITIES[city_name] for city_name in ['london', 'madrid', 'tokyo']}
+    assert rspider.city_groups(cities, 2) == [{'london': 2643743, 'madrid': 3117735}, {'tokyo': 1850147}]
+    assert rspider.city_groups(cities) == [cities]
+
+
+def test_run_groups(group_server, csv_folder):
+    url, stats = group_server
+    csv_folder = f"{csv_folder}/groups"
+    os.mkdir(csv_folder)
+    run_params = {**weather_run_params(csv_folder), 'utcnow_date': date(2019, 11, 29), 'tolerance': rspider.TOLERANCE, 'group_resource_url': f"{url}/group?units=metric&appid=key"}
+    # lagos is not in the recorded response
+    cities = {city_name: common.CITIES[city_name] for city_name in ['london', 'madrid', 'tokyo', 'lagos']}
+
+    rspider.run_groups(cities, run_params, group_size=2)
+
+    assert stats['paths'] == ["/group?units=metric&appid=key&id=2643743,3117735", "/group?units=metric&appid=key&id=1850147,2332459"]
+    assert read_csv_rows(f"{csv_folder}/weather_london.csv") == [['4.52', '1031', '87', '3.6', '40', '1575061200.0', '2019-11-29']]
+    assert read_csv_rows(f"{csv_folder}/weather_madrid.csv") == [['6.91', '1027', '65', '2.1', '350', '1575061200.0', '2019-11-29']]
+    assert read_csv_rows(f"{csv_folder}/weather_tokyo.csv") == [['8.09', '1021', '70', '1.5', '', '1575061200.0', '2019-11-29']]
+    assert not os.path.exists(f"{csv_folder}/weather_lagos.csv")
+
+
+@patch('common.fetch_data')
+def test_run_groups_same_rows_as_run_cities(fetch_data, csv_folder):
+    with open("tests/json_files/weather_group.json", encoding='UTF-8') as f:
+        recorded = json.load(f)
+    cities_json = {city_json['name'].lower(): city_json for city_json in recorded['list']}
+
+    def response(city_json):
+        response = Response()
+        response.status_code = 200
+        response._content = json.dumps(city_json).encode()
+        return response
+
+    run_params = {**weather_run_params(csv_folder), 'utcnow_date': date(2019, 11, 29), 'tolerance': rspider.TOLERANCE}
+    for mode in ['cities', 'groups']:
+        os.mkdir(f"{csv_folder}/{mode}_mode")
+    fetch_data.side_effect = lambda url, deadline=None: response(cities_json[url])
+    common.run_cities({city_name: {**run_params, 'csv_files_path': f"{csv_folder}/cities_mode", 'weather_resource_url': city_name} for city_name in cities_json})
+    with patch('weather_spider_lambda.fetch_data', side_effect=lambda url, deadline=None: response(recorded)):
+        rspider.run_groups({city_name: common.CITIES[city_name] for city_name in cities_json}, {**run_params, 'csv_files_path': f"{csv_folder}/groups_mode", 'group_resource_url': 'group'})
+
+    for city_name in cities_json:
+        assert read_csv_rows(f"{csv_folder}/groups_mode/weather_{city_name}.csv") == read_csv_rows(f"{csv_folder}/cities_mode/weather_{city_name}.csv")
+
+
+def weather_response():
+    response = Response()
+    response.status_code = 200
+    with open("tests/json_files/weather.json", 'rb') as f:
+        response._content = f.read()
+    return response
+
+
+@patch('common.time.sleep')
+@patch('common.session')
+def test_retry_with_backoff(session, sleep):
+    session.get.side_effect = [ConnectionError('error'), Timeout('timeout'), 'response']
+
+    assert common.read_remote_resource('url') == 'response'
+    assert session.get.call_count == 3
+    waits = [call.args[0] for call in sleep.call_args_list]
+    assert len(waits) == 2
+    assert 0 <= waits[0] <= common.BACKOFF_BASE
+    assert 0 <= waits[1] <= 2 * common.BACKOFF_BASE
+
+
+@patch('common.time.sleep')
+@patch('common.session')
+def test_retry_gives_up(session, sleep):
+    session.get.side_effect = ConnectionError('error')
+
+    with pytest.raises(ConnectionError):
+        common.read_remote_resource('url')
+    assert session.get.call_count == common.MAX_ATTEMPTS
+
+
+@patch('common.time.sleep')
+@patch('common.session')
+def test_no_retry_that_cannot_finish_before_deadline(session, sleep):
+    session.get.side_effect = ConnectionError('error')
+
+    with pytest.raises(common.DeadlineExceeded):
+        common.read_remote_resource('url', deadline=time.monotonic() + common.REQUEST_TIMEOUT / 2)
+    assert session.get.call_count == 1
+    # the request itself does not last beyond the deadline
+    assert session.get.call_args.kwargs['timeout'] <= common.REQUEST_TIMEOUT / 2
+    sleep.assert_not_called()
+
+    # the last attempt is not cut by the deadline: its error is raised as it is
+    session.get.reset_mock()
+    with pytest.raises(ConnectionError):
+        common.read_remote_resource('url', deadline=time.monotonic() + 100 * common.REQUEST_TIMEOUT)
+    assert session.get.call_count == common.MAX_ATTEMPTS
+
+
+@patch('common.session')
+def test_city_cut_by_deadline_is_skipped(session, csv_folder, caplog):
+    def get(url, timeout):
+        # request timed out at the deadline
+        if url == 'paris':
+            raise Timeout('timeout')
+        return weather_response()
+
+    session.get.side_effect = get
+    csv_folder = f"{csv_folder}/deadline_timeout"
+    os.mkdir(csv_folder)
+    run_params = {**weather_run_params(csv_folder), 'deadline': time.monotonic() + common.REQUEST_TIMEOUT / 2}
+
+    skipped = common.run_cities({city_name: {**run_params, 'weather_resource_url': city_name} for city_name in ['london', 'paris']}, concurrency=1)
+
+    assert skipped == ['paris']
+    assert os.listdir(csv_folder) == ["weather_london.csv"]
+    assert [record for record in caplog.records if record.levelno >= logging.ERROR] == []
+
+
+@patch('common.session')
+def test_no_request_after_deadline(session):
+    with pytest.raises(common.DeadlineExceeded):
+        common.read_remote_resource('url', deadline=time.monotonic() - 1)
+    session.get.assert_not_called()
+
+
+def test_invocation_deadline():
+    class LambdaContext:
+        def get_remaining_time_in_millis(self):
+            return 30000
+
+    now = time.monotonic()
+    assert now + 30 - common.DEADLINE_MARGIN <= common.invocation_deadline(LambdaContext()) <= time.monotonic() + 30 - common.DEADLINE_MARGIN
+    with patch.dict('os.environ', {'ROBOCLIMATE_SPIDER_BUDGET': '20'}):
+        assert common.invocation_deadline(None) == pytest.approx(time.monotonic() + 20 - common.DEADLINE_MARGIN, abs=1)
+    with patch.dict('os.environ', {'ROBOCLIMATE_SPIDER_BUDGET': ''}):
+        assert common.invocation_deadline(None) is None
+
+
+@patch('common.session')
+def test_run_cities_skips_cities_after_deadline(session, csv_folder):
+    def slow_get(url, timeout):
+        time.sleep(0.3)
+        return weather_response()
+
+    session.get.side_effect = slow_get
+    csv_folder = f"{csv_folder}/deadline"
+    os.mkdir(csv_folder)
+    run_params = {**weather_run_params(csv_folder), 'deadline': time.monotonic() + 0.5}
+    city_names = list(common.CITIES)
+
+    skipped = common.run_cities({city_name: {**run_params, 'weather_resource_url': city_name} for city_name in city_names}, concurrency=2)
+
+    # 2 cities finish at 0.3 s, the next 2 are in progress at the deadline and the rest are cancelled
+    assert skipped == city_names[4:]
+    assert session.get.call_count == 4
+    assert sorted(os.listdir(csv_folder)) == sorted(f"weather_{city_name}.csv" for city_name in city_names[:4])
+
+    # sequential run: the cities after the deadline are not requested
+    session.get.reset_mock()
+    run_params['deadline'] = time.monotonic() + 0.5
+    assert common.run_cities({city_name: {**run_params, 'weather_resource_url': city_name} for city_name in city_names}, concurrency=1) == city_names[2:]
+    assert session.get.call_count == 2
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket_rate():
+    clock = FakeClock()
+    start = clock.now
+    bucket = common.TokenBucket(rate=1, burst=5, clock=clock, sleep=clock.sleep)
+    times = []
+    for _ in range(65):
+        bucket.acquire()
+        times.append(clock.now - start)
+
+    # the burst is not throttled, then one request per second
+    assert times[:5] == [0] * 5
+    assert times[5:] == pytest.approx(list(range(1, 61)))
+    # never more than rate * window + burst requests in any window
+    assert all(sum(1 for t in times if t0 <= t < t0 + 10) <= 10 + 5 for t0 in times)
+
+
+def test_token_bucket_refills_up_to_burst():
+    clock = FakeClock()
+    bucket = common.TokenBucket(rate=0.5, burst=3, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        bucket.acquire()
+    clock.now += 60
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0, 2]
+
+
+def test_token_bucket_timeout():
+    clock = FakeClock()
+    bucket = common.TokenBucket(rate=1, burst=1, clock=clock, sleep=clock.sleep)
+    bucket.acquire()
+    with pytest.raises(common.DeadlineExceeded):
+        bucket.acquire(timeout=0.5)
+    # the token was not taken
+    assert bucket.acquire(timeout=1) == 1
+
+
+def test_token_bucket_shared_state(csv_folder):
+    clock = FakeClock()
+    state_file = f"{csv_folder}/rate_limit.json"
+    first_bucket = common.TokenBucket(rate=1, burst=2, clock=clock, sleep=clock.sleep, state_file=state_file)
+    second_bucket = common.TokenBucket(rate=1, burst=2, clock=clock, sleep=clock.sleep, state_file=state_file)
+
+    assert [first_bucket.acquire(), first_bucket.acquire(), second_bucket.acquire(), first_bucket.acquire()] == [0, 0, 1, 1]
+    with open(state_file, encoding='UTF-8') as f:
+        assert json.load(f) == {'tokens': -1, 'updated': clock.now - 1}
+
+
+@patch('common.session')
+def test_requests_are_rate_limited(session):
+    clock = FakeClock()
+    common.rate_limiter, common.rate_limiter_configured = common.TokenBucket(rate=1, burst=2, clock=clock, sleep=clock.sleep), True
+    session.get.return_value = 'response'
+
+    for i in range(5):
+        common.read_remote_resource(f"url{i}")
+    assert session.get.call_count == 5
+    assert clock.sleeps == [1, 1, 1]
+
+    # no request is made if the rate limiter does not allow it before the deadline
+    with pytest.raises(common.DeadlineExceeded):
+        common.read_remote_resource('url', deadline=time.monotonic() + 0.5)
+    assert session.get.call_count == 5
+
+
+def test_rate_limiter_configuration():
+    with patch.dict('os.environ', {'ROBOCLIMATE_RATE_LIMIT': '120', 'ROBOCLIMATE_RATE_BURST': '4'}):
+        common.rate_limiter_configured = False
+        limiter = common.get_rate_limiter()
+        assert (limiter.rate, limiter.burst, limiter.state_file) == (2, 4, None)
+        assert common.get_rate_limiter() is limiter
+
+    common.rate_limiter_configured = False
+    assert common.get_rate_limiter() is None
+    assert common.rate_limiter_configured
+
+
+def test_complete_joins(csv_folder):
+    csv_files = "tests/csv_files"
+    run_params = {'csv_files_path': csv_folder}
+    forecast_rows = read_csv_rows(f"{csv_files}/forecast_join.csv")
+    weather_rows = read_csv_rows(f"{csv_files}/weather_join.csv")
+
+    # forecasts are added by the forecast spider run of each day, measurements by the weather spider run of each dt
+    for today in sorted({row[6] for row in forecast_rows}):
+        common.add_pending_forecasts('paris', [row for row in forecast_rows if row[6] == today], run_params)
+    for row in weather_rows:
+        common.complete_joins('paris', [row], run_params)
+
+    join_df = rda.storage.read_csv(f"{csv_folder}/prejoin_paris.csv")
+    expected_df = rda.join_weather_and_forecast(rda.load_data(f"{csv_files}/weather_join.csv"), rda.load_data(f"{csv_files}/forecast_join.csv"))
+    assert not join_df.empty
+    pd.testing.assert_frame_equal(join_df, expected_df, check_dtype=False)
+
+    with open(f"{csv_folder}/{common.PENDING_FORECASTS}_paris.json", encoding='UTF-8') as f:
+        pending = json.load(f)
+    assert all(int(dt) > int(weather_rows[-1][5]) for dt in pending)
+
+
+def test_complete_joins_incomplete_forecasts(csv_folder):
+    run_params = {'csv_files_path': csv_folder}
+    common.add_pending_forecasts('rome', [[1.0, 1000, 50, 2.0, 90, 1575072000, f"2019-11-2{i}"] for i in range(6, 10)], run_params)
+    common.complete_joins('rome', [[1.5, 1001, 51, 2.5, 91, 1575072000, "2019-11-30"]], run_params)
+
+    assert not os.path.exists(f"{csv_folder}/prejoin_rome.csv")
+    with open(f"{csv_folder}/{common.PENDING_FORECASTS}_rome.json", encoding='UTF-8') as f:
+        assert json.load(f) == {}